@@ -11,7 +11,13 @@ from ij.plugin import ChannelSplitter, RoiEnlarger, LutLoader
 from file_naming import FileNamer
 from central_nucleation import show_rois, fill_color_rois
 from java.awt import Color
-class AnalysisSetup:
+from fiber_geometry import FiberGeometry
+from fiber_table import FiberTable
+from roi_utils import open_rois
+from lazy_channels import open_channel_handles, split_channel_handles
+from image_pyramid import ImagePyramid
+from profiling import StageProfiler
+class AnalysisSetup(object):
 	
 	CHANNEL_NAMES = {
 		"Fiber Border",
@@ -28,13 +34,14 @@ class AnalysisSetup:
 	FIBER_BORDER_TITLE = "Fiber Border"
 	DAPI_TITLE = "DAPI"
 		
-	def __init__(self, raw_image_path, channel_list, fiber_roi_path=None, ft_sigma_blur=2, ft_flat_blurring=None):
+	def __init__(self, raw_image_path, channel_list, fiber_roi_path=None, ft_sigma_blur=2, ft_flat_blurring=None, profiler=None):
 		"""
 		Initialize analysis setup with image path and channel configuration
 		
 		Parameters:
 		raw_image_path (str): Path to the raw image file
 		channel_list (list): List of channel names matching CHANNEL_NAMES
+		profiler (StageProfiler): Records the time and memory of each stage, starting with loading the image
 		"""
 		if not File(raw_image_path).exists():
 			raise ValueError("Image file not found: {}".format(raw_image_path))
@@ -43,41 +50,183 @@ class AnalysisSetup:
 			raise ValueError("Invalid channel names: {}".format(invalid_channels))
 
 		self.namer = FileNamer(raw_image_path)
+		self.profiler = StageProfiler(self.namer.image_name) if profiler is None else profiler
 		self.all_channels = [None if ch == 'None' else ch for ch in channel_list]
-		self.rm_fiber = self.load_fiber_rois(fiber_roi_path)
+		self.fiber_geometry = None
+		self.fiber_table = None
+		self.fiber_table_geometry = None
+		self.pyramid = None
 		
-		self.imp = read_image(self.namer.image_path)
-		self.imp = self.standardize_image() # Validates image for analysis
-		self.imp_channels = self.split_channels() # Splits the channels into respective order
-		self.imp_scale = self.imp.getCalibration().pixelWidth # microns per pixel
-		self.channel_dict = self.remap_channels()
-		self.colormap = self.get_colormap()
-		self.check_channels()
+		self.loaded_imp = None
+		self.calibration = None
+		self.cn_merge_imp = None
+		self.ft_merge_imp = None
+		
+		with self.profiler.stage("load") as stage:
+			self.rm_fiber = self.load_fiber_rois(fiber_roi_path)
+			# Channels are only read from disk when a stage needs them, unless the image must be standardized as a whole
+			self.channels, self.channel_reader = open_channel_handles(self.namer.image_path, self.all_channels)
+			if self.channels is None:
+				self.channels = split_channel_handles(self.imp, self.all_channels)
+			self.imp_scale = self.get_calibration().pixelWidth # microns per pixel
+			self.channel_dict = self.remap_channels()
+			self.colormap = self.get_colormap()
+			self.check_channels()
 
-		self.ft_sigma_blur=ft_sigma_blur
-		self.border_channel, self.dapi_channel, self.ft_channels = self.rename_channels() # Renames channels according
-		self.Morph, self.CN, self.FT = self.assign_analyses()
-		if self.CN:
-			self.cn_merge = mergeChannels([self.border_channel, self.dapi_channel], "CN_Merge")
-			IJ.run(self.cn_merge, "Magenta", "");
-			self.cn_merge.setPosition(2)
-			IJ.run(self.cn_merge, "Blue", "");
-			self.cn_merge.hide()
-		else:
-			self.cn_merge = None
-		if self.FT:			
-			ch_to_merge = [ch for ch in self.imp_channels if ch.title in self.CHANNEL_NAMES]
-			self.ft_merge = mergeChannels(ch_to_merge, "FT_Merge")
+			self.ft_sigma_blur=ft_sigma_blur
+			self.border_handle, self.dapi_handle, self.ft_handles = self.rename_channels() # Finds channels according to their names
+			self.Morph, self.CN, self.FT = self.assign_analyses()
+			self.drawn_border_roi = self.get_manual_border()
+			stage["channels"] = len(self.channels)
+			stage["fibers"] = self.rm_fiber.getCount() if self.rm_fiber is not None else 0
+		
+	@property
+	def imp(self):
+		"""The whole image, standardized; only read if a stage needs every channel at once (e.g. Cellpose)"""
+		if self.loaded_imp is None:
+			with self.profiler.stage("standardize"):
+				self.loaded_imp = self.standardize_image(read_image(self.namer.image_path)) # Validates image for analysis
+		return self.loaded_imp
+	
+	@property
+	def imp_channels(self):
+		return [handle.load() for handle in self.channels]
+	
+	@property
+	def border_channel(self):
+		return self.border_handle.load() if self.border_handle else None
+	
+	@property
+	def dapi_channel(self):
+		return self.dapi_handle.load() if self.dapi_handle else None
+	
+	@property
+	def ft_channels(self):
+		return [handle.load() for handle in self.ft_handles]
+	
+	@property
+	def cn_merge(self):
+		"""Composite of the fiber border and DAPI channels, built the first time a figure needs it"""
+		if self.cn_merge_imp is None and self.CN:
+			self.cn_merge_imp = mergeChannels([self.border_channel, self.dapi_channel], "CN_Merge")
+			IJ.run(self.cn_merge_imp, "Magenta", "");
+			self.cn_merge_imp.setPosition(2)
+			IJ.run(self.cn_merge_imp, "Blue", "");
+			self.cn_merge_imp.hide()
+		return self.cn_merge_imp
+	
+	@property
+	def ft_merge(self):
+		"""Composite of the named channels, built the first time a figure needs it"""
+		if self.ft_merge_imp is None and self.FT:
+			ch_to_merge = [handle.load() for handle in self.channels if handle.title in self.CHANNEL_NAMES]
+			self.ft_merge_imp = mergeChannels(ch_to_merge, "FT_Merge")
 			
 			for enum, ch in enumerate(ch_to_merge):
-				self.ft_merge.setPosition(enum+1)
-				IJ.run(self.ft_merge, self.colormap[ch.title], "")
-				IJ.run(self.ft_merge, "Enhance Contrast", "saturated=0.05")
-			self.ft_merge.hide()
-		else:
-			self.ft_merge = None
-		self.drawn_border_roi = self.get_manual_border()
+				self.ft_merge_imp.setPosition(enum+1)
+				IJ.run(self.ft_merge_imp, self.colormap[ch.title], "")
+				IJ.run(self.ft_merge_imp, "Enhance Contrast", "saturated=0.05")
+			self.ft_merge_imp.hide()
+		return self.ft_merge_imp
+	
+	def get_calibration(self):
+		"""Returns the image calibration, from the file metadata unless the whole image was read when it was first asked for"""
+		if self.calibration is None:
+			if self.channel_reader is None or self.loaded_imp is not None:
+				self.calibration = self.imp.getCalibration()
+			else:
+				self.calibration = self.channel_reader.get_calibration()
+		return self.calibration
+	
+	def release_image(self):
+		"""
+		Drops the whole image once the stages that need every channel at once are done.
+		The named channels that aren't loaded yet keep their planes from it, rather than reading them from the file again.
+		"""
+		if self.loaded_imp is None:
+			return
+		stack = self.loaded_imp.getStack()
+		if self.channel_reader is not None and stack.getSize() == len(self.channels):
+			for handle in self.channels:
+				if handle.title is not None and not handle.is_loaded():
+					handle.take_plane(stack.getProcessor(handle.channel+1), self.get_calibration())
+		# Not closed, as the channels may share its pixels
+		self.loaded_imp = None
+	
+	def set_fiber_rois(self, rm_fiber):
+		"""
+		Replaces the fiber ROI manager (e.g. after filtering or border exclusion), discarding the cached fiber geometry.
+		"""
+		self.rm_fiber = rm_fiber
+		self.fiber_geometry = None
+		return self.rm_fiber
+	
+	def get_fiber_geometry(self):
+		"""
+		Returns the centroids, areas and bounding boxes of the current fiber ROIs, computing them only when the ROIs have changed.
+		"""
+		if self.rm_fiber is None:
+			return None
+		fiber_rois = self.rm_fiber.getRoisAsArray()
+		if self.fiber_geometry is None or not self.fiber_geometry.matches(fiber_rois):
+			self.fiber_geometry = FiberGeometry(fiber_rois)
+		return self.fiber_geometry
+	
+	def get_fiber_table(self):
+		"""
+		Returns the FiberTable recording the current fibers and their measurements.
+		The table is rebuilt (keeping fiber IDs, but not measurements) if the ROIs were edited in the ROI manager.
+		"""
+		if self.rm_fiber is None:
+			return None
+		geometry = self.get_fiber_geometry()
+		if self.fiber_table is None or self.fiber_table_geometry is not geometry:
+			self.fiber_table = FiberTable.from_rois(geometry.rois, geometry)
+			self.fiber_table_geometry = geometry
+		return self.fiber_table
+	
+	def set_fiber_table(self, fiber_table):
+		"""
+		Makes a FiberTable the record of the fibers, with the fiber ROI manager as its view.
+		"""
+		self.set_fiber_rois(fiber_table.to_roi_manager(self.rm_fiber))
+		self.fiber_table = fiber_table
+		self.fiber_table_geometry = self.get_fiber_geometry()
+		return self.fiber_table
+	
+	def get_pyramid(self):
+		"""
+		Returns the resolution levels of the image file, reading its metadata on first use.
+		"""
+		if self.pyramid is None:
+			self.pyramid = ImagePyramid(self.namer.image_path)
+		return self.pyramid
+	
+	def get_segmentation_level(self, segmentation_level=None, cellpose_diameter=0):
+		"""
+		Returns the pyramid level to segment the fibers at, or None to segment the full resolution image.
 		
+		segmentation_level is a level index, or "auto" for the coarsest level where fibers of cellpose_diameter
+		(in full resolution pixels) keep the diameter Cellpose works best at.
+		"""
+		if segmentation_level is None or segmentation_level == 0:
+			return None
+		pyramid = self.get_pyramid()
+		if segmentation_level == "auto":
+			level = pyramid.level_for_diameter(cellpose_diameter)
+		elif segmentation_level < len(pyramid):
+			level = pyramid.levels[segmentation_level]
+		else:
+			raise ValueError("Pyramid level {} requested, but {} only has {} levels".format(segmentation_level, self.namer.image_name, len(pyramid)))
+		return None if level.downsample == 1 else level
+	
+	def open_level(self, level):
+		"""
+		Opens a pyramid level, standardized and calibrated like the full resolution image.
+		"""
+		imp = self.get_pyramid().open_level(level, self.get_calibration())
+		return ImageStandardizer(imp).standardize_image()
+	
 	def reset_rois(self):
 		for roi in self.rm_fiber.getRoisAsArray():
 			roi.setFillColor(None)
@@ -96,68 +245,79 @@ class AnalysisSetup:
 			IJ.log("{}: {}".format(key, value))
   
 	
-	def save_results(self):
+	def save_results(self, results):
 		"""
-		Creates a directory in standard location, then saves the results to it.
+		Creates a directory in standard location, then saves a ResultsStore to it.
 		"""
 		self.namer.create_directory("results")
-		IJ.saveAs("Results", self.namer.results_path) if IJ.isResultsWindow() else IJ.log("Results window wasn't opened!")
+		return results.save(self.namer.results_path)
 	
 	def create_figures(self, central_rois=None, identified_fiber_types=None, central_fibers=None, percReductions=None):
+		if self.Morph:
+			self.create_morphology_figure()
+		if self.CN:
+			self.create_nucleation_figures(central_rois, central_fibers, percReductions)
+		if self.FT:
+			self.create_fiber_type_figure(identified_fiber_types)
+	
+	def create_morphology_figure(self):
 		self.namer.create_directory("figures")
 		Prefs.useNamesAsLabels = True;
-		
-		# Make morphology images # 
-		if self.Morph:
-			if self.is_brightfield():
-				morphology_image = self.imp.duplicate()
-			else:
-				morphology_image = self.border_channel.duplicate()
-				
-			for label in range(self.rm_fiber.getCount()):
-				self.rm_fiber.rename(label, str(label+1))
+		if self.is_brightfield():
+			morphology_image = self.imp.duplicate()
+		else:
+			morphology_image = self.border_channel.duplicate()
+			
+		for label in range(self.rm_fiber.getCount()):
+			self.rm_fiber.rename(label, str(label+1))
 
-			self.rm_fiber.moveRoisToOverlay(morphology_image)
-			self.rm_fiber.runCommand(morphology_image, "Show All with Labels")
-			IJ.run(morphology_image, "Labels...",  "color=red font="+str(24)+" show use bold")
-			if not self.is_brightfield():
-				IJ.run(morphology_image, "Magenta", "")
-			morphology_image = morphology_image.flatten()
-			morphology_image.setRoi(self.drawn_border_roi)
-			flat_morphology_image = morphology_image.flatten()
-			IJ.saveAs(flat_morphology_image, "Jpg", self.namer.morphology_path)
-			pass # Morphology image
+		self.rm_fiber.moveRoisToOverlay(morphology_image)
+		self.rm_fiber.runCommand(morphology_image, "Show All with Labels")
+		IJ.run(morphology_image, "Labels...",  "color=red font="+str(24)+" show use bold")
+		if not self.is_brightfield():
+			IJ.run(morphology_image, "Magenta", "")
+		morphology_image = morphology_image.flatten()
+		morphology_image.setRoi(self.drawn_border_roi)
+		flat_morphology_image = morphology_image.flatten()
+		IJ.saveAs(flat_morphology_image, "Jpg", self.namer.morphology_path)
 	
-		# Make gradient and binary central nucleation images #
-		if self.CN:
-			self.rm_fiber.runCommand(self.cn_merge, "Show None")
-			flat_cn_merge = self.cn_merge.flatten()
-			show_rois(flat_cn_merge, central_rois)
-			IJ.run(flat_cn_merge, "Labels...",  "color=lightgray font="+str(24)+" show use bold")
+	def create_nucleation_figures(self, central_rois, central_fibers, percReductions):
+		"""Saves the binary and gradient central nucleation images"""
+		self.namer.create_directory("figures")
+		Prefs.useNamesAsLabels = True;
+		self.rm_fiber.runCommand(self.cn_merge, "Show None")
+		flat_cn_merge = self.cn_merge.flatten()
+		show_rois(flat_cn_merge, central_rois)
+		IJ.run(flat_cn_merge, "Labels...",  "color=lightgray font="+str(24)+" show use bold")
 
-			flat_CN_image = flat_cn_merge.flatten()
-			IJ.saveAs(flat_CN_image, "Jpg", self.namer.cn_path)
+		flat_CN_image = flat_cn_merge.flatten()
+		IJ.saveAs(flat_CN_image, "Jpg", self.namer.cn_path)
 
-			flat_gradient_nucleation_image = self.cn_merge.flatten()
-			fill_color_rois(central_fibers, percReductions, self.rm_fiber.getRoisAsArray())
-			self.rm_fiber.moveRoisToOverlay(flat_gradient_nucleation_image)
-			IJ.saveAs(flat_gradient_nucleation_image, "Jpg", self.namer.cn_gradient_path)
-			self.reset_rois()
-			# Central-nucleation composite image
-			# Multiple erosion image with fraction as image label
-			
-		# Make fiber-typing composite image #
-		if self.FT:	
-			for label in range(self.rm_fiber.getCount()):
-				self.rm_fiber.rename(label, identified_fiber_types[label])
-			self.rm_fiber.moveRoisToOverlay(self.ft_merge)
-			IJ.run(self.ft_merge, "Labels...",  "color=cyan font="+str(24)+" show use bold")
-			ft_image = self.ft_merge.flatten()
-			IJ.saveAs(ft_image, "Jpg", self.namer.ft_comp_path)
+		flat_gradient_nucleation_image = self.cn_merge.flatten()
+		fill_color_rois(central_fibers, percReductions, self.rm_fiber.getRoisAsArray())
+		self.rm_fiber.moveRoisToOverlay(flat_gradient_nucleation_image)
+		IJ.saveAs(flat_gradient_nucleation_image, "Jpg", self.namer.cn_gradient_path)
+		self.reset_rois()
+		# Central-nucleation composite image
+		# Multiple erosion image with fraction as image label
+	
+	def create_fiber_type_figure(self, identified_fiber_types):
+		"""Saves the fiber-typing composite, with each fiber labelled by its type"""
+		self.namer.create_directory("figures")
+		Prefs.useNamesAsLabels = True;
+		for label in range(self.rm_fiber.getCount()):
+			self.rm_fiber.rename(label, identified_fiber_types[label])
+		self.rm_fiber.moveRoisToOverlay(self.ft_merge)
+		IJ.run(self.ft_merge, "Labels...",  "color=cyan font="+str(24)+" show use bold")
+		ft_image = self.ft_merge.flatten()
+		IJ.saveAs(ft_image, "Jpg", self.namer.ft_comp_path)
 	
 	def cleanup(self):
 		WM.getWindow("Log").close()
-		self.imp.close()
+		if self.loaded_imp is not None:
+			self.loaded_imp.close()
+		if self.channel_reader is not None:
+			self.channel_reader.close()
 		self.rm_fiber.close()
 	
 	def is_brightfield(self):
@@ -188,10 +348,11 @@ class AnalysisSetup:
 	
 	def load_fiber_rois(self, fiber_roi_path=None):
 		fiber_roi_path = self.namer.fiber_roi_path if fiber_roi_path is None else fiber_roi_path
+		self.fiber_roi_path = None # The file the fibers came from, where their IDs are stored (see incremental.save_snapshot)
 		try:
 			if os.path.exists(fiber_roi_path):
-				rm_fiber = RoiManager().getRoiManager()
-				rm_fiber.open(fiber_roi_path)
+				rm_fiber = open_rois(fiber_roi_path)
+				self.fiber_roi_path = fiber_roi_path
 			else:
 				return None
 		except IOError:
@@ -199,39 +360,27 @@ class AnalysisSetup:
 			raise
 		return rm_fiber
 
-	def split_channels(self):
-		IJ.log("### Splitting channels ###")
-		channels = ChannelSplitter.split(self.imp)
-		return channels
-		
 	def rename_channels(self):	
-		ft_channels = []
-		dapi_channel = None
-		border_channel = None
+		ft_handles = []
+		dapi_handle = None
+		border_handle = None
 		
-		for channel in self.imp_channels:
-			channel_abbrev = channel.title.split("-")[0]
-			channel.title = self.channel_dict[channel_abbrev]
-#			if channel.title is not None and channel.title != self.DAPI_TITLE:
-#				channel.show()
-#				pass
-			if channel.title == self.FIBER_BORDER_TITLE:
-				border_channel = channel
-			if channel.title == self.DAPI_TITLE:
-				dapi_channel = channel
-			if channel.title in self.ALL_FIBERTYPE_CHANNELS:
-				ft_channels.append(channel)
-
-		# self.open_channels = map(WM.getImage, WM.getIDList())
-		return border_channel, dapi_channel, ft_channels
+		for handle in self.channels:
+			if handle.title == self.FIBER_BORDER_TITLE:
+				border_handle = handle
+			if handle.title == self.DAPI_TITLE:
+				dapi_handle = handle
+			if handle.title in self.ALL_FIBERTYPE_CHANNELS:
+				ft_handles.append(handle)
+		return border_handle, dapi_handle, ft_handles
 
 	def assign_analyses(self):
 		"""
 		Chooses analyses to execute according to the available channels
 		"""
-		Morph = True if self.border_channel else False
-		CN = True if self.border_channel and self.dapi_channel else False
-		FT = True if self.border_channel and any(self.ft_channels) else False
+		Morph = True if self.border_handle else False
+		CN = True if self.border_handle and self.dapi_handle else False
+		FT = True if self.border_handle and any(self.ft_handles) else False
 		return Morph, CN, FT
 		
 	def get_channel_index(self, channel_name):
@@ -259,7 +408,7 @@ class AnalysisSetup:
 		specified_channels = [ch for ch in self.all_channels if ch is not None]
 		max_ch_pos = max([i for i, x in enumerate(self.all_channels) if x is not None] or [0])+1 # offset to compare with length
 		num_ch_specified = len(specified_channels)
-		num_ch_image = len(self.imp_channels)
+		num_ch_image = len(self.channels)
 		if num_ch_specified > num_ch_image:
 			IJ.error("Too many channels specified: {} in specifications, {} in image".format(num_ch_specified, num_ch_image))
 			sys.exit(1)
@@ -277,7 +426,7 @@ class AnalysisSetup:
 			sys.exit(1)
 		
 	
-	def standardize_image(self):
+	def standardize_image(self, imp):
 		"""
 		Standardize image format using ImageStandardizer
 		
@@ -285,7 +434,7 @@ class AnalysisSetup:
 		ImagePlus: Standardized image
 		"""
 		IJ.log("Checking and standardizing image format...")
-		image_checker = ImageStandardizer(self.imp)
+		image_checker = ImageStandardizer(imp)
 		standardized_imp = image_checker.standardize_image()
 		if standardized_imp is None:
 			raise RuntimeError("Image standardization failed")
@@ -0,0 +1,122 @@
+from ij import IJ
+from ij.macro import Interpreter
+from ij.plugin.frame import RoiManager
+from java.lang import Throwable
+from datetime import datetime
+from collections import OrderedDict
+import os, time, traceback
+from jy_tools import closeAll
+from image_tools import batch_open_images
+from analysis_setup import AnalysisSetup
+from file_naming import FileNamer
+from utilities import make_directories
+from main import run_analysis, default_config
+from cellpose_runner import CellposeRunner
+
+IMAGE_TYPES = [".tif", ".tiff", ".nd2", ".png"]
+SUMMARY_COLUMNS = ["Image", "Status", "Fibers", "Seconds", "Error"]
+
+def find_experiment_images(experiment_dir, file_types=IMAGE_TYPES, name_filter=None):
+	"""
+	Returns the sorted paths of all images in the 'raw' folder of an experiment directory.
+	"""
+	raw_dir = os.path.join(experiment_dir, "raw")
+	if not os.path.isdir(raw_dir):
+		raise ValueError("Missing required image directory: {}".format(raw_dir))
+	return sorted(batch_open_images(raw_dir, list(file_types), name_filter))
+
+def reset_workspace():
+	"""
+	Closes all images and empties the shared ROI manager, so nothing leaks from one image into the next.
+	"""
+	rm = RoiManager.getInstance()
+	if rm is not None:
+		rm.reset()
+	IJ.run("Close All")
+	closeAll()
+
+def run_image(image_path, channel_list, options, cellpose_worker=None):
+	"""
+	Runs the full FiberSight analysis on a single image without dialogs or windows.
+	Manually edited fiber ROIs are used if they exist, then Cellpose ROIs, otherwise Cellpose is run.
+
+	Returns the number of fibers analyzed.
+	"""
+	reset_workspace()
+	namer = FileNamer(image_path)
+	fiber_roi_path = namer.manual_rois_path if os.path.exists(namer.manual_rois_path) else None # Prefer manually edited fibers
+	analysis = AnalysisSetup(image_path, channel_list, fiber_roi_path=fiber_roi_path)
+	analysis.namer.validate_structure()
+	config = default_config(analysis, **options)
+	run_analysis(analysis, config, headless=True, cellpose_worker=cellpose_worker)
+	return analysis.rm_fiber.getCount()
+
+def write_summary(summary, summary_path):
+	with open(summary_path, "w") as summary_file:
+		summary_file.write(",".join(SUMMARY_COLUMNS) + "\n")
+		for row in summary:
+			summary_file.write(",".join('"{}"'.format(str(row[column]).replace('"', "'")) for column in SUMMARY_COLUMNS) + "\n")
+
+def run_experiment(experiment_dir, channel_list, options=None, file_types=IMAGE_TYPES, name_filter=None, skip_existing=False, image_paths=None, summary_path=None, persistent_cellpose=True):
+	"""
+	Runs FiberSight on every image of an experiment directory, headless and unattended.
+
+	`options` are passed to `main.default_config` (e.g. cellpose_model, threshold_method). A failing image is
+	logged and recorded in the batch summary, then the batch carries on with the next image. If skip_existing
+	is True, images which already have a results file are skipped, so an interrupted batch can be resumed.
+	With persistent_cellpose, one Cellpose process is kept running for the whole batch, so the model loads once.
+
+	The summary is saved to `summary_path`, by default a timestamped CSV in the experiment's results folder.
+	Returns the batch summary, one OrderedDict of SUMMARY_COLUMNS per image.
+	"""
+	options = options or {}
+	if image_paths is None:
+		image_paths = find_experiment_images(experiment_dir, file_types, name_filter)
+	IJ.log("### Running FiberSight batch on {} images ###".format(len(image_paths)))
+
+	cellpose_worker = None
+	if persistent_cellpose:
+		try:
+			runner = CellposeRunner(model_name=options.get("cellpose_model", "cyto3"))
+			# Only started once an image needs segmenting; parallel workers log next to their summaries, in batch_logs
+			cellpose_worker = runner.create_worker(log_dir=os.path.dirname(summary_path) if summary_path else None)
+		except OSError as e:
+			IJ.log("No persistent Cellpose worker: {}".format(e))
+	batch_mode = Interpreter.isBatchMode()
+	Interpreter.setBatchMode(True) # Keeps images off-screen
+	summary = []
+	try:
+		for enum, image_path in enumerate(image_paths):
+			row = OrderedDict([("Image", os.path.basename(image_path)), ("Status", "Done"), ("Fibers", 0), ("Seconds", 0), ("Error", "")])
+			IJ.log("### Image {}/{}: {} ###".format(enum+1, len(image_paths), row["Image"]))
+			if skip_existing and os.path.exists(FileNamer(image_path).results_path):
+				IJ.log("Results already exist, skipping")
+				row["Status"] = "Skipped"
+				summary.append(row)
+				continue
+			start = time.time()
+			try:
+				row["Fibers"] = run_image(image_path, channel_list, options, cellpose_worker)
+				if cellpose_worker is not None and cellpose_worker.failed:
+					cellpose_worker = None # Already logged; the remaining images use the Cellpose command
+			except (Exception, Throwable, SystemExit) as e: # AnalysisSetup exits on invalid channels
+				row["Status"] = "Failed"
+				row["Error"] = str(e)
+				IJ.log("ERROR: {} failed: {}".format(row["Image"], e))
+				IJ.log(traceback.format_exc())
+			row["Seconds"] = round(time.time() - start, 2)
+			summary.append(row)
+	finally:
+		reset_workspace()
+		Interpreter.setBatchMode(batch_mode)
+		if cellpose_worker is not None:
+			cellpose_worker.close()
+
+	if summary_path is None:
+		make_directories(experiment_dir, "results")
+		summary_path = os.path.join(experiment_dir, "results", "batch_summary_{}.csv".format(datetime.now().strftime("%Y-%m-%d_%H-%M-%S")))
+	write_summary(summary, summary_path)
+	statuses = [row["Status"] for row in summary]
+	IJ.log("### Batch complete: {} analyzed, {} skipped, {} failed ###".format(statuses.count("Done"), statuses.count("Skipped"), statuses.count("Failed")))
+	IJ.log("Batch summary saved to {}".format(summary_path))
+	return summary
@@ -3,13 +3,17 @@ from ij.plugin import ChannelSplitter
 import os
 from image_tools import read_image, convertLabelsToROIs, detectMultiChannel
 from utilities import download_model, get_model_path
+from cellpose_worker import CellposeWorker
+from segmentation_cache import image_key, hash_file
+from ij.plugin.frame import RoiManager
+from tiled_segmentation import tile_grid, crop_tile, stitch_tiles
 import time
 
 class CellposeRunner:
 	HOMEDIR = os.path.expanduser("~")
 	CELLPOSE_DEFAULT_MODELS = ["nuclei", "cyto2", "cyto3"]
 	
-	def __init__(self, model_name="cyto3", diameter=0, segmentation_channel=0, default_settings=None):
+	def __init__(self, model_name="cyto3", diameter=0, segmentation_channel=0, default_settings=None, worker=None, cache=None, tile_size=None, tile_overlap=256):
 		
 		self.settings = default_settings or {
 			"env_path": self.find_cellpose_env(), 
@@ -25,10 +29,15 @@ class CellposeRunner:
 		self.pretrained_model = self.get_pretrained_model()
 		self.image = None
 		self.image_path = None
+		self.channel_handle = None # A single channel to segment, read from the file when needed (see set_channel)
 		self.segmentation_channel = segmentation_channel
 		self.additional_flags = "[--use_gpu, --cellprob_threshold, {}, --flow_threshold, {}]".format(self.settings["cellprob_threshold"], self.settings["flow_threshold"])
 		self.label_image = None
 		self.rm = None
+		self.worker = worker # A CellposeWorker, which keeps the model loaded between images
+		self.cache = cache # A SegmentationCache, which skips Cellpose for previously segmented images
+		self.tile_size = tile_size # Images larger than this are segmented in tiles, overlapping by tile_overlap pixels
+		self.tile_overlap = tile_overlap
 
 	def get_pretrained_model(self):
 		"""
@@ -43,6 +52,13 @@ class CellposeRunner:
 			pretrained_model_string = ""
 		return pretrained_model_string
 
+	def create_worker(self, use_gpu=True, log_dir=None):
+		"""
+		Returns a persistent CellposeWorker for this runner's model and environment, to share between runners.
+		"""
+		model_path = None if self.pretrained_model else self.model_path
+		return CellposeWorker(self.settings["env_path"], model_name=self.model_name, model_path=model_path, use_gpu=use_gpu, log_dir=log_dir)
+
 	def update_settings(self, **kwargs):
 		self.settings.update(kwargs)
 		return self
@@ -91,39 +107,160 @@ class CellposeRunner:
 				self.image.hide()
 				self.image = channel_to_segment
 	
-	def run_cellpose(self):
-		if not self.image:
-			raise Exception("Image path wasn't set", "Use set_image() to specify target image")
+	def set_channel(self, channel_handle):
+		"""
+		Sets a single channel to segment from a lazy_channels.ChannelHandle. Tiled images are read from the file one tile at a time,
+		so the whole channel is only read if it is segmented at once or hashed for the segmentation cache.
+		"""
+		self.channel_handle = channel_handle
+		self.image = None
+		self.image_path = None
+	
+	def get_image(self):
+		"""Returns the image to segment, reading the channel set with set_channel the first time it is needed"""
+		if self.image is None and self.channel_handle is not None:
+			self.image = self.channel_handle.load().duplicate()
+		return self.image
+	
+	def get_size(self):
+		if self.image is None and self.channel_handle is not None:
+			return self.channel_handle.get_size()
+		return self.image.getWidth(), self.image.getHeight()
+	
+	def get_cache_key(self):
+		"""
+		Returns the segmentation cache key of the current image with the current model and settings.
+		"""
+		model_hash = self.model_name if self.pretrained_model or not os.path.exists(self.model_path) else hash_file(self.model_path)
+		settings = {
+			"model": model_hash,
+			"segmentation_channel": self.segmentation_channel,
+			"diameter": self.diameter,
+			"cellprob_threshold": self.settings["cellprob_threshold"],
+			"flow_threshold": self.settings["flow_threshold"],
+			"ch1": self.settings["ch1"],
+			"ch2": self.settings["ch2"]
+		}
+		if self.is_tiled():
+			settings["tiles"] = [self.tile_size, self.tile_overlap]
+		return image_key(self.get_image(), settings)
 
-		if not self.image.getProcessor():
-			raise Exception("Image was closed or does not exist")
+	def load_cached_rois(self, cache_key):
+		"""
+		Fills the ROI manager from the segmentation cache. Returns False on a cache miss.
+		"""
+		rois = self.cache.get(cache_key)
+		if rois is None:
+			return False
+		IJ.log("### Using cached Cellpose segmentation of {} ###".format(self.image.title))
+		self.rm = RoiManager().getRoiManager()
+		self.rm.reset()
+		for roi in rois:
+			self.rm.addRoi(roi)
+		self.label_image = None
+		IJ.log("Cellpose Number of Detected Fibers: {}".format(self.rm.getCount()))
+		return True
+
+	def start_worker(self):
+		"""
+		Starts the persistent worker if needed. If it can't start, it is dropped and Cellpose runs through the BIOP command instead.
+		"""
+		if self.worker is not None and not self.worker.failed:
+			try:
+				self.worker.start()
+				return True
+			except (OSError, IOError) as e:
+				IJ.log("WARNING: Cellpose worker failed to start, using the Cellpose command instead: {}".format(e))
+				self.worker.close()
+				self.worker.failed = True
+		self.worker = None
+		return False
+	
+	def segment_image(self, imp):
+		"""
+		Runs Cellpose on an image, with the persistent worker if there is one, and returns the label image.
+		"""
+		if self.worker is not None and self.worker.model_name != self.model_name:
+			raise ValueError("Cellpose worker runs model {}, but {} was requested".format(self.worker.model_name, self.model_name))
+		if self.start_worker():
+			IJ.log("### Running Cellpose worker on {} ###".format(imp.title))
+			return self.worker.segment(imp, diameter=self.diameter, \
+			cellprob_threshold=self.settings["cellprob_threshold"], flow_threshold=self.settings["flow_threshold"])
 		
-		if not self.image.visible:
-			self.image.show()
+		if not imp.visible:
+			imp.show()
 		
 		if 'BIOP' in os.listdir(IJ.getDirectory("plugins")):
 			if not os.path.exists(self.settings["env_path"]):
 				raise OSError("Cellpose Environment not found at {}".format(self.settings["env_path"]))
 			try:
 				cellpose_str = "env_path={} env_type={} model={} model_path={} diameter={} ch1={} ch2={} additional_flags={}".format(
-					self.settings["env_path"], self.settings["env_type"], self.pretrained_model, self.model_path, \\
+					self.settings["env_path"], self.settings["env_type"], self.pretrained_model, self.model_path, \
 					self.diameter, self.settings["ch1"], self.settings["ch2"], self.additional_flags)
 				start = time.time()
-				IJ.log("### Running Cellpose on {} ###".format(self.image.title))
+				IJ.log("### Running Cellpose on {} ###".format(imp.title))
 				IJ.log("- model: {}".format(self.model_name))
 				IJ.log("- diameter: {}".format(self.diameter))
 				IJ.log("- cellprob_threshold: {}".format(self.settings["cellprob_threshold"]))
 				IJ.log("- flow_threshold: {}".format(self.settings["flow_threshold"]))
-				IJ.run(self.image, "Cellpose ...", cellpose_str)
+				IJ.run(imp, "Cellpose ...", cellpose_str)
 				finish = time.time()
 				time_in_seconds = finish-start
 				IJ.log("Time to run Cellpose = {:.2f} seconds".format(time_in_seconds))
 			except Exception as e:
 				IJ.log(str(e))
-		self.label_image = IJ.getImage()
-		self.rm = convertLabelsToROIs(self.label_image)
+		return IJ.getImage()
+	
+	def is_tiled(self):
+		return self.tile_size is not None and max(self.get_size()) > self.tile_size
+	
+	def run_tiled(self):
+		"""
+		Segments the image in overlapping tiles, then stitches the tile ROIs into one ROI manager.
+		Only one tile is held by Cellpose at a time, so memory is bounded by the tile size rather than the image size.
+		Tiles of a channel set with set_channel are read from the file, unless the whole channel was already read.
+		"""
+		width, height = self.get_size()
+		tiles = tile_grid(width, height, self.tile_size, self.tile_overlap)
+		IJ.log("### Segmenting {}x{} image in {} tiles ###".format(width, height, len(tiles)))
+		tile_results = []
+		for enum, tile in enumerate(tiles):
+			IJ.showProgress(enum, len(tiles))
+			tile_imp = self.channel_handle.open_region(tile) if self.image is None else crop_tile(self.image, tile)
+			tile_labels = self.segment_image(tile_imp)
+			rm_tile = convertLabelsToROIs(tile_labels)
+			tile_results.append((tile, list(rm_tile.getRoisAsArray())))
+			rm_tile.reset()
+			tile_labels.close()
+			tile_imp.close()
+		rois = stitch_tiles(tile_results, width, height)
+		rm = RoiManager().getRoiManager()
+		rm.reset()
+		for roi in rois:
+			rm.addRoi(roi)
+		return rm
+	
+	def run_cellpose(self):
+		if not self.image and self.channel_handle is None:
+			raise Exception("Image path wasn't set", "Use set_image() or set_channel() to specify target image")
+
+		if self.image is not None and not self.image.getProcessor():
+			raise Exception("Image was closed or does not exist")
+		
+		cache_key = self.get_cache_key() if self.cache is not None else None
+		if cache_key is not None and self.load_cached_rois(cache_key):
+			return
+		
+		if self.is_tiled():
+			self.label_image = None
+			self.rm = self.run_tiled()
+		else:
+			self.label_image = self.segment_image(self.get_image())
+			self.rm = convertLabelsToROIs(self.label_image)
 		num_detections = self.rm.getCount()
 		IJ.log("Cellpose Number of Detected Fibers: {}".format(num_detections))	
+		if cache_key is not None and num_detections > 0:
+			self.cache.put(cache_key, self.rm.getRoisAsArray())
 		
 	def save_rois(self, save_path):
 		IJ.log("### Saving ROIs ###")
@@ -0,0 +1,279 @@
+from ij import IJ, ImagePlus
+from ij.process import ShortProcessor, FloatProcessor
+from java.net import Socket, ServerSocket, InetAddress, ConnectException
+from java.io import DataInputStream, DataOutputStream, BufferedInputStream, BufferedOutputStream
+from java.lang import String
+from java.nio import ByteBuffer
+from java.nio.file import Files, Paths, StandardCopyOption
+from jarray import zeros
+import os, sys, json, subprocess, time, tempfile
+
+HOMEDIR = os.path.expanduser("~")
+SERVER_PATH = os.path.join(HOMEDIR, ".fibersight", "cellpose_server.py")
+CHUNK_PIXELS = 1 << 20 # Pixels streamed to or from the worker at a time
+
+# Runs inside the Cellpose environment (CPython 3), so it is written out to SERVER_PATH rather than imported.
+# Protocol, all integers big-endian: a 4-byte header length, a JSON header, then the raw pixels.
+# Requests send (channels, height, width) float32 pixels; responses send (height, width) uint16 or float32 labels.
+SERVER_SCRIPT = '''
+import argparse, json, socket, struct, sys, traceback
+import numpy as np
+
+def recv_exact(conn, n_bytes):
+	buffer = bytearray(n_bytes)
+	view = memoryview(buffer)
+	received = 0
+	while received < n_bytes:
+		n_read = conn.recv_into(view[received:], n_bytes - received)
+		if n_read == 0:
+			raise EOFError("Connection closed")
+		received += n_read
+	return buffer
+
+def send_message(conn, header, payload=b""):
+	data = json.dumps(header).encode("utf-8")
+	conn.sendall(struct.pack(">I", len(data)) + data)
+	if payload:
+		conn.sendall(payload)
+
+def load_model(args):
+	from cellpose import models
+	if args.model_path:
+		return models.CellposeModel(gpu=args.gpu, pretrained_model=args.model_path)
+	if hasattr(models, "Cellpose"):
+		return models.Cellpose(gpu=args.gpu, model_type=args.model_type)
+	return models.CellposeModel(gpu=args.gpu, model_type=args.model_type)
+
+def segment(model, header, pixels):
+	n_channels, height, width = header["channels"], header["height"], header["width"]
+	image = np.frombuffer(pixels, dtype=">f4").astype(np.float32).reshape(n_channels, height, width)
+	kwargs = {"diameter": header["diameter"] or None, "channels": [0, 0],
+		"flow_threshold": header["flow_threshold"], "cellprob_threshold": header["cellprob_threshold"]}
+	if n_channels == 1:
+		image = image[0]
+	else:
+		kwargs["channel_axis"] = 0
+	return model.eval(image, **kwargs)[0]
+
+def main():
+	parser = argparse.ArgumentParser(description="FiberSight persistent Cellpose server")
+	parser.add_argument("--port", type=int, required=True)
+	parser.add_argument("--model_type", default="cyto3")
+	parser.add_argument("--model_path", default="")
+	parser.add_argument("--gpu", action="store_true")
+	args = parser.parse_args()
+
+	model = load_model(args)
+	print("Loaded Cellpose model {}".format(args.model_path or args.model_type), flush=True)
+	server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	server.bind(("127.0.0.1", args.port))
+	server.listen(1)
+	conn, _ = server.accept()
+	with conn:
+		while True:
+			try:
+				header = json.loads(recv_exact(conn, struct.unpack(">I", recv_exact(conn, 4))[0]).decode("utf-8"))
+			except EOFError:
+				break
+			if header.get("command") == "shutdown":
+				break
+			pixels = recv_exact(conn, 4 * header["channels"] * header["height"] * header["width"])
+			try:
+				masks = segment(model, header, pixels)
+			except Exception:
+				send_message(conn, {"status": "error", "message": traceback.format_exc()})
+				continue
+			n_labels = int(masks.max())
+			dtype = "short" if n_labels < 65536 else "float"
+			labels = masks.astype(">u2" if dtype == "short" else ">f4")
+			send_message(conn, {"status": "ok", "n_labels": n_labels, "dtype": dtype}, labels.tobytes())
+			print("Segmented {}x{} image: {} labels".format(header["width"], header["height"], n_labels), flush=True)
+	server.close()
+
+if __name__ == "__main__":
+	main()
+'''
+
+def find_env_python(env_path):
+	"""
+	Returns the python executable of a conda or venv environment
+	"""
+	candidates = ["python.exe", os.path.join("Scripts", "python.exe")] if IJ.isWindows() else [os.path.join("bin", "python")]
+	for candidate in candidates:
+		python_path = os.path.join(env_path, candidate)
+		if os.path.exists(python_path):
+			return python_path
+	raise OSError("Could not find a python executable in the Cellpose environment at {}".format(env_path))
+
+def find_free_port():
+	server = ServerSocket(0)
+	port = server.getLocalPort()
+	server.close()
+	return port
+
+class CellposeWorker:
+	"""
+	A long-lived Cellpose process that loads its model once, then segments every image streamed to it over a local socket.
+
+	The process is started on the first `segment` call and stops with `close`, or when this session's connection drops.
+	Its output goes to a log named by its port in `log_dir` (by default next to the server script), so parallel workers keep separate logs.
+	"""
+
+	def __init__(self, env_path, model_name="cyto3", model_path=None, use_gpu=True, startup_timeout=600, log_dir=None):
+		self.env_path = env_path
+		self.model_name = model_name
+		self.model_path = model_path
+		self.use_gpu = use_gpu
+		self.startup_timeout = startup_timeout
+		self.process = None
+		self.socket = None
+		self.log_file = None
+		self.log_dir = log_dir or os.path.dirname(SERVER_PATH)
+		self.log_path = None
+		self.failed = False # Set by CellposeRunner when the process can't start, so later images don't retry it
+
+	def is_running(self):
+		return self.process is not None and self.process.poll() is None
+
+	def write_server_script(self):
+		"""
+		Writes the server script if it is missing or out of date. Other workers may be launching it at the same time,
+		so it is written to a temporary file which then replaces the script in one atomic move.
+		"""
+		if os.path.exists(SERVER_PATH):
+			with open(SERVER_PATH) as server_file:
+				if server_file.read() == SERVER_SCRIPT:
+					return
+		server_dir = os.path.dirname(SERVER_PATH)
+		if not os.path.exists(server_dir):
+			os.makedirs(server_dir)
+		handle, temp_path = tempfile.mkstemp(suffix=".py", dir=server_dir)
+		with os.fdopen(handle, "w") as server_file:
+			server_file.write(SERVER_SCRIPT)
+		Files.move(Paths.get(temp_path), Paths.get(SERVER_PATH), StandardCopyOption.ATOMIC_MOVE, StandardCopyOption.REPLACE_EXISTING)
+
+	def start(self):
+		if self.is_running():
+			return self
+		self.socket = None # A crashed worker is restarted with a fresh connection
+		self.write_server_script()
+		port = find_free_port()
+		command = [find_env_python(self.env_path), SERVER_PATH, "--port", str(port)]
+		command.extend(["--model_path", self.model_path] if self.model_path else ["--model_type", self.model_name])
+		if self.use_gpu:
+			command.append("--gpu")
+		IJ.log("### Starting Cellpose worker with model {} ###".format(self.model_name))
+		if not os.path.exists(self.log_dir):
+			os.makedirs(self.log_dir)
+		self.log_path = os.path.join(self.log_dir, "cellpose_server_{}.log".format(port))
+		self.log_file = open(self.log_path, "w")
+		self.process = subprocess.Popen(command, stdout=self.log_file, stderr=subprocess.STDOUT)
+		start = time.time()
+		while self.socket is None:
+			if not self.is_running():
+				raise OSError("Cellpose worker exited during startup, see {}".format(self.log_path))
+			if time.time() - start > self.startup_timeout:
+				self.close()
+				raise OSError("Cellpose worker did not start within {} seconds, see {}".format(self.startup_timeout, self.log_path))
+			try:
+				self.socket = Socket(InetAddress.getLoopbackAddress(), port)
+			except ConnectException:
+				time.sleep(0.5) # The model is still loading
+		self.input = DataInputStream(BufferedInputStream(self.socket.getInputStream()))
+		self.output = DataOutputStream(BufferedOutputStream(self.socket.getOutputStream()))
+		IJ.log("Cellpose worker ready after {:.2f} seconds".format(time.time() - start))
+		return self
+
+	def send_header(self, header):
+		data = String(json.dumps(header)).getBytes("UTF-8")
+		self.output.writeInt(len(data))
+		self.output.write(data)
+
+	def read_header(self):
+		data = zeros(self.input.readInt(), 'b')
+		self.input.readFully(data)
+		return json.loads(String(data, "UTF-8"))
+
+	def get_planes(self, imp):
+		"""Returns the (processor, channel) of each plane to send: one per channel, or the red, green and blue channels of an RGB image"""
+		if imp.getType() == ImagePlus.COLOR_RGB:
+			return [(imp.getProcessor(), channel) for channel in range(3)]
+		stack = imp.getStack()
+		return [(stack.getProcessor(imp.getStackIndex(channel, imp.getZ(), imp.getT())), 0) for channel in range(1, imp.getNChannels()+1)]
+
+	def rows_per_chunk(self, width):
+		return max(1, CHUNK_PIXELS // width)
+
+	def send_planes(self, planes, width, height):
+		"""
+		Streams the planes as float32 in chunks of rows through one small buffer, so whole-slide planes
+		(over 2^31 bytes as floats) are never held as a single array.
+		"""
+		n_rows = self.rows_per_chunk(width)
+		pixel_buffer = ByteBuffer.allocate(4 * n_rows * width)
+		for ip, channel in planes:
+			for y in xrange(0, height, n_rows):
+				rows = min(n_rows, height - y)
+				ip.setRoi(0, y, width, rows)
+				chunk = ip.crop().toFloat(channel, None)
+				ip.resetRoi()
+				pixel_buffer.clear()
+				pixel_buffer.asFloatBuffer().put(chunk.getPixels())
+				self.output.write(pixel_buffer.array(), 0, 4 * rows * width)
+		self.output.flush()
+
+	def read_labels(self, dtype, width, height):
+		"""Reads the label image in chunks of rows, straight into the pixel array of its processor"""
+		bytes_per_pixel = 2 if dtype == "short" else 4
+		labels = zeros(width * height, 'h' if dtype == "short" else 'f')
+		n_rows = self.rows_per_chunk(width)
+		label_bytes = zeros(bytes_per_pixel * n_rows * width, 'b')
+		for y in xrange(0, height, n_rows):
+			n_pixels = min(n_rows, height - y) * width
+			self.input.readFully(label_bytes, 0, bytes_per_pixel * n_pixels)
+			chunk = ByteBuffer.wrap(label_bytes, 0, bytes_per_pixel * n_pixels)
+			if dtype == "short":
+				chunk.asShortBuffer().get(labels, y * width, n_pixels)
+			else:
+				chunk.asFloatBuffer().get(labels, y * width, n_pixels)
+		if dtype == "short":
+			return ShortProcessor(width, height, labels, None)
+		return FloatProcessor(width, height, labels)
+
+	def segment(self, imp, diameter=0, cellprob_threshold=0.0, flow_threshold=0.4):
+		"""
+		Segments an image (single or multi-channel, segmented in gray-scale) and returns the Cellpose label image.
+		"""
+		self.start()
+		planes = self.get_planes(imp)
+		width, height = imp.getWidth(), imp.getHeight()
+		start = time.time()
+		self.send_header({"channels": len(planes), "width": width, "height": height, "diameter": diameter, \
+		"cellprob_threshold": cellprob_threshold, "flow_threshold": flow_threshold})
+		self.send_planes(planes, width, height)
+
+		header = self.read_header()
+		if header["status"] != "ok":
+			raise RuntimeError("Cellpose worker failed on {}:\n{}".format(imp.getTitle(), header["message"]))
+		label_ip = self.read_labels(header["dtype"], width, height)
+		label_ip.resetMinAndMax()
+		IJ.log("Cellpose worker segmented {} in {:.2f} seconds".format(imp.getTitle(), time.time() - start))
+		return ImagePlus("{}-cp_masks".format(imp.getTitle()), label_ip)
+
+	def close(self):
+		shut_down = False
+		if self.socket is not None:
+			try:
+				self.send_header({"command": "shutdown"})
+				self.output.flush()
+				self.socket.close()
+				shut_down = True
+			except Exception as e:
+				IJ.log("Error closing the Cellpose worker connection: {}".format(e))
+			self.socket = None
+		if self.is_running():
+			self.process.wait() if shut_down else self.process.terminate()
+		if self.log_file is not None:
+			self.log_file.close()
+			self.log_file = None
+		self.process = None
@@ -11,7 +11,10 @@ from ij.plugin.frame import RoiManager
 from ij.plugin.filter import ParticleAnalyzer as PA
 from ij.measure import ResultsTable
 from ij.plugin import ChannelSplitter, RoiEnlarger
-from image_tools import read_image, watershedParticles,roiRecolor, pickImage, getCentroidPositions, findNdistances, findInNearestFibers
+from image_tools import read_image, watershedParticles,roiRecolor, pickImage, getCentroidPositions, findNdistances, findInNearestFibers, findInLabelImage
+from roi_utils import R2L, open_rois, rasterize_rois
+from label_utils import labels_at, label_areas, inner_distance_map
+from spatial_index import CentroidGrid
 import os
 from jy_tools import closeAll, attrs
 from ij.gui import Overlay, Roi
@@ -19,7 +22,7 @@ from math import sqrt, pi
 from java.awt import Color
 from collections import OrderedDict, Counter
 
-def find_all_nuclei(dapi_channel, rm_fiber):
+def find_all_nuclei(dapi_channel):
 	imp_temp = dapi_channel.duplicate()
 	imp_temp.title = "{} Temp".format(dapi_channel.title)
 	Prefs.blackBackground = True
@@ -27,19 +30,33 @@ def find_all_nuclei(dapi_channel, rm_fiber):
 	IJ.run(imp_temp, "Convert to Mask", "")
 	IJ.run(imp_temp, "Watershed", "")
 	IJ.run("Set Measurements...", "area centroid redirect=None decimal=3")
-	rm_fiber.close()
 	PA_settings = "size=1.0--Infinity circularity=0-1.00 add"
 	roiArray, rm_nuclei = analyze_particles_get_roi_array(imp_temp, PA_settings)
 	return roiArray, rm_nuclei
 
-def determine_central_nucleation(rm_fiber, rm_nuclei, num_Check = 8, imp=None):
+def determine_central_nucleation(rm_fiber, rm_nuclei, num_Check = 8, imp=None, count_mode="nearest", ref_image=None, fiber_centroids=None, fiber_labels=None):
+	"""
+	Counts the total and central nuclei in each fiber.
+	
+	With count_mode="nearest", each nucleus is checked against its `num_Check` nearest fibers.
+	With count_mode="label", the fibers are rasterized into a label image the size of `ref_image`, and each
+	nucleus is assigned by the label underneath it. No nearest-fiber lists are made, so None is returned in their place.
+	Previously computed fiber centroids can be passed as an (x, y) pair in `fiber_centroids`, and a label image of the fibers
+	as `fiber_labels`, so a stage that needs it elsewhere (e.g. for gradient_nucleation) rasterizes the fibers once.
+	"""
 	nFibers = rm_fiber.getCount()
-	xFib, yFib = getCentroidPositions(rm_fiber)
+	xFib, yFib = getCentroidPositions(rm_fiber) if fiber_centroids is None else fiber_centroids
 	xNuc, yNuc = getCentroidPositions(rm_nuclei)
-	nearestNucleiFibers = findNdistances(xNuc, yNuc, xFib, yFib, nFibers, rm_nuclei, num_Check)
-	count_nuclei = findInNearestFibers(nearestNucleiFibers, rm_fiber, xNuc, yNuc)
+	if count_mode == "label":
+		nearestNucleiFibers = None
+		fiber_labels = R2L(ref_image, rm_fiber.getRoisAsArray()) if fiber_labels is None else fiber_labels
+		count_nuclei = findInLabelImage(fiber_labels, nFibers, xNuc, yNuc)
+	else:
+		fiber_index = CentroidGrid(xFib, yFib) # Built once per image, shared by every nuclei-to-fiber query
+		nearestNucleiFibers = findNdistances(xNuc, yNuc, xFib, yFib, nFibers, rm_nuclei, num_Check, fiber_index=fiber_index)
+		count_nuclei = findInNearestFibers(nearestNucleiFibers, rm_fiber, xNuc, yNuc)
 	all_reduced = []
-	count_central, relative_reduced_area, rm_central = single_erosion(rm_fiber, 0.25, all_reduced, nearestNucleiFibers, xNuc, yNuc, xFib, yFib, imp=imp)
+	count_central, relative_reduced_area, rm_central = single_erosion(rm_fiber, 0.25, all_reduced, nearestNucleiFibers, xNuc, yNuc, xFib, yFib, imp=imp, count_mode=count_mode, ref_image=ref_image)
 	return count_central, count_nuclei, rm_central, xFib, yFib, xNuc, yNuc, nearestNucleiFibers
 
 def determine_number_peripheral(count_central, count_nuclei):
@@ -49,7 +66,7 @@ def determine_number_peripheral(count_central, count_nuclei):
 	return Counter(peripheral_dict)
 
 def analyze_particles_get_roi_array(imp, settings):
-	newRM = RoiManager()
+	newRM = RoiManager(True) # Hidden, so the fiber ROI manager stays open
 	PA.setRoiManager(newRM)
 	IJ.run(imp,"Analyze Particles...", settings)
 	roiArray = newRM.getRoisAsArray()
@@ -63,9 +80,15 @@ def show_rois(imp, roi_array):
 	imp.draw()
 	imp.setOverlay(overlay)
 
-def single_erosion(rm_fiber, percent, all_reduced, nearestNucleiFibers, xNuc, yNuc, xFib, yFib, imp=None):
-	RM_central = RoiManager()
-	rm_central = RM_central.getRoiManager()
+def single_erosion(rm_fiber, percent, all_reduced, nearestNucleiFibers, xNuc, yNuc, xFib, yFib, imp=None, fiber_index=None, num_Check=8, count_mode="nearest", ref_image=None, central_labels=None):
+	"""
+	Erodes every fiber to (1-percent) of its area, and counts the nuclei within each eroded fiber.
+	In label mode, the eroded fibers are rasterized into `central_labels` if given (a label image that is reused between erosions).
+	"""
+	if nearestNucleiFibers is None and count_mode != "label":
+		fiber_index = CentroidGrid(xFib, yFib) if fiber_index is None else fiber_index
+		nearestNucleiFibers = fiber_index.nearest_many(xNuc, yNuc, num_Check)
+	rm_central = RoiManager(True) # Hidden, separate from the fiber ROI manager
 	relative_reduced_area = []
 	for i in range(0, rm_fiber.getCount()):
 		roi = rm_fiber.getRoi(i)
@@ -85,12 +108,25 @@ def single_erosion(rm_fiber, percent, all_reduced, nearestNucleiFibers, xNuc, yN
 	
 	# print(new_roi.getStatistics().area)
 	all_reduced.append(sum(relative_reduced_area)/len(relative_reduced_area))
-	count_central = findInNearestFibers(nearestNucleiFibers, rm_central, xNuc, yNuc, xFib=xFib, yFib=yFib, imp=imp)
+	if count_mode == "label":
+		if central_labels is None:
+			central_labels = R2L(ref_image, rm_central.getRoisAsArray())
+		else:
+			rasterize_rois(rm_central.getRoisAsArray(), central_labels.getWidth(), central_labels.getHeight(), label_ip=central_labels.getProcessor())
+		count_central = findInLabelImage(central_labels, rm_central.getCount(), xNuc, yNuc, xFib=xFib, yFib=yFib, imp=imp)
+	else:
+		count_central = findInNearestFibers(nearestNucleiFibers, rm_central, xNuc, yNuc, xFib=xFib, yFib=yFib, imp=imp)
 	return count_central, relative_reduced_area, rm_central
 
-def repeated_erosion(percReductions, rm_fiber, nearestNucleiFibers, xNuc, yNuc, xFib, yFib):
+def repeated_erosion(percReductions, rm_fiber, nearestNucleiFibers, xNuc, yNuc, xFib, yFib, fiber_index=None, num_Check=8, count_mode="nearest", ref_image=None):
 	num_central = []
 	all_reduced = []
+	if nearestNucleiFibers is None and count_mode != "label":
+		# Resolve the nearest fibers once, rather than once per erosion step
+		fiber_index = CentroidGrid(xFib, yFib) if fiber_index is None else fiber_index
+		nearestNucleiFibers = fiber_index.nearest_many(xNuc, yNuc, num_Check)
+	# Every erosion is rasterized into the same label image, rather than a new one per step
+	central_labels = R2L(ref_image, [], output_bit_depth=16 if rm_fiber.getCount() <= 65535 else 32) if count_mode == "label" else None
 	
 	central_fibers = {}
 	for col_enum, percent in enumerate(percReductions):
@@ -98,10 +134,9 @@ def repeated_erosion(percReductions, rm_fiber, nearestNucleiFibers, xNuc, yNuc,
 	#	model_reduced_area = []
 		
 		if col_enum > 0:
-			rm_central.runCommand("Deselect")
-			rm_central.runCommand("Delete")
+			rm_central.reset()
 		
-		count_central, relative_reduced_area, rm_central = single_erosion(rm_fiber, percent, all_reduced, nearestNucleiFibers, xNuc, yNuc, xFib, yFib, imp=None)
+		count_central, relative_reduced_area, rm_central = single_erosion(rm_fiber, percent, all_reduced, nearestNucleiFibers, xNuc, yNuc, xFib, yFib, imp=None, count_mode=count_mode, ref_image=ref_image, central_labels=central_labels)
 		
 		num_central.append(sum([count_central[count] > 0 for count in count_central]))	
 	
@@ -110,6 +145,53 @@ def repeated_erosion(percReductions, rm_fiber, nearestNucleiFibers, xNuc, yNuc,
 		
 	return(num_central, all_reduced, central_fibers)
 
+def nucleus_depths(label_image, nFibers, xNuc, yNuc):
+	"""
+	Returns the fiber index of each nucleus (None if it lies outside every fiber), and its centrality depth.
+	
+	The depth is the distance from the nucleus to the outline of its fiber, divided by the fiber's equivalent radius sqrt(area/pi).
+	It is 0 at the fiber outline and approaches 1 at the centre of a circular fiber.
+	"""
+	label_ip = label_image.getProcessor()
+	radii = [sqrt(area/pi) for area in label_areas(label_ip, nFibers)]
+	distance_ip = inner_distance_map(label_ip)
+	fiber_indices, depths = [], []
+	for x, y, label in zip(xNuc, yNuc, labels_at(label_ip, xNuc, yNuc)):
+		if label == 0 or label > nFibers or radii[label-1] == 0:
+			fiber_indices.append(None)
+			depths.append(0.0)
+		else:
+			fiber_indices.append(label-1)
+			depths.append((distance_ip.getf(int(x), int(y)) + 0.5)/radii[label-1]) # From the outer edge of the outline
+	return fiber_indices, depths
+
+def gradient_nucleation(percReductions, label_image, nFibers, xNuc, yNuc):
+	"""
+	Distance-transform alternative to `repeated_erosion`, computing the central fibers for every erosion percentage in a single pass.
+	
+	Eroding a fiber of equivalent radius r until it keeps (1-percent) of its area shrinks it by r*(1-sqrt(1-percent)),
+	so a nucleus falls within the eroded fiber when its centrality depth exceeds 1-sqrt(1-percent).
+	Unlike the ROI erosion, the shrink distance is not rounded to whole pixels.
+	
+	Returns the same (num_central, all_reduced, central_fibers) as `repeated_erosion`, where all_reduced
+	holds the modelled remaining area fraction for each percentage.
+	"""
+	fiber_indices, depths = nucleus_depths(label_image, nFibers, xNuc, yNuc)
+	deepest = {}
+	for fiber, depth in zip(fiber_indices, depths):
+		if fiber is not None and depth > deepest.get(fiber, -1):
+			deepest[fiber] = depth
+	
+	num_central = []
+	all_reduced = []
+	central_fibers = {}
+	for percent in percReductions:
+		depth_cutoff = 1-sqrt(1-percent)
+		central_fibers[percent] = sorted([fiber for fiber, depth in deepest.items() if depth > depth_cutoff])
+		num_central.append(len(central_fibers[percent]))
+		all_reduced.append(1-percent)
+	return num_central, all_reduced, central_fibers
+
 def fill_color_rois(central_fibers, percReductions, fiber_rois):
 	# Set differences:
 	for percent in percReductions:
@@ -137,20 +219,20 @@ if __name__ == "__main__":
 	imp = read_image(raw_path)
 	imp.show()
 	
-	rm_fiber = RoiManager()
-	rm_fiber.open(roi_path)
+	rm_fiber = open_rois(roi_path, RoiManager())
 	
 	channels = ChannelSplitter().split(imp)
 	DAPI = channels[0]
 	# unitType = watershedParticles(DAPI.title)
 	
 	# Nuclei determination
-	roiArray, rm_nuclei =find_all_nuclei(DAPI, rm_fiber)
+	roiArray, rm_nuclei =find_all_nuclei(DAPI)
 	num_Check = 8
 	nFibers = rm_fiber.getCount()
 	xFib, yFib = getCentroidPositions(rm_fiber)
 	xNuc, yNuc = getCentroidPositions(rm_nuclei)
-	nearestNucleiFibers = findNdistances(xNuc, yNuc, xFib, yFib, nFibers, rm_nuclei, num_Check)
+	fiber_index = CentroidGrid(xFib, yFib)
+	nearestNucleiFibers = findNdistances(xNuc, yNuc, xFib, yFib, nFibers, rm_nuclei, num_Check, fiber_index=fiber_index)
 	count_nuclei = findInNearestFibers(nearestNucleiFibers, rm_fiber, xNuc, yNuc)
 	
 	percReductions = [float(a)/10 for a in range(0, 10, 1)]
@@ -158,8 +240,7 @@ if __name__ == "__main__":
 	
 	rm_fiber.close()
 	# rm_central.close()
-	rm_fiber = RoiManager()
-	rm_fiber.open(roi_path)
+	rm_fiber = open_rois(roi_path, RoiManager())
 	fill_color_rois(central_fibers, percReductions, rm_fiber)
 
 #options = PA.SHOW_ROI_MASKS \
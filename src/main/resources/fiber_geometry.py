@@ -0,0 +1,45 @@
+from ij.gui import Roi
+from fiber_morphology import polygon_moments
+
+class FiberGeometry:
+	"""
+	Centroids, areas, second moments and bounding boxes of a set of fiber ROIs, computed once and shared between analysis stages.
+
+	All values are in pixels. A geometry is tied to the exact ROI objects it was computed from, see `matches`.
+	"""
+
+	def __init__(self, rois):
+		self.rois = list(rois)
+		self.n_fibers = len(self.rois)
+		self.areas, self.x, self.y = [], [], []
+		self.moments, self.bounds = [], []
+		for roi in self.rois:
+			if roi.getType() == Roi.COMPOSITE:
+				stats = roi.getStatistics()
+				area, cx, cy, moments = stats.pixelCount, stats.xCentroid, stats.yCentroid, None
+			else:
+				polygon = roi.getFloatPolygon()
+				area, cx, cy, mu20, mu02, mu11 = polygon_moments(polygon.xpoints[:polygon.npoints], polygon.ypoints[:polygon.npoints])
+				moments = (mu20, mu02, mu11)
+			bounds = roi.getBounds()
+			self.areas.append(area)
+			self.x.append(cx)
+			self.y.append(cy)
+			self.moments.append(moments)
+			self.bounds.append((bounds.x, bounds.y, bounds.width, bounds.height))
+
+	def matches(self, rois):
+		"""
+		Checks whether this geometry was computed from exactly these ROI objects, in this order.
+		Editing an ROI in the ROI manager replaces its object, so edited or filtered ROI sets never match.
+		"""
+		if len(rois) != self.n_fibers:
+			return False
+		return all(roi is cached for roi, cached in zip(rois, self.rois)) # Roi.equals compares bounds and lengths, not identity
+
+	def get_centroids(self):
+		return self.x, self.y
+
+	def get_scaled_areas(self, scale):
+		"""Returns the fiber areas, calibrated by `scale` (microns per pixel)"""
+		return [area*scale*scale for area in self.areas]
@@ -1,24 +1,98 @@
 from ij import IJ
-from ij.measure import ResultsTable
-from image_tools import getCentroidPositions
-from jy_tools import test_Results
+from ij.gui import Roi
+from array import array
+from collections import OrderedDict
+from math import sqrt, pi
 
-def estimate_fiber_morphology(fiber_border, scale, rm_fiber):
-	# fiber_border.show()
+MORPHOLOGY_COLUMNS = ["Area", "X", "Y", "Perim.", "Feret", "MinFeret", "FeretAngle", "Circ.", "AR", "Solidity"]
+
+def polygon_moments(xs, ys):
+	"""
+	Returns the area, centroid and central second moments (mu20, mu02, mu11) of a closed polygon, using Green's theorem.
+
+	For traced ROIs, whose vertices lie on pixel corners, these match the moments of the pixels inside the outline.
+	"""
+	a = cx = cy = sxx = syy = sxy = 0.0
+	n = len(xs)
+	for i in range(n):
+		x0, y0 = xs[i-1], ys[i-1]
+		x1, y1 = xs[i], ys[i]
+		cross = x0*y1 - x1*y0
+		a += cross
+		cx += (x0 + x1)*cross
+		cy += (y0 + y1)*cross
+		sxx += (x0*x0 + x0*x1 + x1*x1)*cross
+		syy += (y0*y0 + y0*y1 + y1*y1)*cross
+		sxy += (x0*y1 + 2*x0*y0 + 2*x1*y1 + x1*y0)*cross
+	if a == 0:
+		return 0.0, (xs[0] if n else 0.0), (ys[0] if n else 0.0), 0.0, 0.0, 0.0
+	area = a/2.0
+	cx, cy = cx/(6.0*area), cy/(6.0*area)
+	mu20 = sxx/(12.0*area) - cx*cx
+	mu02 = syy/(12.0*area) - cy*cy
+	mu11 = sxy/(24.0*area) - cx*cy
+	return abs(area), cx, cy, mu20, mu02, mu11
+
+def ellipse_axes(mu20, mu02, mu11):
+	"""Returns the (major, minor) eigenvalues of the second moment matrix, proportional to the squared ellipse axes"""
+	spread = sqrt(((mu20 - mu02)/2.0)**2 + mu11**2)
+	return (mu20 + mu02)/2.0 + spread, (mu20 + mu02)/2.0 - spread
+
+def polygon_area(polygon):
+	xs, ys = polygon.xpoints, polygon.ypoints
+	n = polygon.npoints
+	return abs(sum(xs[i-1]*ys[i] - xs[i]*ys[i-1] for i in range(n)))/2.0
+
+def measure_fiber_morphology(rois, scale=1.0, geometry=None):
+	"""
+	Measures the morphology of every fiber ROI directly from its outline, without the ROI manager or a ResultsTable.
+
+	Returns an OrderedDict of MORPHOLOGY_COLUMNS, each a column of doubles with one value per ROI.
+	Area, Perim., Feret and MinFeret are calibrated by `scale` (microns per pixel); X and Y are left in pixels.
+	Areas, centroids and moments are reused from `geometry` (a `fiber_geometry.FiberGeometry`) when it matches the ROIs.
+	"""
+	columns = OrderedDict((column, array('d')) for column in MORPHOLOGY_COLUMNS)
+	if geometry is not None and not geometry.matches(rois):
+		geometry = None
+	for enum, roi in enumerate(rois):
+		if geometry is not None and geometry.moments[enum] is not None:
+			area, cx, cy = geometry.areas[enum], geometry.x[enum], geometry.y[enum]
+			major, minor = ellipse_axes(*geometry.moments[enum])
+		elif roi.getType() == Roi.COMPOSITE:
+			stats = roi.getStatistics() # Outlines with holes can't be measured from a single polygon
+			area, cx, cy = stats.pixelCount, stats.xCentroid, stats.yCentroid
+			major, minor = stats.major, stats.minor
+		else:
+			polygon = roi.getFloatPolygon()
+			area, cx, cy, mu20, mu02, mu11 = polygon_moments(polygon.xpoints[:polygon.npoints], polygon.ypoints[:polygon.npoints])
+			major, minor = ellipse_axes(mu20, mu02, mu11)
+		perimeter = roi.getLength()
+		feret_values = roi.getFeretValues()
+		hull_area = polygon_area(roi.getFloatConvexHull())
+
+		columns["Area"].append(area*scale*scale)
+		columns["X"].append(cx)
+		columns["Y"].append(cy)
+		columns["Perim."].append(perimeter*scale)
+		columns["Feret"].append(feret_values[0]*scale)
+		columns["MinFeret"].append(feret_values[2]*scale)
+		columns["FeretAngle"].append(feret_values[1])
+		columns["Circ."].append(min(4*pi*area/(perimeter*perimeter), 1.0) if perimeter > 0 else 0.0)
+		columns["AR"].append(sqrt(major/minor) if minor > 0 else 0.0)
+		columns["Solidity"].append(area/hull_area if hull_area > 0 else float("nan"))
+	return columns
+
+def estimate_fiber_morphology(fiber_border, scale, fibers, rois=None, geometry=None):
+	"""
+	Measures the fibers of a FiberTable, and records their calibrated area (as "Area_um2", since the table's "Area" stays
+	in pixels for filtering) and MinFeret as columns of the table.
+
+	The ROIs the table is shown as (e.g. in the fiber ROI manager) can be passed as `rois`, otherwise they are made from the table.
+	Returns the fiber labels (image title and fiber name), areas and minimum Feret diameters.
+	"""
 	IJ.run(fiber_border, "Set Scale...", "distance=1 known={} unit=micron".format(scale))
-	IJ.run("Set Measurements...", "area feret's centroid display redirect=None decimal=3")
-	rt = ResultsTable().getResultsTable()
-	rm_fiber.runCommand(fiber_border, "Measure")
-	fiber_labels = rt.getColumnAsStrings("Label")
-	area_results = rt.getColumn("Area")
-	minferet_results = rt.getColumn("MinFeret")
-
-	nFibers = rm_fiber.getCount()
-	xFib, yFib = getCentroidPositions(rm_fiber)
-	for i in range(0, rm_fiber.getCount()):
-		xFiberLocation = int(round(xFib[i]))
-		yFiberLocation = int(round(yFib[i]))
-		rm_fiber.rename(i, str(i+1)+'_x' + str(xFiberLocation) + '-' + 'y' + str(yFiberLocation))
-	test_Results(xFib, yFib, scale)
-	IJ.run("Clear Results", "") 
+	morphology = measure_fiber_morphology(fibers.to_rois() if rois is None else rois, scale, geometry=geometry)
+	fiber_labels = ["{}:{}".format(fiber_border.title, name) for name in fibers.names]
+	area_results = fibers.set_column("Area_um2", morphology["Area"])
+	minferet_results = fibers.set_column("MinFeret", morphology["MinFeret"])
 	return fiber_labels, area_results, minferet_results
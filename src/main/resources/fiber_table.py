@@ -0,0 +1,165 @@
+from ij import IJ
+from ij.gui import Roi, PolygonRoi
+from ij.process import FloatPolygon
+from ij.plugin.frame import RoiManager
+from array import array
+from collections import OrderedDict
+from fiber_geometry import FiberGeometry
+
+FIBER_ID_PROPERTY = "fiber_id"
+
+def assign_fiber_ids(rois):
+	"""
+	Returns the fiber ID of each ROI: the one stored on it, or the next unused ID for ROIs without one.
+	"""
+	stored_ids = [roi.getProperty(FIBER_ID_PROPERTY) for roi in rois]
+	next_id = max([int(fiber_id) for fiber_id in stored_ids if fiber_id] or [0]) + 1
+	fiber_ids = []
+	for stored_id in stored_ids:
+		if stored_id:
+			fiber_ids.append(int(stored_id))
+		else:
+			fiber_ids.append(next_id)
+			next_id += 1
+	return fiber_ids
+
+class FiberTable:
+	"""
+	Columnar record of the fibers in an image.
+
+	Outlines are packed into flat coordinate arrays (fiber i spans offsets[i]:offsets[i+1]), and per-fiber
+	attributes are kept as columns, so no ROI objects need to stay alive. Every fiber has a stable ID that
+	survives filtering, and is stored on its ROI as the "fiber_id" property when the table is viewed as ROIs.
+	Outlines with holes (composite ROIs) can't be packed into one polygon, so they are kept as ROIs.
+	"""
+
+	def __init__(self):
+		self.ids = array('i')
+		self.offsets = array('i', [0])
+		self.xs = array('f')
+		self.ys = array('f')
+		self.roi_types = array('i')
+		self.names = []
+		self.composites = {} # index -> ROI
+		self.columns = OrderedDict()
+
+	@classmethod
+	def from_rois(cls, rois, geometry=None):
+		"""
+		Packs ROIs into a table, with Area, X and Y columns (in pixels) from their geometry.
+		Area stays in pixels, as filters like remove_small_fibers calibrate it themselves.
+		"""
+		rois = list(rois)
+		geometry = FiberGeometry(rois) if geometry is None or not geometry.matches(rois) else geometry
+		table = cls()
+		for roi, fiber_id in zip(rois, assign_fiber_ids(rois)):
+			table.add_roi(roi, fiber_id)
+		table.columns["Area"] = array('d', geometry.areas)
+		table.columns["X"] = array('d', geometry.x)
+		table.columns["Y"] = array('d', geometry.y)
+		return table
+
+	@classmethod
+	def from_roi_manager(cls, rm, geometry=None):
+		return cls.from_rois(rm.getRoisAsArray(), geometry)
+
+	def __len__(self):
+		return len(self.ids)
+
+	def add_roi(self, roi, fiber_id):
+		index = len(self.ids)
+		self.ids.append(fiber_id)
+		self.names.append(roi.getName())
+		self.roi_types.append(roi.getType())
+		if roi.getType() == Roi.COMPOSITE:
+			self.composites[index] = roi
+		else:
+			polygon = roi.getFloatPolygon()
+			self.xs.extend(polygon.xpoints[:polygon.npoints])
+			self.ys.extend(polygon.ypoints[:polygon.npoints])
+		self.offsets.append(len(self.xs))
+		return index
+
+	def get_outline(self, index):
+		"""Returns the x and y coordinates of a fiber's outline"""
+		start, end = self.offsets[index], self.offsets[index+1]
+		return self.xs[start:end], self.ys[start:end]
+
+	def to_roi(self, index):
+		"""
+		Creates the ROI of a fiber, named as it was originally and tagged with its fiber ID.
+		"""
+		if index in self.composites:
+			roi = self.composites[index].clone()
+		else:
+			xs, ys = self.get_outline(index)
+			roi_type = self.roi_types[index] if self.roi_types[index] in (Roi.POLYGON, Roi.FREEROI, Roi.TRACED_ROI) else Roi.POLYGON
+			roi = PolygonRoi(FloatPolygon(xs, ys), roi_type)
+		roi.setName(self.names[index])
+		roi.setProperty(FIBER_ID_PROPERTY, str(self.ids[index]))
+		return roi
+
+	def to_rois(self):
+		return [self.to_roi(index) for index in range(len(self))]
+
+	def to_roi_manager(self, rm=None):
+		"""
+		Shows the fibers in a ROI manager (the shared one unless given), replacing its contents. The manager is
+		only a view; edits to it are picked up by rebuilding the table with `from_roi_manager`.
+		"""
+		rm = RoiManager().getRoiManager() if rm is None else rm
+		rm.reset()
+		for roi in self.to_rois():
+			rm.addRoi(roi)
+		return rm
+
+	def index_of(self, fiber_id):
+		return list(self.ids).index(fiber_id)
+
+	def get_column(self, name):
+		return self.columns[name]
+
+	def set_column(self, name, values):
+		"""
+		Sets a per-fiber attribute. Numbers are stored as doubles, anything else (e.g. fiber types) as a list.
+		"""
+		values = list(values)
+		if len(values) != len(self):
+			raise ValueError("Column {} has {} values, but there are {} fibers".format(name, len(values), len(self)))
+		numeric = all(isinstance(value, (int, long, float)) and not isinstance(value, bool) for value in values)
+		self.columns[name] = array('d', values) if numeric else values
+		return self.columns[name]
+
+	def filter(self, keep):
+		"""
+		Returns a new table with only the fibers where `keep` is true, keeping their IDs and attributes.
+		`keep` is a sequence of booleans, one per fiber, or a function of the fiber index.
+		"""
+		keep = [keep(index) for index in range(len(self))] if callable(keep) else list(keep)
+		table = FiberTable()
+		kept = [index for index in range(len(self)) if keep[index]]
+		for index in kept:
+			new_index = len(table.ids)
+			table.ids.append(self.ids[index])
+			table.names.append(self.names[index])
+			table.roi_types.append(self.roi_types[index])
+			if index in self.composites:
+				table.composites[new_index] = self.composites[index]
+			start, end = self.offsets[index], self.offsets[index+1]
+			table.xs.extend(self.xs[start:end])
+			table.ys.extend(self.ys[start:end])
+			table.offsets.append(len(table.xs))
+		for name, values in self.columns.items():
+			filtered = [values[index] for index in kept]
+			table.columns[name] = array(values.typecode, filtered) if isinstance(values, array) else filtered
+		return table
+
+def remove_small_fibers(fibers, minimum_area, scale=1.0):
+	"""
+	Returns the fibers with a calibrated area above `minimum_area`, measured from the table's Area column.
+	"""
+	IJ.log("### Removing small ROIs with area below {} ###".format(minimum_area))
+	IJ.log("Original: {} ROIs".format(len(fibers)))
+	large_fibers = fibers.filter([area*scale*scale > minimum_area for area in fibers.get_column("Area")])
+	IJ.log("Removed {} ROIs".format(len(fibers)-len(large_fibers)))
+	return large_fibers
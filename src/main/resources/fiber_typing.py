@@ -54,7 +54,7 @@ for raw_image_name, fiber_roi_name in matched_files:
 	if remove_small_fibers:
 		# Assumption is that the image does not have scale data
 		min_fiber_size = 10
-		analysis.rm_fiber = remove_small_rois(analysis.rm_fiber, analysis.imp, min_fiber_size)
+		analysis.rm_fiber = remove_small_rois(analysis.rm_fiber, analysis.border_channel, min_fiber_size)
 		# IJ.run(analysis.imp, "Set Scale...", "distance={} known=1 unit=micron".format(analysis.imp_scale));
 	
 	if remove_fibers_outside_border:
@@ -64,7 +64,7 @@ for raw_image_name, fiber_roi_name in matched_files:
 	#		rm_fiber = remove_fibers_outside_border(rm_fiber)
 	
 	if analysis.Morph:
-		results_dict["Label"], results_dict["Area"], results_dict["MinFeret"] = estimate_fiber_morphology(analysis.border_channel, analysis.imp_scale, analysis.rm_fiber)
+		results_dict["Label"], results_dict["Area"], results_dict["MinFeret"] = estimate_fiber_morphology(analysis.border_channel, analysis.imp_scale, analysis.get_fiber_table(), rois=analysis.rm_fiber.getRoisAsArray())
 	
 	if analysis.FT:
 		area_frac = OrderedDict()
@@ -13,7 +13,12 @@ class FileNamer:
 		"morph": "_morphology.jpeg",
 		"cn_cutoff": "_central_nucleation.jpeg",
 		"cn_gradient": "_gradient_nucleation.jpeg",
-		"ft_comp": "_fiber_typing.jpeg"
+		"ft_comp": "_fiber_typing.jpeg",
+		"profile_json": "_profile.json",
+		"profile_csv": "_profile.csv",
+		"analysed_rois": "_analysed_RoiSet.zip",
+		"analysed_config": "_analysed_config.json",
+		"threshold_sweep": "_threshold_sweep.csv"
 		# more can be added as necessary
 	}
 	
@@ -29,7 +34,12 @@ class FileNamer:
 		"morph": "figures",
 		"cn_cutoff": "figures",
 		"cn_gradient": "figures",
-		"ft_comp": "figures"
+		"ft_comp": "figures",
+		"profile_json": "results",
+		"profile_csv": "results",
+		"analysed_rois": "results",
+		"analysed_config": "results",
+		"threshold_sweep": "results"
 		# more can be added as necessary
 	}
 	
@@ -59,6 +69,11 @@ class FileNamer:
 		self.figures_path = self.get_path("figures")
 		self.masks_path = self.get_path("masks")
 		self.excluded_border_fiber_rois_path = self.get_path("border_exclusion")
+		self.profile_json_path = self.get_path("profile_json")
+		self.profile_csv_path = self.get_path("profile_csv")
+		self.analysed_rois_path = self.get_path("analysed_rois")
+		self.analysed_config_path = self.get_path("analysed_config")
+		self.threshold_sweep_path = self.get_path("threshold_sweep")
 	
 	def create_directory(self, directory):
 		if directory not in self.DIRECTORIES:
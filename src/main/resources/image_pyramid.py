@@ -0,0 +1,95 @@
+from ij import IJ
+from ij.plugin import RoiScaler
+from loci.formats import ImageReader
+from loci.plugins import BF
+from loci.plugins.in import ImporterOptions
+from collections import namedtuple
+
+# series is the Bio-Formats importer's (flattened) series index of the level, downsample its size relative to level 0
+PyramidLevel = namedtuple("PyramidLevel", ["index", "series", "width", "height", "downsample"])
+
+class ImagePyramid:
+	"""
+	The resolution levels of an image file, from full resolution (level 0) down to the smallest thumbnail.
+
+	Levels are the sub-resolutions of the first series (pyramidal CZI, OME-TIFF, NDPI, SVS...), or for readers that
+	store the pyramid as separate series, the following series with the same channels and aspect ratio.
+	Images without a pyramid have a single level. Only the file metadata is read until a level is opened.
+	"""
+
+	def __init__(self, file_path):
+		self.file_path = file_path
+		self.levels = self.find_levels()
+
+	def find_levels(self):
+		reader = ImageReader()
+		reader.setFlattenedResolutions(False)
+		reader.setId(self.file_path)
+		try:
+			reader.setSeries(0)
+			width, height, n_channels = reader.getSizeX(), reader.getSizeY(), reader.getSizeC()
+			sizes = []
+			if reader.getResolutionCount() > 1:
+				for resolution in range(reader.getResolutionCount()):
+					reader.setResolution(resolution)
+					sizes.append((resolution, reader.getSizeX(), reader.getSizeY()))
+			else:
+				sizes.append((0, width, height))
+				for series in range(1, reader.getSeriesCount()):
+					reader.setSeries(series)
+					same_aspect = abs(float(reader.getSizeX())/reader.getSizeY() - float(width)/height) < 0.01*width/height
+					if reader.getSizeC() == n_channels and same_aspect and reader.getSizeX() < sizes[-1][1]:
+						sizes.append((series, reader.getSizeX(), reader.getSizeY()))
+		finally:
+			reader.close()
+		return [PyramidLevel(enum, series, level_width, level_height, float(width)/level_width) \
+		for enum, (series, level_width, level_height) in enumerate(sizes)]
+
+	def __len__(self):
+		return len(self.levels)
+
+	def level_for_downsample(self, downsample):
+		"""Returns the coarsest level that is downsampled by no more than `downsample`"""
+		return [level for level in self.levels if level.downsample <= downsample*1.01][-1]
+
+	def level_for_diameter(self, diameter, min_diameter=30):
+		"""
+		Returns the coarsest level where fibers of `diameter` full-resolution pixels are still at least `min_diameter` pixels wide.
+		An unknown diameter (0) keeps the full resolution.
+		"""
+		if not diameter:
+			return self.levels[0]
+		return self.level_for_downsample(max(1.0, float(diameter)/min_diameter))
+
+	def open_level(self, level=0, calibration=None):
+		"""
+		Opens one level of the pyramid as an ImagePlus, calibrated so that measurements match the full resolution image.
+		`calibration` (e.g. of the full resolution image) is used when the file has no pixel size for the level.
+		"""
+		level = self.levels[level] if isinstance(level, int) else level
+		options = ImporterOptions()
+		options.setId(self.file_path)
+		options.setQuiet(True)
+		options.setSeriesOn(0, False)
+		options.setSeriesOn(level.series, True)
+		imp = BF.openImagePlus(options)[0]
+		IJ.log("Opened pyramid level {} of {}: {}x{} pixels, downsampled {:.2f}x".format(level.index, imp.getTitle(), level.width, level.height, level.downsample))
+		if calibration is not None and level.downsample > 1:
+			level_calibration = calibration.copy()
+			level_calibration.pixelWidth = calibration.pixelWidth*level.downsample
+			level_calibration.pixelHeight = calibration.pixelHeight*level.downsample
+			imp.setCalibration(level_calibration)
+		return imp
+
+def scale_rois(rois, factor):
+	"""
+	Scales ROIs from one pyramid level to another, e.g. by a level's downsample to map them back to full resolution.
+	"""
+	if factor == 1:
+		return list(rois)
+	scaled_rois = []
+	for roi in rois:
+		scaled_roi = RoiScaler.scale(roi, factor, factor, False)
+		scaled_roi.setName(roi.getName())
+		scaled_rois.append(scaled_roi)
+	return scaled_rois
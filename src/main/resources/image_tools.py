@@ -16,6 +16,10 @@ from java.io import File
 from utilities import download_model
 from loci.formats import ChannelSeparator
 from time import sleep
+from spatial_index import CentroidGrid
+from label_utils import labels_at
+from image_pyramid import ImagePyramid
+from results_store import ResultsStore
 
 class CZIopener:
 	def __init__(self, file_path):
@@ -193,46 +197,12 @@ def batch_open_images(path, file_type=[".tif", ".nd2", ".png"], name_filter=None
 
 	return path_to_images
 
-def make_results(results_dict, Morph=False, CN=False, FT=False):
-	""" Takes an Dictionary, and adds to ResultsTable in that order """
-	IJ.run("Clear Results")
-	rt = ResultsTable.getResultsTable()
-	label_column = rt.getFreeColumn("Label")
-
-	for enum, label in enumerate(results_dict["Label"]):
-		rt.setValue(label_column, enum, label)
-		
-	if Morph:
-		IJ.log("Recording Morphologies")
-		rt.setValues("Area", results_dict["Area"])
-		rt.setValues("MinFeret", results_dict["MinFeret"])
-		
-	if CN:
-		IJ.log("Recording Nucleation")
-		rt.setValues("Central Nuclei", results_dict["Central Nuclei"])
-		rt.setValues("Peripheral Nuclei", results_dict["Peripheral Nuclei"])
-		rt.setValues("Total Nuclei", results_dict["Total Nuclei"])
-	
-	if FT:
-		IJ.log("Recording Fiber Types")
-		if results_dict.get("Type I_%-Area") is not None:
-			rt.setValues("Type I_%-Area", results_dict["Type I_%-Area"])
-
-		if results_dict.get("Type IIa_%-Area") is not None:
-			rt.setValues("Type IIa_%-Area", results_dict["Type IIa_%-Area"])
-
-		if results_dict.get("Type IIx_%-Area") is not None:
-			rt.setValues("Type IIx_%-Area", results_dict["Type IIx_%-Area"])
-
-		if results_dict.get("Type IIb_%-Area") is not None:
-			rt.setValues("Type IIb_%-Area", results_dict["Type IIb_%-Area"])
-
-		for enum, ft_label in enumerate(results_dict["Fiber_Type"]):
-			ft_column = rt.getFreeColumn("Label")
-			rt.setValue("Fiber_Type", enum, ft_label)
-
+def make_results(results_dict, Morph=False, CN=False, FT=False, show=True):
+	""" Fills the shared ResultsTable from a results dictionary, for scripts that save the Results window. The table is only displayed if show is True """
+	rt = ResultsStore.from_results_dict(results_dict, Morph, CN, FT).to_results_table(ResultsTable.getResultsTable())
 	rt.updateResults()
-	rt.show("Results")
+	if show:
+		rt.show("Results")
 	return(rt)
 
 def split_string(input_string):
@@ -253,21 +223,16 @@ def split_string(input_string):
 #	return imp
 	
 def loadMicroscopeImage(image_path, slicenum = 2):
-	''' Loads a microscope image from a path, and allows you to specify a specific slice '''
+	''' Loads a microscope image from a path, and allows you to specify a pyramid level (clamped to the levels in the file) '''
 	print "\n### Loading Images ###"
 	print "Image Directory =", image_path
 	
-	czi=CZIopener(image_path)
-	
-	if ((image_path.endswith('.czi')) and (len(czi.series_names) > 1)):
-		print('Image has multiple series, opening one')
-		czi.openSlice(slicenum)
-		image_magnification = czi.slice_mag
-		imp = IJ.getImage()
+	pyramid = ImagePyramid(image_path)
+	if len(pyramid) > 1:
+		print('Image has multiple resolutions, opening one')
+		imp = pyramid.open_level(min(slicenum, len(pyramid)-1))
 	else:
-		args = "open='{}' autoscale color_mode=Default display_rois rois_import=[ROI manager] view=Hyperstack stack_order=XYCZT".format(image_path)
-		IJ.run("Bio-Formats Importer", args)
-		imp = IJ.getImage()
+		imp = read_image(image_path)
 	return imp
 
 def ResegmentImage():
@@ -514,14 +479,15 @@ def getCentroidPositions(rm):
 	return (x, y)
 
 
-def findNdistances(x, y, xFib, yFib, nFibers, rm, nCheck):
+def findNdistances(x, y, xFib, yFib, nFibers, rm, nCheck, fiber_index=None):
+	'''Finds the nCheck nearest fibers to each marker position.
+	Queries a spatial index over the fiber centroids, which can be shared between calls by passing `fiber_index`.'''
+	if fiber_index is None:
+		fiber_index = CentroidGrid(xFib[:nFibers], yFib[:nFibers])
 	nearestFibers = {}
 	nSignal = rm.getCount()
 	for loc in range(nSignal):
-		# fiber_distances is a list
-		fiber_distances = calculateDist(x[loc], y[loc], xFib, yFib, nFibers)
-		min_indices = findmin(fiber_distances, nCheck)
-		nearestFibers[loc] = min_indices
+		nearestFibers[loc] = fiber_index.nearest(x[loc], y[loc], nCheck)
 		txt = "nuclei"
 		if (loc % 500 == 1):
 			IJ.showStatus("Calculating {} centroids".format(txt))
@@ -585,6 +551,23 @@ def findInNearestFibers(nearestFibers, rm, xCenter, yCenter, imp=None, xFib=None
 	print countMarker.most_common()
 	return countMarker
 
+def findInLabelImage(label_image, nFibers, xCenter, yCenter, imp=None, xFib=None, yFib=None):
+	'''Finds the number of markers in each muscle fiber, using a label image of the fibers.
+	Each marker is assigned to the fiber whose label lies underneath its centroid, so every fiber is checked, not just the nearest few.
+	Parameters:
+	`label_image` is an image where pixels belonging to the fiber at index i hold the value i+1 (see `roi_utils.R2L`)
+	`nFibers` is the number of fibers that were rasterized into the label image
+	`xCenter` and `yCenter` are the matched-list of coordinates for the centroid of each marker'''
+	countMarker = Counter()
+	countMarker.update({x:0 for x in range(0, nFibers)})
+	label_ip = label_image.getProcessor()
+	for loc, label in enumerate(labels_at(label_ip, xCenter, yCenter)):
+		if label > 0:
+			countMarker[label-1]+=1
+			if imp is not None:
+				drawCatch(xCenter[loc], yCenter[loc], xFib[label-1], yFib[label-1], imp)
+	return countMarker
+
 def watershedParticles(image_title):
 	imp = pickImage(image_title)
 	imp_temp = imp.duplicate()
@@ -665,18 +648,22 @@ def read_image(file_path):
 		print(e)
 		return None
 
-def remove_small_rois(rm, imp, minimum_area=1500):
-	'''Automatically removes ROIs that are too small'''
+def remove_small_rois(rm, imp, minimum_area=1500, areas=None):
+	'''Automatically removes ROIs that are too small.
+	Areas are measured through the ROI manager, unless already-calibrated `areas` are provided'''
 	
 	IJ.log("### Removing small ROIs with area below {} ###".format(minimum_area))
 	
-	IJ.run("Set Measurements...", "area add redirect=None decimal=3");
-	rm.runCommand(imp, "Measure")
-	rm.runCommand(imp, "Show None")
 	n_before = rm.getCount()
 	IJ.log("Original: {} ROIs".format(n_before))
-	rt = ResultsTable().getResultsTable()
-	Areas = rt.getColumn("Area")
+	if areas is None:
+		IJ.run("Set Measurements...", "area add redirect=None decimal=3");
+		rm.runCommand(imp, "Measure")
+		rm.runCommand(imp, "Show None")
+		rt = ResultsTable().getResultsTable()
+		Areas = rt.getColumn("Area")
+	else:
+		Areas = areas
 	large_rois = []
 	for enum, area in enumerate(Areas):
 		if area > minimum_area:
@@ -0,0 +1,177 @@
+from ij import IJ
+from ij.gui import Roi
+from collections import OrderedDict, namedtuple
+from hashlib import md5
+import os, csv, json
+from roi_utils import read_rois, write_rois
+from utilities import read_csv_rows
+from results_store import format_value
+from fiber_table import FIBER_ID_PROPERTY, assign_fiber_ids
+from stage_cache import rois_key
+
+# Bumped whenever the measurements change, so results of an older version are analysed again rather than updated
+SNAPSHOT_VERSION = 1
+
+# Settings that don't change any measurement, so results made with different values can still be updated
+IGNORED_SETTINGS = ["incremental", "create_figures", "save_profile", "overwrite_rois", "run_cellpose", "segmentation_cache", "stage_cache", "segmentation_level"]
+
+# unchanged and modified are (previous index, current index) pairs, added current indices, removed previous indices
+RoiDiff = namedtuple("RoiDiff", ["unchanged", "modified", "added", "removed", "ids"])
+
+def geometry_hash(roi):
+	"""Hashes a ROI's type and outline (to a thousandth of a pixel), so any edit to it changes the hash"""
+	polygon = roi.getFloatPolygon()
+	digest = md5(str(roi.getType()))
+	digest.update(",".join("{:.3f}".format(value) for value in list(polygon.xpoints[:polygon.npoints]) + list(polygon.ypoints[:polygon.npoints])))
+	if roi.getType() == Roi.COMPOSITE: # Holes don't show in the outline
+		digest.update(str(roi.getStatistics().area))
+	return digest.hexdigest()
+
+def diff_fibers(previous_rois, fibers):
+	"""
+	Compares the fibers of a previous analysis (ROIs tagged with their fiber ID) with the current FiberTable.
+
+	Fibers with an identical outline are unchanged, even if they lost their ID (e.g. ROIs edited outside FiberSight).
+	Otherwise fibers with the same ID are modified, and the rest are added or removed.
+	The returned ids are the stable ID of each current fiber: the previous ID where matched, a new one when added.
+	"""
+	previous_ids = [int(roi.getProperty(FIBER_ID_PROPERTY) or 0) for roi in previous_rois]
+	current_rois = fibers.to_rois()
+	unmatched = OrderedDict()
+	for index, roi in enumerate(previous_rois):
+		unmatched.setdefault(geometry_hash(roi), []).append(index)
+
+	unchanged, modified, added = [], [], []
+	remaining = []
+	for index, roi in enumerate(current_rois):
+		matches = unmatched.get(geometry_hash(roi))
+		if matches:
+			same_id = [match for match in matches if previous_ids[match] == fibers.ids[index]]
+			match = same_id[0] if same_id else matches[0]
+			matches.remove(match)
+			unchanged.append((match, index))
+		else:
+			remaining.append(index)
+
+	unmatched_ids = dict((previous_ids[index], index) for indices in unmatched.values() for index in indices)
+	for index in remaining:
+		if fibers.ids[index] in unmatched_ids:
+			modified.append((unmatched_ids.pop(fibers.ids[index]), index))
+		else:
+			added.append(index)
+	removed = sorted(unmatched_ids.values())
+
+	ids = [0]*len(current_rois)
+	for previous_index, index in unchanged + modified:
+		ids[index] = previous_ids[previous_index]
+	next_id = max(previous_ids + list(fibers.ids) + [0]) + 1
+	for index in added:
+		ids[index], next_id = next_id, next_id + 1
+	return RoiDiff(unchanged, sorted(modified, key=lambda pair: pair[1]), added, removed, ids)
+
+def changed_indices(diff):
+	"""The current indices of the fibers to measure again, in order"""
+	return sorted([index for _, index in diff.modified] + diff.added)
+
+def analysis_settings(analysis, config):
+	"""
+	The settings a previous analysis must share to be updated: the configuration, the channel assignment, the manual border
+	(fiber-type channels are cleared outside it before thresholding), the size and modification time of the image, and the snapshot version.
+	"""
+	namer = analysis.namer
+	settings = dict((key, value) for key, value in config.items() if key not in IGNORED_SETTINGS)
+	settings["channels"] = list(analysis.all_channels)
+	settings["border"] = rois_key([analysis.drawn_border_roi])
+	settings["image_file"] = [os.path.getsize(namer.image_path), int(os.path.getmtime(namer.image_path))]
+	settings["snapshot_version"] = SNAPSHOT_VERSION
+	return settings
+
+def tag_fiber_rois(roi_path, stable_ids):
+	"""
+	Stores stable fiber IDs on the ROIs of a fiber ROI file, so that they survive editing the file in the ROI editor.
+	`stable_ids` maps the ID each ROI is given when the file is read into a FiberTable (see assign_fiber_ids) to its stable ID.
+	ROIs that weren't analysed (e.g. small fibers) keep their ID unless an analysed fiber took it.
+	The file is only rewritten if an ID changed; returns whether it was.
+	"""
+	rois = read_rois(roi_path)
+	fiber_ids = assign_fiber_ids(rois)
+	used_ids = set(stable_ids.values())
+	next_id = max(list(used_ids) + fiber_ids + [0]) + 1
+	changed = False
+	for roi, fiber_id in zip(rois, fiber_ids):
+		if fiber_id in stable_ids:
+			stable_id = stable_ids[fiber_id]
+		elif fiber_id in used_ids:
+			stable_id, next_id = next_id, next_id + 1
+		else:
+			stable_id = fiber_id
+		if roi.getProperty(FIBER_ID_PROPERTY) != str(stable_id):
+			roi.setProperty(FIBER_ID_PROPERTY, str(stable_id))
+			changed = True
+	if changed:
+		write_rois(rois, roi_path)
+	return changed
+
+def save_snapshot(analysis, fibers, config, ids=None):
+	"""
+	Records the fibers (tagged with their IDs, in the order of the results rows) and the settings of an analysis,
+	so later runs can update its results instead of starting over. `ids` replaces the table's fiber IDs (see diff_fibers).
+	The IDs are also stored in the ROI file the fibers were loaded from, which is the one the ROI editor opens.
+	"""
+	namer = analysis.namer
+	namer.create_directory("results")
+	ids = list(fibers.ids) if ids is None else ids
+	rois = fibers.to_rois()
+	for roi, fiber_id in zip(rois, ids):
+		roi.setProperty(FIBER_ID_PROPERTY, str(fiber_id))
+	write_rois(rois, namer.analysed_rois_path)
+	if analysis.fiber_roi_path is not None and os.path.exists(analysis.fiber_roi_path):
+		tag_fiber_rois(analysis.fiber_roi_path, dict(zip(fibers.ids, ids)))
+	with open(namer.analysed_config_path, "w") as config_file:
+		json.dump(analysis_settings(analysis, config), config_file, indent=2, sort_keys=True)
+
+def load_snapshot(analysis, config):
+	"""
+	Returns the fiber ROIs of the previous analysis, or None if its results can't be updated:
+	there are no results, the fibers are to be segmented again, or the analysis settings or channels changed.
+	"""
+	namer = analysis.namer
+	paths = [namer.results_path, namer.analysed_rois_path, namer.analysed_config_path]
+	if config["run_cellpose"] or not all(os.path.exists(path) for path in paths):
+		return None
+	with open(namer.analysed_config_path) as config_file:
+		previous_settings = json.load(config_file)
+	if previous_settings != json.loads(json.dumps(analysis_settings(analysis, config))):
+		IJ.log("### The image, channels or analysis settings changed since the last run, analysing every fiber ###")
+		return None
+	return read_rois(namer.analysed_rois_path)
+
+def patch_results(results_path, diff, n_fibers, changed_results):
+	"""
+	Rewrites a results CSV for the current fibers: rows of unchanged fibers are kept, rows of removed fibers dropped,
+	and rows of modified or added fibers filled from `changed_results` (columns of values, in `changed_indices` order).
+	Columns missing from `changed_results` are left empty.
+	"""
+	header, rows = read_csv_rows(results_path)
+	row_numbers = bool(header) and not header[0].strip() # ImageJ's row-number column
+	previous_rows = dict((index, rows[previous_index]) for previous_index, index in diff.unchanged)
+	changed_rows = {}
+	for position, index in enumerate(changed_indices(diff)):
+		changed_rows[index] = [format_value(changed_results[column][position]) if column in changed_results else "" for column in header]
+
+	with open(results_path, "wb") as results_file:
+		writer = csv.writer(results_file)
+		writer.writerow(header)
+		for index in range(n_fibers):
+			row = list(previous_rows[index] if index in previous_rows else changed_rows[index])
+			if row_numbers:
+				row[0] = str(index+1)
+			writer.writerow(row)
+	IJ.log("Updated {}: {} unchanged, {} modified, {} added and {} removed fibers".format(os.path.basename(results_path), \
+	len(diff.unchanged), len(diff.modified), len(diff.added), len(diff.removed)))
+	return results_path
+
+def read_results_column(results_path, column):
+	header, rows = read_csv_rows(results_path)
+	position = header.index(column)
+	return [row[position] for row in rows]
@@ -0,0 +1,219 @@
+"""
+Helpers for reading and manipulating label images, where each pixel holds the (1-indexed) label of the fiber it belongs to,
+and 0 is background. Label images are usually made from fiber ROIs with `roi_utils.R2L`.
+"""
+
+from ij.process import ShortProcessor, ByteProcessor, Blitter
+from ij.plugin.filter import EDM
+from jarray import array, zeros
+from java.lang import Runtime
+from java.util.concurrent import Executors, Callable
+import math
+
+def label_at(label_ip, x, y):
+	"""
+	Returns the label of the pixel containing the position (x, y), or 0 if the position is outside the image.
+	"""
+	col, row = int(math.floor(x)), int(math.floor(y)) # int() rounds (-1, 0) up to the first column or row
+	if col < 0 or row < 0 or col >= label_ip.getWidth() or row >= label_ip.getHeight():
+		return 0
+	return int(label_ip.getf(col, row))
+
+def labels_at(label_ip, xs, ys):
+	"""
+	Returns the labels found at each of the positions in `xs` and `ys`.
+	"""
+	return [label_at(label_ip, x, y) for x, y in zip(xs, ys)]
+
+class _ErodeStripe(Callable):
+	"""Erodes the rows [start, end) of a label image, reading from the original pixels and writing to the eroded copy"""
+	def __init__(self, pixels, eroded, width, height, start, end, connectivity):
+		self.pixels, self.eroded = pixels, eroded
+		self.width, self.height = width, height
+		self.start, self.end = start, end
+		self.connectivity = connectivity
+
+	def call(self):
+		pixels, eroded, width, height = self.pixels, self.eroded, self.width, self.height
+		diagonal = self.connectivity == 8
+		for y in range(self.start, self.end):
+			row = y*width
+			up, down = y > 0, y < height-1
+			for x in range(width):
+				i = row+x
+				value = pixels[i]
+				if value == 0:
+					continue
+				left, right = x > 0, x < width-1
+				if (left and pixels[i-1] != value) or (right and pixels[i+1] != value) or \
+					(up and pixels[i-width] != value) or (down and pixels[i+width] != value):
+					eroded[i] = 0
+				elif diagonal and ((up and left and pixels[i-width-1] != value) or (up and right and pixels[i-width+1] != value) or \
+					(down and left and pixels[i+width-1] != value) or (down and right and pixels[i+width+1] != value)):
+					eroded[i] = 0
+		return self.end - self.start
+
+def erode_labels(label_ip, connectivity=4, n_threads=None):
+	"""
+	Removes the outermost pixel layer of every label, so that touching labels are separated by background.
+	This is the CPU equivalent of CLIJ2's erodeLabels with a radius of 1.
+	
+	A pixel is cleared if any of its 4-connected (or 8-connected) neighbours holds a different value (including background).
+	Neighbours outside of the image are ignored. The image is eroded in row stripes on `n_threads` threads (all cores by default).
+	"""
+	width, height = label_ip.getWidth(), label_ip.getHeight()
+	eroded_ip = label_ip.duplicate()
+	pixels = label_ip.getPixels()
+	eroded = eroded_ip.getPixels()
+	n_threads = min(n_threads or Runtime.getRuntime().availableProcessors(), height)
+	if n_threads <= 1:
+		_ErodeStripe(pixels, eroded, width, height, 0, height, connectivity).call()
+		return eroded_ip
+	
+	bounds = [height*stripe//n_threads for stripe in range(n_threads+1)]
+	pool = Executors.newFixedThreadPool(n_threads)
+	try:
+		stripes = [_ErodeStripe(pixels, eroded, width, height, bounds[stripe], bounds[stripe+1], connectivity) for stripe in range(n_threads)]
+		for future in pool.invokeAll(stripes):
+			future.get() # Raises any error from the stripe
+	finally:
+		pool.shutdown()
+	return eroded_ip
+
+def label_areas(label_ip, n_labels):
+	"""
+	Returns the number of pixels belonging to each label, indexed so that position i holds the area of label i+1.
+	"""
+	if isinstance(label_ip, ShortProcessor):
+		label_ip.resetRoi()
+		histogram = label_ip.getHistogram()
+		return [histogram[label] for label in range(1, n_labels+1)]
+	areas = [0]*(n_labels+1)
+	for value in label_ip.getPixels():
+		label = int(value)
+		if 0 < label <= n_labels:
+			areas[label] += 1
+	return areas[1:]
+
+def inner_distance_map(label_ip):
+	"""
+	Returns a 32-bit map holding, for each labelled pixel, the Euclidean distance from the pixel centre to the centre of the
+	outline pixels of its own label. Add 0.5 to a labelled pixel's value for the distance to the outer edge of the outline.
+	
+	Labels are separated by one pixel before the distance transform, so that touching fibers do not merge.
+	Pixels outside of any label hold 0.
+	"""
+	mask = erode_labels(label_ip).convertToByteProcessor(False)
+	mask.threshold(0) # Any remaining label becomes foreground
+	return EDM().makeFloatEDM(mask, 0, True)
+
+def label_mask_counts(label_ip, mask_ips, n_labels):
+	"""
+	Counts, for every label, the number of its pixels that are positive (non-zero) in each of the provided binary masks.
+	
+	Returns (areas, positive_counts), where areas[i] is the pixel count of label i+1, and positive_counts[c][i]
+	is the number of those pixels that are positive in mask c.
+	
+	16-bit label images are counted with histograms of the label image multiplied by each mask, otherwise
+	all of the masks are counted in a single scan of the label image.
+	"""
+	if isinstance(label_ip, ShortProcessor):
+		areas = label_areas(label_ip, n_labels)
+		positive_counts = []
+		for mask_ip in mask_ips:
+			positive_labels = label_ip.duplicate()
+			unit_mask = mask_ip.convertToShortProcessor(False)
+			unit_mask.max(1) # Positive mask pixels become 1
+			positive_labels.copyBits(unit_mask, 0, 0, Blitter.MULTIPLY)
+			positive_counts.append(label_areas(positive_labels, n_labels))
+		return areas, positive_counts
+	
+	areas = [0]*(n_labels+1)
+	positive_counts = [[0]*(n_labels+1) for _ in mask_ips]
+	mask_pixels = [mask_ip.getPixels() for mask_ip in mask_ips]
+	labels = label_ip.getPixels()
+	for i in range(len(labels)):
+		label = int(labels[i])
+		if 0 < label <= n_labels:
+			areas[label] += 1
+			for counts, pixels in zip(positive_counts, mask_pixels):
+				if pixels[i] != 0:
+					counts[label] += 1
+	return areas[1:], [counts[1:] for counts in positive_counts]
+
+def label_area_fractions(label_ip, mask_ips, n_labels):
+	"""
+	Returns, for each mask, a list of the percentage of each label's area that is positive in that mask (the '%Area' measurement).
+	Labels without any pixels are given NaN.
+	"""
+	areas, positive_counts = label_mask_counts(label_ip, mask_ips, n_labels)
+	return [[100.0*positive/area if area > 0 else float("nan") for positive, area in zip(counts, areas)] for counts in positive_counts]
+
+def label_histograms(label_ip, value_ip, n_labels):
+	"""
+	Returns the histogram of an 8-bit image's values within every label, in a single scan of the label image.
+	histograms[i] counts the pixels of label i+1 with each of the 256 values, so its sum is the label's area.
+	"""
+	n_bins = 256
+	counts = zeros((n_labels+1)*n_bins, 'i')
+	labels = label_ip.getPixels()
+	values = value_ip.getPixels()
+	short_labels = isinstance(label_ip, ShortProcessor)
+	for i in range(len(labels)):
+		label = labels[i] & 0xffff if short_labels else int(labels[i])
+		if 0 < label <= n_labels:
+			counts[label*n_bins + (values[i] & 0xff)] += 1
+	return [counts[label*n_bins:(label+1)*n_bins] for label in range(1, n_labels+1)]
+
+def border_touching_labels(label_ip, border_roi, n_labels):
+	"""
+	Returns, for every label, whether it touches the edge of a border ROI: whether any of its pixels lie outside of the ROI,
+	on the ROI's outline, or on the edge of the image.
+	
+	The pixels outside of the ROI and on its outline form one mask, drawn with ImageJ's fill and draw, whose labels are found
+	from a single masked count.
+	"""
+	width, height = label_ip.getWidth(), label_ip.getHeight()
+	interior = ByteProcessor(width, height)
+	interior.setValue(255)
+	interior.fill(border_roi)
+	interior.resetRoi()
+	interior.setValue(0)
+	interior.setLineWidth(1)
+	interior.draw(border_roi) # Clears the ROI's outline
+	interior.drawRect(0, 0, width, height) # Fibers cut by the image edge are excluded too
+	interior.invert() # Outside or on the outline of the ROI
+	_, (edge_counts,) = label_mask_counts(label_ip, [interior], n_labels)
+	return [count > 0 for count in edge_counts]
+
+def remove_labels(label_ip, remove):
+	"""
+	Returns a copy of a label image with every label flagged in `remove` (where position i refers to label i+1) set to background.
+	
+	16-bit label images are relabelled with a lookup table in one pass, otherwise the pixels are scanned.
+	"""
+	removed_ip = label_ip.duplicate()
+	if isinstance(label_ip, ShortProcessor):
+		lut = list(range(65536))
+		for index, flagged in enumerate(remove):
+			if flagged:
+				lut[index+1] = 0
+		removed_ip.applyTable(array(lut, 'i'))
+		return removed_ip
+	removed = set(index+1 for index, flagged in enumerate(remove) if flagged)
+	pixels = removed_ip.getPixels()
+	for i in range(len(pixels)):
+		if int(pixels[i]) in removed:
+			pixels[i] = 0
+	removed_ip.resetMinAndMax()
+	return removed_ip
+
+def exclude_border_labels(label_ip, border_roi, n_labels):
+	"""
+	Removes the labels touching the edge of a border ROI (see `border_touching_labels`).
+	
+	Returns the edgeless label image, and a list of whether each label was kept.
+	Labels are excluded individually, so a fiber in contact with an excluded fiber is kept.
+	"""
+	touching = border_touching_labels(label_ip, border_roi, n_labels)
+	return remove_labels(label_ip, touching), [not flagged for flagged in touching]
@@ -0,0 +1,146 @@
+from ij import IJ, ImagePlus
+from ij.gui import Roi
+from ij.measure import Calibration
+from ij.plugin import ChannelSplitter
+from loci.formats import ChannelSeparator, MetadataTools
+from loci.plugins.util import ImageProcessorReader, LociPrefs
+from ome.units import UNITS
+from tiff_mmap import open_mapped_tiff
+
+class ChannelReader:
+	"""
+	Reads single channel planes of an image file through Bio-Formats, without opening the whole image.
+
+	RGB images are separated into their red, green and blue channels. The file stays open until `close`.
+	"""
+
+	def __init__(self, file_path, series=0):
+		self.file_path = file_path
+		self.series = series
+		self.metadata = MetadataTools.createOMEXMLMetadata()
+		self.reader = ImageProcessorReader(ChannelSeparator(LociPrefs.makeImageReader()))
+		self.reader.setMetadataStore(self.metadata)
+		self.reader.setId(file_path)
+		self.reader.setSeries(series)
+
+	def get_size(self):
+		"""Returns the (width, height, channels, slices, frames) of the image"""
+		reader = self.reader
+		return reader.getSizeX(), reader.getSizeY(), reader.getSizeC(), reader.getSizeZ(), reader.getSizeT()
+
+	def is_single_plane(self):
+		"""Checks that every channel is a single plane, otherwise the image needs to be standardized first"""
+		_, _, _, n_slices, n_frames = self.get_size()
+		return n_slices == 1 and n_frames == 1
+
+	def get_calibration(self):
+		calibration = Calibration()
+		pixel_width = self.metadata.getPixelsPhysicalSizeX(self.series)
+		pixel_height = self.metadata.getPixelsPhysicalSizeY(self.series)
+		if pixel_width is not None:
+			calibration.pixelWidth = pixel_width.value(UNITS.MICROMETER).doubleValue()
+			calibration.pixelHeight = pixel_height.value(UNITS.MICROMETER).doubleValue() if pixel_height is not None else calibration.pixelWidth
+			calibration.setUnit("micron")
+		return calibration
+
+	def open_channel(self, channel, title):
+		"""Reads the plane of a channel (0-indexed) with openBytes, as a calibrated ImagePlus"""
+		ip = self.reader.openProcessors(self.reader.getIndex(0, channel, 0))[0]
+		ip.resetMinAndMax()
+		imp = ImagePlus(title or "C{}".format(channel+1), ip)
+		imp.setCalibration(self.get_calibration())
+		return imp
+
+	def open_region(self, channel, title, region):
+		"""Reads an (x, y, width, height) rectangle of a channel (0-indexed) with openBytes, as a calibrated ImagePlus"""
+		x, y, width, height = region
+		ip = self.reader.openProcessors(self.reader.getIndex(0, channel, 0), x, y, width, height)[0]
+		ip.resetMinAndMax()
+		imp = ImagePlus(title or "C{}".format(channel+1), ip)
+		imp.setCalibration(self.get_calibration())
+		return imp
+
+	def close(self):
+		self.reader.close()
+
+class ChannelHandle:
+	"""
+	A channel of an image that is only read from disk when a stage asks for its pixels with `load`.
+	Handles made from an already opened channel (`imp`) simply return it.
+	"""
+
+	def __init__(self, title, channel, reader=None, imp=None):
+		self.title = title
+		self.channel = channel
+		self.reader = reader
+		self.imp = imp
+
+	def is_loaded(self):
+		return self.imp is not None
+
+	def load(self):
+		if self.imp is None:
+			IJ.log("Loading channel {} ({})".format(self.channel+1, self.title))
+			self.imp = self.reader.open_channel(self.channel, self.title)
+		return self.imp
+
+	def get_size(self):
+		"""Returns the (width, height) of the channel, without reading it"""
+		if self.imp is not None:
+			return self.imp.getWidth(), self.imp.getHeight()
+		return self.reader.get_size()[:2]
+
+	def open_region(self, region):
+		"""
+		Returns an (x, y, width, height) rectangle of the channel, cropped from it if loaded, otherwise read from the file.
+		"""
+		title = "{}-x{}_y{}".format(self.title or "C{}".format(self.channel+1), region[0], region[1])
+		if self.imp is None:
+			return self.reader.open_region(self.channel, title, region)
+		ip = self.imp.getProcessor()
+		ip.setRoi(Roi(*region))
+		region_imp = ImagePlus(title, ip.crop())
+		ip.resetRoi()
+		region_imp.setCalibration(self.imp.getCalibration())
+		return region_imp
+
+	def take_plane(self, ip, calibration):
+		"""Keeps a plane that was already read (e.g. with the whole image), instead of reading it again on `load`"""
+		if self.imp is None:
+			ip.resetMinAndMax()
+			self.imp = ImagePlus(self.title or "C{}".format(self.channel+1), ip)
+			self.imp.setCalibration(calibration)
+		return self.imp
+
+	def release(self):
+		"""Frees the channel's pixels; it is read again on the next `load`"""
+		if self.imp is not None and self.reader is not None:
+			self.imp.close()
+			self.imp = None
+
+def open_channel_handles(file_path, titles):
+	"""
+	Returns a handle for every channel of an image file, titled from `titles` (a channel name or None per channel),
+	along with the reader, or (None, None) if the file has to be opened whole (e.g. channels stored as slices).
+	Uncompressed ImageJ TIFFs are read from memory-mapped strips (see tiff_mmap), other files through Bio-Formats.
+	"""
+	reader = open_mapped_tiff(file_path)
+	try:
+		reader = reader or ChannelReader(file_path)
+	except Exception as e:
+		IJ.log("Bio-Formats can't read channels of {} separately: {}".format(file_path, e))
+		return None, None
+	if not reader.is_single_plane():
+		reader.close()
+		return None, None
+	n_channels = reader.get_size()[2]
+	return [ChannelHandle(titles[channel] if channel < len(titles) else None, channel, reader=reader) for channel in range(n_channels)], reader
+
+def split_channel_handles(imp, titles):
+	"""Splits an opened image into handles of its channels, titled from `titles`"""
+	handles = []
+	for channel, channel_imp in enumerate(ChannelSplitter.split(imp)):
+		title = titles[channel] if channel < len(titles) else None
+		channel_imp.title = title
+		handles.append(ChannelHandle(title, channel, imp=channel_imp))
+	return handles
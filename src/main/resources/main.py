@@ -3,19 +3,24 @@ from ij.gui import GenericDialog
 from ij.measure import ResultsTable
 from ij.plugin.frame import RoiManager
 from gui import FiberSight_GUI
-from image_tools import pickImage, remove_small_rois, make_results, convertLabelsToROIs, mergeChannels
+from image_tools import pickImage, convertLabelsToROIs, mergeChannels
 from jy_tools import attrs, reload_modules, closeAll, is_development_machine
 from analysis_setup import AnalysisSetup
 from file_naming import FileNamer
-from fiber_morphology import estimate_fiber_morphology
-from central_nucleation import find_all_nuclei, determine_central_nucleation, determine_number_peripheral, show_rois, repeated_erosion, fill_color_rois
-from muscle_fiber_typing import fiber_type_channel, generate_ft_results 
-from remove_edge_labels import ROI_border_exclusion
+from fiber_morphology import estimate_fiber_morphology, measure_fiber_morphology
+from fiber_table import remove_small_fibers
+from central_nucleation import find_all_nuclei, determine_central_nucleation, determine_number_peripheral, show_rois, repeated_erosion, fill_color_rois, gradient_nucleation
+from muscle_fiber_typing import binarize_fiber_type_channel, measure_area_fraction, generate_ft_results 
+from label_utils import exclude_border_labels, label_area_fractions
 import os, sys
 from collections import Counter, OrderedDict
-from roi_utils import read_rois
-from time import sleep
+from roi_utils import read_rois, write_rois, R2L
 from cellpose_runner import CellposeRunner
+from segmentation_cache import SegmentationCache
+from image_pyramid import scale_rois
+from stage_cache import StageCache, StageGraph, file_key, rois_key
+from results_store import ResultsStore
+from incremental import load_snapshot, save_snapshot, diff_fibers, changed_indices, patch_results, read_results_column
 reload_modules(force=True, verbose=True)
 
 def setup_experiment(image_path, channel_list):
@@ -29,9 +34,44 @@ def save_fibertype_mask(channel_dup, analysis, threshold_method, image_correctio
 	IJ.saveAs(channel_dup, "Png", ft_mask_path)
 
 def updateProgress(curr_progress):
-	sleep(0.1)
 	IJ.showProgress(curr_progress)
 
+def default_config(analysis, **options):
+	"""
+	Returns the analysis configuration for an AnalysisSetup, with any keyword options overriding the defaults.
+	"""
+	config = {
+		"min_fiber_size": 10,
+		"prop_threshold": 50,
+		"num_nuclei_check": 8,
+		"nuclei_count_mode": "label", # "label" assigns nuclei with a fiber label image, "nearest" checks the num_nuclei_check nearest fibers
+		"ft_area_mode": "label", # "label" counts fiber-type area fractions from a fiber label image, "measure" uses the ROI manager
+		"cn_gradient_mode": "distance", # "distance" uses a single distance transform, "erosion" re-erodes the fibers for every percentage
+		"blur_radius": 4,
+		"assess_hybrid": True,
+		"image_correction": False,
+		"threshold_method": "Mean",
+		"remove_small_fibers": True,
+		"overwrite_rois": False,
+		"cellpose_model": "cyto3",
+		"cellpose_diam": 0,
+		"segmentation_cache": False, # Reuses earlier Cellpose segmentations of identical pixels and settings: True caches in the experiment's cache folder, a path anywhere
+		"cellpose_tile_size": None, # Segments images larger than this many pixels in overlapping tiles, e.g. 2048 for whole slides
+		"cellpose_tile_overlap": 256, # Should be wider than the largest fiber
+		"create_figures": True, # Builds the channel composites and saves the figures; the composites are never made otherwise
+		"stage_cache": False, # Reuses the nuclei, fiber-type masks, area fractions and border exclusion of earlier runs with the same inputs: True caches in the experiment's cache folder, a path anywhere. Masks aren't saved again when the fractions are reused
+		"incremental": True, # Updates the previous results after the fibers are edited, measuring only the changed fibers
+		"save_profile": True, # Saves the time, CPU and memory use of every stage next to the results
+		"segmentation_level": None, # Pyramid level to segment: None for full resolution, a level index, or "auto" to pick it from cellpose_diam
+		"remove_fibers_outside_border": analysis.drawn_border_roi is not None
+	}
+	unknown_options = [key for key in options if key not in config]
+	if unknown_options:
+		raise ValueError("Unknown analysis options: {}".format(", ".join(unknown_options)))
+	config.update(options)
+	config["run_cellpose"] = analysis.rm_fiber is None or config["overwrite_rois"]
+	return config
+
 def run_FiberSight(input_image_path=None, channel_list=None, cp_model=None, is_testing=False):
 	fs = FiberSight_GUI(input_image_path=input_image_path, channel_list=channel_list, cp_model=cp_model, is_testing=is_testing)
 	updateProgress(0.0)
@@ -49,121 +89,326 @@ def run_FiberSight(input_image_path=None, channel_list=None, cp_model=None, is_t
 	analysis = AnalysisSetup(im_path, channels, fiber_roi_path=roi_path)
 	analysis.namer.validate_structure()
 	
-	ANALYSIS_CONFIG = {
-		"min_fiber_size": 10,
-		"prop_threshold": 50,
-		"num_nuclei_check": 8,
-		"blur_radius": 4,
-		"assess_hybrid": fs.get_ft_hybrid(),
-		"image_correction": "pseudo_flat_field" if fs.get_flat_field() else False,
-		"threshold_method": fs.get_threshold_method(),
-		"remove_small_fibers": fs.get_remove_small(),
-		"run_cellpose": analysis.rm_fiber is None or fs.get_overwrite_button(),
-		"cellpose_model": fs.get_cellpose_model(),
-		"cellpose_diam": fs.get_cellpose_diameter(),
-		"remove_fibers_outside_border": analysis.drawn_border_roi is not None
-	}
+	ANALYSIS_CONFIG = default_config(analysis, 
+		assess_hybrid=fs.get_ft_hybrid(),
+		image_correction="pseudo_flat_field" if fs.get_flat_field() else False,
+		threshold_method=fs.get_threshold_method(),
+		remove_small_fibers=fs.get_remove_small(),
+		overwrite_rois=fs.get_overwrite_button(),
+		cellpose_model=fs.get_cellpose_model(),
+		cellpose_diam=fs.get_cellpose_diameter()
+	)
+	return run_analysis(analysis, ANALYSIS_CONFIG)
+
+def get_cache_dir(analysis, cache_setting, cache_name):
+	"""
+	Returns the directory of a cache setting: None when off, the experiment's own cache folder for True, otherwise the given path.
+	"""
+	if not cache_setting:
+		return None
+	if cache_setting is True:
+		return os.path.join(analysis.namer.experiment_dir, "cache", cache_name)
+	return cache_setting
+
+def make_stage_graph(analysis, ANALYSIS_CONFIG):
+	"""
+	Returns the StageGraph of an analysis, with the image, its channel names and the manual border as sources.
+	"""
+	stage_cache_dir = get_cache_dir(analysis, ANALYSIS_CONFIG["stage_cache"], "stage_cache")
+	graph = StageGraph(ANALYSIS_CONFIG, StageCache(stage_cache_dir) if stage_cache_dir else None)
+	graph.set_source("image", file_key(analysis.namer.image_path, analysis.all_channels))
+	graph.set_source("border", rois_key([analysis.drawn_border_roi]))
+	return graph
+
+def detect_nuclei(analysis, graph):
+	"""Returns a ROI manager of the nuclei found in the DAPI channel"""
+	nuclei = graph.run("nuclei", lambda: {"nuclei": list(find_all_nuclei(analysis.dapi_channel)[0])})["nuclei"]
+	rm_nuclei = RoiManager(True)
+	for enum, roi in enumerate(nuclei):
+		rm_nuclei.add(None, roi, enum)
+	return rm_nuclei
+
+def record_columns(fibers, results_dict, columns):
+	"""Records the results of a stage as columns of the FiberTable, as soon as the stage has them"""
+	for column in columns:
+		values = results_dict[column]
+		fibers.set_column(column, [values[i] for i in range(len(fibers))] if isinstance(values, dict) else values)
+
+def measure_fiber_types(analysis, rm_fiber, ANALYSIS_CONFIG, graph):
+	"""
+	Thresholds the fiber-type channels, and returns the positive area fraction of the fibers in `rm_fiber` for each channel, with the channel masks.
+	When the fractions are reused from the stage cache the channels aren't read at all, and no masks are returned.
+	"""
+	channel_masks = []
 	
+	def threshold_channels():
+		return {"masks": [binarize_fiber_type_channel(channel, rm_fiber, blur_radius=ANALYSIS_CONFIG["blur_radius"], \
+		threshold_method=ANALYSIS_CONFIG["threshold_method"], image_correction=ANALYSIS_CONFIG["image_correction"], \
+		drawn_border_roi=analysis.drawn_border_roi) for channel in analysis.ft_channels]}
+	
+	def measure_fractions():
+		channel_masks.extend(graph.run("ft_masks", threshold_channels)["masks"])
+		if ANALYSIS_CONFIG["ft_area_mode"] == "label":
+			fiber_labels = R2L(analysis.border_channel, rm_fiber.getRoisAsArray())
+			fractions = label_area_fractions(fiber_labels.getProcessor(), [mask.getProcessor() for mask in channel_masks], rm_fiber.getCount())
+		else:
+			fractions = [measure_area_fraction(mask, rm_fiber) for mask in channel_masks]
+		return {"fractions": [[handle.title, list(fraction)] for handle, fraction in zip(analysis.ft_handles, fractions)]}
+	
+	graph.set_source("fibers", rois_key(rm_fiber.getRoisAsArray()))
+	fractions = graph.run("ft_fractions", measure_fractions)["fractions"]
+	area_frac = OrderedDict(("{}_%-Area".format(title), fraction) for title, fraction in fractions)
+	return area_frac, channel_masks
+
+def filter_fibers(analysis, ANALYSIS_CONFIG, graph):
+	"""
+	Removes small fibers and fibers touching the manual border, as set in the configuration.
+	"""
+	profiler = analysis.profiler
+	if ANALYSIS_CONFIG["remove_small_fibers"]:
+		updateProgress(0.35)
+		with profiler.stage("remove_small") as stage:
+			analysis.set_fiber_table(remove_small_fibers(analysis.get_fiber_table(), ANALYSIS_CONFIG["min_fiber_size"], analysis.imp_scale))
+			stage["fibers"] = analysis.rm_fiber.getCount()
+
+	if ANALYSIS_CONFIG["remove_fibers_outside_border"]:
+		updateProgress(0.4)
+		with profiler.stage("border_exclusion") as stage:
+			IJ.log("### Loading Previously Generated Manual Border ###\nLoading manual border from {}".format(analysis.namer.border_path))
+			fibers = analysis.get_fiber_table()
+			def exclude_border():
+				fiber_labels = R2L(analysis.border_channel, analysis.rm_fiber.getRoisAsArray())
+				return {"kept": exclude_border_labels(fiber_labels.getProcessor(), analysis.drawn_border_roi, len(fibers))[1]}
+			graph.set_source("fibers", rois_key(analysis.rm_fiber.getRoisAsArray()))
+			kept = graph.run("border_exclusion", exclude_border)["kept"]
+			analysis.set_fiber_table(fibers.filter(kept))
+			IJ.log("Removed {} fibers touching the border".format(kept.count(False)))
+			analysis.namer.create_directory("border_exclusion")
+			write_rois(analysis.rm_fiber.getRoisAsArray(), analysis.namer.excluded_border_fiber_rois_path)
+			stage["fibers"] = analysis.rm_fiber.getCount()
+
+def save_profile(analysis, ANALYSIS_CONFIG):
+	if ANALYSIS_CONFIG["save_profile"]:
+		analysis.namer.create_directory("results")
+		analysis.profiler.save(analysis.namer.profile_json_path, analysis.namer.profile_csv_path)
+		analysis.profiler.log_summary()
+
+def run_analysis(analysis, ANALYSIS_CONFIG, headless=False, cellpose_worker=None):
+	"""
+	Runs segmentation, border exclusion, morphology, central nucleation and fiber-typing on a prepared AnalysisSetup.
+	
+	With headless=True no images or tables are shown, so it can run under `fiji --headless`.
+	A persistent `cellpose_worker` (see cellpose_worker.CellposeWorker) avoids reloading Cellpose for every image.
+	Each stage is timed by the analysis' StageProfiler, and saved with the results when `save_profile` is set.
+	"""
+	profiler = analysis.profiler
 	results_dict = {}
 	central_rois = None
 	central_fibers = None
 	percReductions = None
 	identified_fiber_types = None
 	
+	previous_rois = load_snapshot(analysis, ANALYSIS_CONFIG) if ANALYSIS_CONFIG["incremental"] else None
+	if previous_rois is not None:
+		return update_analysis(analysis, ANALYSIS_CONFIG, previous_rois)
+	
 	if ANALYSIS_CONFIG["run_cellpose"]:
-		save_rois="True"
-		seg_chan = 0 if analysis.is_brightfield() else analysis.get_fiber_border_channel_position()
-		imp_dup = analysis.imp.duplicate()
-		# image_string = "raw_path='{}', cellpose_diam='{}', model='{}', save_rois='{}', seg_chan='{}'".format(analysis.namer.image_path, ANALYSIS_CONFIG["cellpose_diam"], ANALYSIS_CONFIG["cellpose_model"], save_rois, seg_chan)
-		updateProgress(0.2)
-		IJ.showStatus("Running Cellpose")
-		runner = CellposeRunner(model_name=ANALYSIS_CONFIG["cellpose_model"], diameter=ANALYSIS_CONFIG["cellpose_diam"], segmentation_channel=seg_chan)
-		runner.set_image(imp_dup)
-		runner.run_cellpose()
-		runner.save_rois(analysis.namer.fiber_roi_path)
+		with profiler.stage("cellpose") as stage:
+			save_rois="True"
+			seg_chan = 0 if analysis.is_brightfield() else analysis.get_fiber_border_channel_position()
+			seg_level = analysis.get_segmentation_level(ANALYSIS_CONFIG["segmentation_level"], ANALYSIS_CONFIG["cellpose_diam"])
+			downsample = 1 if seg_level is None else seg_level.downsample
+			# image_string = "raw_path='{}', cellpose_diam='{}', model='{}', save_rois='{}', seg_chan='{}'".format(analysis.namer.image_path, ANALYSIS_CONFIG["cellpose_diam"], ANALYSIS_CONFIG["cellpose_model"], save_rois, seg_chan)
+			updateProgress(0.2)
+			IJ.showStatus("Running Cellpose")
+			segmentation_cache_dir = get_cache_dir(analysis, ANALYSIS_CONFIG["segmentation_cache"], "segmentation_cache")
+			runner = CellposeRunner(model_name=ANALYSIS_CONFIG["cellpose_model"], diameter=ANALYSIS_CONFIG["cellpose_diam"]/downsample, segmentation_channel=seg_chan, worker=cellpose_worker, \
+			cache=SegmentationCache(segmentation_cache_dir) if segmentation_cache_dir else None, \
+			tile_size=ANALYSIS_CONFIG["cellpose_tile_size"], tile_overlap=ANALYSIS_CONFIG["cellpose_tile_overlap"])
+			if seg_level is not None:
+				runner.set_image(analysis.open_level(seg_level))
+			elif seg_chan > 0:
+				runner.set_channel(analysis.border_handle) # Only the channel Cellpose segments is read, tile by tile if tiled
+			else:
+				runner.set_image(analysis.imp.duplicate())
+			runner.run_cellpose()
+			if downsample > 1:
+				IJ.log("### Scaling fibers from pyramid level {} to full resolution ###".format(seg_level.index))
+				full_rois = scale_rois(runner.rm.getRoisAsArray(), downsample)
+				runner.rm.reset()
+				for roi in full_rois:
+					runner.rm.addRoi(roi)
+			runner.save_rois(analysis.namer.fiber_roi_path)
+			analysis.fiber_roi_path = analysis.namer.fiber_roi_path
 		
-		analysis.rm_fiber = RoiManager().getRoiManager()
-		if analysis.rm_fiber.getCount() == 0:
-			raise Exception("No ROIs found")
-		for im_title in WM.getImageTitles():
-			pickImage(im_title).close()
+			analysis.set_fiber_rois(RoiManager().getRoiManager())
+			if analysis.rm_fiber.getCount() == 0:
+				raise Exception("No ROIs found")
+			for im_title in WM.getImageTitles():
+				pickImage(im_title).close()
+			if runner.image is not None:
+				runner.image.close()
+			analysis.release_image()
+			stage["fibers"] = analysis.rm_fiber.getCount()
 	else:
 		IJ.log("### Using previously generated fiber segmentations ###\nFibers loaded from: {}".format(analysis.namer.fiber_roi_path))
 
-	if ANALYSIS_CONFIG["remove_small_fibers"]:
-		updateProgress(0.35)
-		analysis.rm_fiber = remove_small_rois(analysis.rm_fiber, analysis.imp, ANALYSIS_CONFIG["min_fiber_size"])
-
-	if ANALYSIS_CONFIG["remove_fibers_outside_border"]:
-		updateProgress(0.4)
-		IJ.log("### Loading Previously Generated Manual Border ###\nLoading manual border from {}".format(analysis.namer.border_path))
-		fiber_rois = analysis.rm_fiber.getRoisAsArray()
-		edgeless, overlay_image = ROI_border_exclusion(analysis.border_channel, analysis.drawn_border_roi, fiber_rois, separate_rois=True, GPU=True)
-		overlay_image.hide()
-		analysis.border_channel.hide()
-		rm_test = convertLabelsToROIs(edgeless)
-		edgeless.hide()
-		# TODO: Save these ROIs #
+	graph = make_stage_graph(analysis, ANALYSIS_CONFIG)
+	filter_fibers(analysis, ANALYSIS_CONFIG, graph)
+	fibers = analysis.get_fiber_table()
 
 	if analysis.Morph:
 		updateProgress(0.5)
-		results_dict["Label"], results_dict["Area"], results_dict["MinFeret"] = estimate_fiber_morphology(analysis.border_channel, analysis.imp_scale, analysis.rm_fiber)
+		with profiler.stage("morphology"):
+			results_dict["Label"], results_dict["Area"], results_dict["MinFeret"] = estimate_fiber_morphology(analysis.border_channel, analysis.imp_scale, fibers, \
+			rois=analysis.rm_fiber.getRoisAsArray(), geometry=analysis.get_fiber_geometry())
 
 	if analysis.CN:
 		updateProgress(0.6)
-		roiArray, rm_nuclei = find_all_nuclei(analysis.dapi_channel, analysis.rm_fiber)
-		results_dict["Central Nuclei"], results_dict["Total Nuclei"], rm_central, xFib, yFib, xNuc, yNuc, nearestNucleiFibers = determine_central_nucleation(analysis.rm_fiber, rm_nuclei, num_Check = ANALYSIS_CONFIG["num_nuclei_check"], imp=analysis.cn_merge)
-		results_dict["Peripheral Nuclei"] = determine_number_peripheral(results_dict["Central Nuclei"], results_dict["Total Nuclei"])
-		for label in range(rm_central.getCount()):
-			rm_central.rename(label, str(results_dict["Central Nuclei"][label]))
-		central_rois = rm_central.getRoisAsArray()
+		with profiler.stage("central_nucleation") as stage:
+			fiber_centroids = analysis.get_fiber_geometry().get_centroids()
+			rm_nuclei = detect_nuclei(analysis, graph)
+			# The fibers are rasterized once for both the nuclei counts and the central nucleation gradient
+			use_labels = ANALYSIS_CONFIG["nuclei_count_mode"] == "label" or ANALYSIS_CONFIG["cn_gradient_mode"] == "distance"
+			fiber_labels = R2L(analysis.dapi_channel, analysis.rm_fiber.getRoisAsArray()) if use_labels else None
+			results_dict["Central Nuclei"], results_dict["Total Nuclei"], rm_central, xFib, yFib, xNuc, yNuc, nearestNucleiFibers = determine_central_nucleation(analysis.rm_fiber, rm_nuclei, num_Check = ANALYSIS_CONFIG["num_nuclei_check"], imp=analysis.cn_merge if ANALYSIS_CONFIG["create_figures"] else None, count_mode=ANALYSIS_CONFIG["nuclei_count_mode"], ref_image=analysis.dapi_channel, fiber_centroids=fiber_centroids, fiber_labels=fiber_labels)
+			results_dict["Peripheral Nuclei"] = determine_number_peripheral(results_dict["Central Nuclei"], results_dict["Total Nuclei"])
+			record_columns(fibers, results_dict, ["Central Nuclei", "Peripheral Nuclei", "Total Nuclei"])
+			for label in range(rm_central.getCount()):
+				rm_central.rename(label, str(results_dict["Central Nuclei"][label]))
+			central_rois = rm_central.getRoisAsArray()
 		
-		percReductions = [float(a)/10 for a in range(0, 10, 1)]
-		IJ.log("Percent Reductions: {}".format(" ".join([str(perc) for perc in percReductions])))
-		num_central, all_reduced, central_fibers = repeated_erosion(percReductions, analysis.rm_fiber, nearestNucleiFibers, xNuc, yNuc, xFib, yFib)
+			percReductions = [float(a)/10 for a in range(0, 10, 1)]
+			IJ.log("Percent Reductions: {}".format(" ".join([str(perc) for perc in percReductions])))
+			if ANALYSIS_CONFIG["cn_gradient_mode"] == "distance":
+				num_central, all_reduced, central_fibers = gradient_nucleation(percReductions, fiber_labels, analysis.rm_fiber.getCount(), xNuc, yNuc)
+			else:
+				num_central, all_reduced, central_fibers = repeated_erosion(percReductions, analysis.rm_fiber, nearestNucleiFibers, xNuc, yNuc, xFib, yFib, count_mode=ANALYSIS_CONFIG["nuclei_count_mode"], ref_image=analysis.dapi_channel)
+			stage["nuclei"] = rm_nuclei.getCount()
+			stage["central_fibers"] = len(central_rois)
 		
 	if analysis.FT:
 		updateProgress(0.8)
-		area_frac = OrderedDict()
-		analysis.namer.create_directory("masks")
-		for channel in analysis.ft_channels:
-			ch_title = channel.getTitle()
-			area_frac["{}_%-Area".format(ch_title)], channel_dup = fiber_type_channel(channel,  \\
-			analysis.rm_fiber, blur_radius=ANALYSIS_CONFIG["blur_radius"], threshold_method=ANALYSIS_CONFIG["threshold_method"], \\
-			image_correction=ANALYSIS_CONFIG["image_correction"], drawn_border_roi=analysis.drawn_border_roi)
-			channel_dup.show()
-			save_fibertype_mask(channel_dup, analysis, ANALYSIS_CONFIG["threshold_method"], ANALYSIS_CONFIG["image_correction"])
-
-		IJ.log("### Identifying Fiber Types by Area Fraction ###")
-		for key in area_frac.keys():
-			results_dict[key] = area_frac.get(key, None)
+		with profiler.stage("fiber_typing") as stage:
+			analysis.namer.create_directory("masks")
+			area_frac, channel_masks = measure_fiber_types(analysis, analysis.rm_fiber, ANALYSIS_CONFIG, graph)
+			if not channel_masks:
+				IJ.log("Fiber-type area fractions reused from the stage cache, so no masks are saved to {}".format(analysis.namer.masks_dir))
+			for channel_dup in channel_masks:
+				if not headless:
+					channel_dup.show()
+				save_fibertype_mask(channel_dup, analysis, ANALYSIS_CONFIG["threshold_method"], ANALYSIS_CONFIG["image_correction"])
+
+			IJ.log("### Identifying Fiber Types by Area Fraction ###")
+			for key in area_frac.keys():
+				results_dict[key] = area_frac.get(key, None)
 	
-		ft_ch_list = [channel.title for channel in analysis.ft_channels]
-		identified_fiber_types, areas = generate_ft_results(area_frac, ft_ch_list, T1_hybrid=ANALYSIS_CONFIG["assess_hybrid"], T2_hybrid=ANALYSIS_CONFIG["assess_hybrid"], T3_hybrid=ANALYSIS_CONFIG["assess_hybrid"], prop_threshold = ANALYSIS_CONFIG["prop_threshold"])		
-		results_dict["Fiber_Type"] = identified_fiber_types
+			ft_ch_list = [handle.title for handle in analysis.ft_handles]
+			identified_fiber_types, areas = generate_ft_results(area_frac, ft_ch_list, T1_hybrid=ANALYSIS_CONFIG["assess_hybrid"], T2_hybrid=ANALYSIS_CONFIG["assess_hybrid"], T3_hybrid=ANALYSIS_CONFIG["assess_hybrid"], prop_threshold = ANALYSIS_CONFIG["prop_threshold"])		
+			results_dict["Fiber_Type"] = identified_fiber_types
+			record_columns(fibers, results_dict, list(area_frac.keys()) + ["Fiber_Type"])
 		
-		IJ.log("### Counting Fiber Types ###")
-		c = Counter(identified_fiber_types)
-		total_Fibers = sum(c.values())
+			IJ.log("### Counting Fiber Types ###")
+			c = Counter(identified_fiber_types)
+			total_Fibers = sum(c.values())
 	
-		IJ.log("### Calculating Fiber Diagnostics ###\nTotal Number of Fibers = {}".format(str(total_Fibers)))
-		# IJ.log("-- SigBlur {}, Flat-field {}, Thresh {}".format(self.ft_sigma_blur, self.ft_flat_blurring, threshold_method))
-		for fibertype in c.most_common():
-			fraction = round(float(fibertype[1])/float(total_Fibers)*100,2)
-			IJ.log("Type {} fibers: {} ({}%) of fibers".format(fibertype[0], fibertype[1], fraction))
+			IJ.log("### Calculating Fiber Diagnostics ###\nTotal Number of Fibers = {}".format(str(total_Fibers)))
+			# IJ.log("-- SigBlur {}, Flat-field {}, Thresh {}".format(self.ft_sigma_blur, self.ft_flat_blurring, threshold_method))
+			for fibertype in c.most_common():
+				fraction = round(float(fibertype[1])/float(total_Fibers)*100,2)
+				IJ.log("Type {} fibers: {} ({}%) of fibers".format(fibertype[0], fibertype[1], fraction))
 		
-		if analysis.drawn_border_roi is not None:
-			IJ.log("### Clearing area outside border ###")
-			channel_dup.setRoi(analysis.drawn_border_roi)
-			IJ.run(channel_dup, "Clear Outside", "")
+			if analysis.drawn_border_roi is not None and channel_masks:
+				IJ.log("### Clearing area outside border ###")
+				channel_dup.setRoi(analysis.drawn_border_roi)
+				IJ.run(channel_dup, "Clear Outside", "")
+			stage["channels"] = len(area_frac)
 
 	updateProgress(0.9)
-	results = make_results(results_dict, analysis.Morph, analysis.CN, analysis.FT)
-	analysis.save_results()
-	analysis.create_figures(central_rois, identified_fiber_types=identified_fiber_types, central_fibers=central_fibers, percReductions=percReductions)
+	with profiler.stage("save") as stage:
+		results = ResultsStore.from_results_dict(results_dict, analysis.Morph, analysis.CN, analysis.FT)
+		analysis.save_results(results)
+		if not headless:
+			results.show()
+		save_snapshot(analysis, fibers, ANALYSIS_CONFIG)
+		stage["fibers"] = len(fibers)
+	if ANALYSIS_CONFIG["create_figures"]:
+		with profiler.stage("figures"):
+			analysis.create_figures(central_rois, identified_fiber_types=identified_fiber_types, central_fibers=central_fibers, percReductions=percReductions)
+	save_profile(analysis, ANALYSIS_CONFIG)
 	updateProgress(1)
 	# analysis.save_metadata() TODO
 	return analysis
+
+def update_analysis(analysis, ANALYSIS_CONFIG, previous_rois):
+	"""
+	Updates the results of a previous analysis after its fibers were edited, measuring only the added and modified fibers.
+	
+	The fibers are matched to the previous ones by fiber ID and outline (see incremental.diff_fibers). Rows of unchanged
+	fibers are kept from the results file and rows of removed fibers dropped. The morphology and fiber-typing figures are redrawn,
+	but the central nucleation figures need the erosions of every fiber, so they are only made by a full analysis.
+	"""
+	profiler = analysis.profiler
+	IJ.log("### Updating the results of {} ###".format(analysis.namer.image_name))
+	graph = make_stage_graph(analysis, ANALYSIS_CONFIG)
+	filter_fibers(analysis, ANALYSIS_CONFIG, graph)
+	fibers = analysis.get_fiber_table()
+	with profiler.stage("diff") as stage:
+		diff = diff_fibers(previous_rois, fibers)
+		stage["unchanged"], stage["modified"], stage["added"], stage["removed"] = len(diff.unchanged), len(diff.modified), len(diff.added), len(diff.removed)
+	changed_rois = [fibers.to_roi(index) for index in changed_indices(diff)]
+	changed_results = OrderedDict()
+	
+	if changed_rois:
+		rm_changed = RoiManager(True)
+		for enum, roi in enumerate(changed_rois):
+			rm_changed.add(None, roi, enum)
+		if analysis.Morph:
+			updateProgress(0.5)
+			with profiler.stage("morphology"):
+				morphology = measure_fiber_morphology(changed_rois, analysis.imp_scale)
+				changed_results["Label"] = ["{}:{}".format(analysis.border_handle.title, roi.getName()) for roi in changed_rois]
+				changed_results["Area"], changed_results["MinFeret"] = morphology["Area"], morphology["MinFeret"]
+		
+		if analysis.CN:
+			updateProgress(0.6)
+			with profiler.stage("central_nucleation") as stage:
+				rm_nuclei = detect_nuclei(analysis, graph)
+				count_central, count_nuclei = determine_central_nucleation(rm_changed, rm_nuclei, num_Check=ANALYSIS_CONFIG["num_nuclei_check"], \
+				count_mode=ANALYSIS_CONFIG["nuclei_count_mode"], ref_image=analysis.dapi_channel)[:2]
+				count_peripheral = determine_number_peripheral(count_central, count_nuclei)
+				for column, counts in [("Central Nuclei", count_central), ("Peripheral Nuclei", count_peripheral), ("Total Nuclei", count_nuclei)]:
+					changed_results[column] = [counts[i] for i in range(len(changed_rois))]
+				stage["nuclei"] = rm_nuclei.getCount()
+		
+		if analysis.FT:
+			updateProgress(0.8)
+			with profiler.stage("fiber_typing"):
+				area_frac, channel_masks = measure_fiber_types(analysis, rm_changed, ANALYSIS_CONFIG, graph)
+				for channel_dup in channel_masks:
+					channel_dup.changes = False
+					channel_dup.close()
+				ft_ch_list = [handle.title for handle in analysis.ft_handles]
+				changed_results.update(area_frac)
+				changed_results["Fiber_Type"] = generate_ft_results(area_frac, ft_ch_list, T1_hybrid=ANALYSIS_CONFIG["assess_hybrid"], T2_hybrid=ANALYSIS_CONFIG["assess_hybrid"], T3_hybrid=ANALYSIS_CONFIG["assess_hybrid"], prop_threshold = ANALYSIS_CONFIG["prop_threshold"])[0]
+		rm_changed.close()
+	
+	updateProgress(0.9)
+	with profiler.stage("save") as stage:
+		patch_results(analysis.namer.results_path, diff, len(fibers), changed_results)
+		save_snapshot(analysis, fibers, ANALYSIS_CONFIG, ids=diff.ids)
+		stage["fibers"] = len(fibers)
+	if ANALYSIS_CONFIG["create_figures"]:
+		with profiler.stage("figures"):
+			if analysis.Morph:
+				analysis.create_morphology_figure()
+			if analysis.FT:
+				analysis.create_fiber_type_figure(read_results_column(analysis.namer.results_path, "Fiber_Type"))
+			if analysis.CN:
+				IJ.log("Central nucleation figures are only redrawn by a full analysis")
+	save_profile(analysis, ANALYSIS_CONFIG)
+	updateProgress(1)
+	return analysis
 #
 if __name__ in ['__builtin__','__main__']:
 	IJ.run("Close All")
@@ -1,6 +1,8 @@
 from ij import IJ, ImagePlus, Prefs, WindowManager as WM
 from ij.measure import ResultsTable
 import math
+from collections import OrderedDict
+from label_utils import label_area_fractions
 
 def choose_fiber(positively_marked, T1_hybrid=False, T2_hybrid=False, T3_hybrid=False):
 	"""
@@ -186,12 +188,11 @@ def determine_fiber_type(fiber_type_keys, perc, T1_hybrid=False, T2_hybrid=False
 	
 	return(ft)
 
-def fiber_type_channel(channel, rm_fiber, threshold_method="Default", blur_radius=2, image_correction=False, drawn_border_roi=None):
-	IJ.run("Set Measurements...", "area area_fraction display add redirect=None decimal=3");
-	IJ.log("### Processing channel {} ###".format(channel.title))
+def prepare_fiber_type_channel(channel, blur_radius=2, image_correction=False, drawn_border_roi=None):
+	"""
+	Returns a copy of a fiber-type channel, cleared outside the border, blurred and corrected, ready to be thresholded.
+	"""
 	channel_dup = channel.duplicate()
-	
-	rm_fiber.runCommand("Show All")
 	if drawn_border_roi is not None:
 		channel_dup.setRoi(drawn_border_roi)
 		IJ.run(channel_dup, "Clear Outside", "")
@@ -207,6 +208,16 @@ def fiber_type_channel(channel, rm_fiber, threshold_method="Default", blur_radiu
 		IJ.run(channel_dup, "Pseudo flat field correction", "blurring={} hide".format(ft_flat_blurring))
 	else:
 		pass
+	return channel_dup
+
+def binarize_fiber_type_channel(channel, rm_fiber=None, threshold_method="Default", blur_radius=2, image_correction=False, drawn_border_roi=None):
+	"""
+	Blurs, corrects and auto-thresholds a fiber-type channel, returning a binary mask of the positive pixels.
+	"""
+	IJ.log("### Processing channel {} ###".format(channel.title))
+	if rm_fiber is not None:
+		rm_fiber.runCommand("Show All")
+	channel_dup = prepare_fiber_type_channel(channel, blur_radius, image_correction, drawn_border_roi)
 	
 	# IJ.setRawThreshold(channel_dup, 200, 65535)
 	
@@ -215,14 +226,50 @@ def fiber_type_channel(channel, rm_fiber, threshold_method="Default", blur_radiu
 	Prefs.blackBackground = True
 	IJ.run(channel_dup, "Convert to Mask", "");
 	IJ.run(channel_dup, "Despeckle", "")
-	rm_fiber.runCommand(channel_dup, "Measure")
+	channel_dup.setTitle(channel_dup.title.split('_')[1].replace(' ', '-'))
+	if rm_fiber is not None:
+		rm_fiber.runCommand("Show None")
+	return channel_dup
+
+def measure_area_fraction(channel_mask, rm_fiber):
+	"""
+	Measures the positive area fraction of a binary mask within each fiber ROI, using the ROI manager.
+	"""
+	IJ.run("Set Measurements...", "area area_fraction display add redirect=None decimal=3");
+	rm_fiber.runCommand(channel_mask, "Measure")
 	fiber_type_ch = ResultsTable().getResultsTable()
 	fiber_type_frac = fiber_type_ch.getColumn("%Area")
-
 	IJ.run("Clear Results", "")
-	channel_dup.setTitle(channel_dup.title.split('_')[1].replace(' ', '-'))
 	rm_fiber.runCommand("Show None")
+	return fiber_type_frac
+
+def fiber_type_channel(channel, rm_fiber, threshold_method="Default", blur_radius=2, image_correction=False, drawn_border_roi=None, label_image=None):
+	"""
+	Thresholds a fiber-type channel and measures the positive area fraction of each fiber.
+	
+	If a fiber label image is provided (see `roi_utils.R2L`), the area fraction is counted from the labels instead of measuring every ROI.
+	"""
+	channel_dup = binarize_fiber_type_channel(channel, rm_fiber, threshold_method=threshold_method, blur_radius=blur_radius, \
+		image_correction=image_correction, drawn_border_roi=drawn_border_roi)
+	if label_image is not None:
+		fiber_type_frac, = label_area_fractions(label_image.getProcessor(), [channel_dup.getProcessor()], rm_fiber.getCount())
+	else:
+		fiber_type_frac = measure_area_fraction(channel_dup, rm_fiber)
 	return fiber_type_frac, channel_dup
+
+def fiber_type_channels(channels, rm_fiber, label_image, threshold_method="Default", blur_radius=2, image_correction=False, drawn_border_roi=None):
+	"""
+	Thresholds every fiber-type channel, then counts the positive area fraction of each fiber for all channels at once from the fiber label image.
+	
+	Returns an OrderedDict of '<channel>_%-Area' columns, and the list of binary channel masks.
+	"""
+	channel_masks = [binarize_fiber_type_channel(channel, rm_fiber, threshold_method=threshold_method, blur_radius=blur_radius, \
+		image_correction=image_correction, drawn_border_roi=drawn_border_roi) for channel in channels]
+	fractions = label_area_fractions(label_image.getProcessor(), [mask.getProcessor() for mask in channel_masks], rm_fiber.getCount())
+	area_frac = OrderedDict()
+	for channel, fiber_type_frac in zip(channels, fractions):
+		area_frac["{}_%-Area".format(channel.getTitle())] = fiber_type_frac
+	return area_frac, channel_masks
 	
 def generate_ft_results(multichannel_dict, ch_list, T1_hybrid=False, T2_hybrid=False, T3_hybrid=False, prop_threshold = 50):
 	dom_list = []
@@ -0,0 +1,153 @@
+from ij import IJ
+from java.lang import System, Runtime
+from datetime import datetime
+from collections import OrderedDict
+import os, csv, json, subprocess, time
+from batch_runner import run_experiment, find_experiment_images, write_summary, IMAGE_TYPES
+from file_naming import FileNamer
+from utilities import make_directories, read_csv_rows
+
+FIJI_LAUNCHERS = ["ImageJ-linux64", "ImageJ-win64.exe", "Contents/MacOS/ImageJ-macosx", "fiji-linux-x64", "fiji-windows-x64.exe", "Contents/MacOS/fiji-macos"]
+
+WORKER_SCRIPT = '''#@ String job_path
+from parallel_batch import run_job
+run_job(job_path)
+'''
+
+def find_fiji_executable():
+	"""
+	Returns the path of the Fiji launcher running this session, so workers start with the same plugins and update sites.
+	"""
+	launcher = System.getProperty("fiji.executable") or System.getProperty("ij.executable")
+	if launcher and os.path.exists(launcher):
+		return launcher
+	fiji_dir = IJ.getDirectory("imagej")
+	for launcher in FIJI_LAUNCHERS:
+		launcher_path = os.path.join(fiji_dir, launcher)
+		if os.path.exists(launcher_path):
+			return launcher_path
+	raise OSError("Could not find the Fiji launcher in {}".format(fiji_dir))
+
+def default_worker_count():
+	"""Uses half of the cores, since every worker JVM also runs ImageJ's own multithreaded filters"""
+	return max(1, Runtime.getRuntime().availableProcessors() // 2)
+
+def shard_images(image_paths, n_workers):
+	"""
+	Deals the images out round-robin, so that slides of a similar size (usually named alike) are spread across workers.
+	"""
+	shards = [image_paths[worker::n_workers] for worker in range(n_workers)]
+	return [shard for shard in shards if shard]
+
+def run_job(job_path):
+	"""
+	Worker entry point: runs the images of a single job file, written by `run_parallel_experiment`.
+	"""
+	with open(job_path) as job_file:
+		job = json.load(job_file)
+	run_experiment(job["experiment_dir"], job["channel_list"], options=job["options"], skip_existing=job["skip_existing"], \
+	image_paths=job["image_paths"], summary_path=job["summary_path"], persistent_cellpose=job["persistent_cellpose"])
+
+def merge_results(image_paths, merged_path):
+	"""
+	Concatenates the per-image results files into one CSV, with an extra Image column.
+	Columns missing from an image (e.g. a fiber-type channel it doesn't have) are left empty.
+	"""
+	columns = ["Image"]
+	tables = []
+	for image_path in image_paths:
+		results_path = FileNamer(image_path).results_path
+		if not os.path.exists(results_path):
+			continue
+		header, rows = read_csv_rows(results_path)
+		header = [column for column in header if column.strip()] if header and not header[0].strip() else header # Drop ImageJ's row-number column
+		offset = len(rows[0]) - len(header) if rows else 0
+		columns.extend(column for column in header if column not in columns)
+		tables.append((os.path.basename(image_path), header, offset, rows))
+
+	with open(merged_path, "wb") as merged_file:
+		writer = csv.writer(merged_file)
+		writer.writerow(columns)
+		for image_name, header, offset, rows in tables:
+			for row in rows:
+				values = dict(zip(header, row[offset:]))
+				values["Image"] = image_name
+				writer.writerow([values.get(column, "") for column in columns])
+	return len(tables)
+
+def run_parallel_experiment(experiment_dir, channel_list, options=None, n_workers=None, memory_per_worker=None, \
+	file_types=IMAGE_TYPES, name_filter=None, skip_existing=False, persistent_cellpose=True, poll_seconds=5):
+	"""
+	Runs FiberSight on an experiment directory with `n_workers` headless Fiji processes working in parallel.
+
+	Every worker is a separate JVM, so the RoiManager, ResultsTable and WindowManager are never shared.
+	The worker logs are kept in the experiment's batch_logs folder; at the end the worker summaries are merged
+	into one batch summary, and the per-image results into a single combined results file.
+	`memory_per_worker` (e.g. "8g") caps each worker's heap; keep n_workers * memory_per_worker below the RAM.
+
+	Returns the merged batch summary.
+	"""
+	options = options or {}
+	n_workers = n_workers or default_worker_count()
+	image_paths = find_experiment_images(experiment_dir, file_types, name_filter)
+	shards = shard_images(image_paths, n_workers)
+	fiji = find_fiji_executable()
+	timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+	log_dir = make_directories(experiment_dir, "batch_logs")[0]
+	job_dir = os.path.join(log_dir, timestamp)
+	os.mkdir(job_dir)
+	worker_script = os.path.join(job_dir, "FiberSight_Worker.py")
+	with open(worker_script, "w") as script_file:
+		script_file.write(WORKER_SCRIPT)
+
+	IJ.log("### Running FiberSight on {} images with {} workers ###".format(len(image_paths), len(shards)))
+	workers = []
+	for worker, shard in enumerate(shards):
+		job = {
+			"experiment_dir": experiment_dir,
+			"channel_list": channel_list,
+			"options": options,
+			"skip_existing": skip_existing,
+			"persistent_cellpose": persistent_cellpose,
+			"image_paths": shard,
+			"summary_path": os.path.join(job_dir, "worker_{}_summary.csv".format(worker+1))
+		}
+		job_path = os.path.join(job_dir, "worker_{}_job.json".format(worker+1))
+		with open(job_path, "w") as job_file:
+			json.dump(job, job_file)
+		command = [fiji, "--headless", "--console"]
+		if memory_per_worker:
+			command.append("--mem={}".format(memory_per_worker))
+		command.extend(["--run", worker_script, "job_path='{}'".format(job_path)])
+		log_file = open(os.path.join(job_dir, "worker_{}.log".format(worker+1)), "w")
+		workers.append((subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT), log_file, job))
+
+	start = time.time()
+	running = len(workers)
+	while running:
+		time.sleep(poll_seconds)
+		running = sum(1 for process, _, _ in workers if process.poll() is None)
+		IJ.showStatus("FiberSight batch: {} of {} workers running".format(running, len(workers)))
+	IJ.log("All workers finished in {:.1f} seconds".format(time.time() - start))
+
+	summary = []
+	for worker, (process, log_file, job) in enumerate(workers):
+		log_file.close()
+		if os.path.exists(job["summary_path"]):
+			header, rows = read_csv_rows(job["summary_path"])
+			summary.extend(OrderedDict(zip(header, row)) for row in rows)
+		else: # The worker JVM died before writing its summary
+			IJ.log("ERROR: worker {} exited with code {}, see {}".format(worker+1, process.returncode, log_file.name))
+			for image_path in job["image_paths"]:
+				summary.append(OrderedDict([("Image", os.path.basename(image_path)), ("Status", "Failed"), ("Fibers", 0), ("Seconds", 0), \
+				("Error", "Worker exited with code {}".format(process.returncode))]))
+
+	make_directories(experiment_dir, "results")
+	summary_path = os.path.join(experiment_dir, "results", "batch_summary_{}.csv".format(timestamp))
+	write_summary(summary, summary_path)
+	merged_path = os.path.join(experiment_dir, "results", "combined_results_{}.csv".format(timestamp))
+	n_merged = merge_results(image_paths, merged_path)
+	statuses = [row["Status"] for row in summary]
+	IJ.log("### Batch complete: {} analyzed, {} skipped, {} failed ###".format(statuses.count("Done"), statuses.count("Skipped"), statuses.count("Failed")))
+	IJ.log("Batch summary saved to {}\nResults of {} images combined in {}".format(summary_path, n_merged, merged_path))
+	return summary
@@ -0,0 +1,85 @@
+from ij import IJ
+from java.lang import Runtime
+from java.lang.management import ManagementFactory
+from contextlib import contextmanager
+from collections import OrderedDict
+from datetime import datetime
+import json, time
+
+STAGE_COLUMNS = ["Image", "Stage", "Parent", "Wall_s", "CPU_s", "Heap_Before_MB", "Heap_After_MB", "Heap_Delta_MB"]
+
+def heap_used_mb():
+	runtime = Runtime.getRuntime()
+	return (runtime.totalMemory() - runtime.freeMemory()) / 1048576.0
+
+def cpu_seconds():
+	"""CPU time of the whole JVM (every thread), or of the current thread if the JVM doesn't report it"""
+	try:
+		return ManagementFactory.getOperatingSystemMXBean().getProcessCpuTime() / 1e9
+	except Exception:
+		return ManagementFactory.getThreadMXBean().getCurrentThreadCpuTime() / 1e9
+
+class StageProfiler:
+	"""
+	Records the wall time, CPU time and JVM heap use of each stage of an analysis, with counts of what the stage produced.
+
+	Stages are timed with `with profiler.stage("cellpose") as stage:`, and counts are added to the yielded dict
+	(e.g. stage["fibers"] = 512). Stages can be nested; a nested stage's time is also part of its parent's.
+	"""
+
+	def __init__(self, image_name=None):
+		self.image_name = image_name
+		self.started = datetime.now()
+		self.start_time = time.time()
+		self.stages = []
+		self.open_stages = []
+
+	@contextmanager
+	def stage(self, name):
+		counts = OrderedDict()
+		parent = self.open_stages[-1] if self.open_stages else ""
+		self.open_stages.append(name)
+		heap_before, wall_start, cpu_start = heap_used_mb(), time.time(), cpu_seconds()
+		try:
+			yield counts
+		finally:
+			wall, cpu, heap_after = time.time() - wall_start, cpu_seconds() - cpu_start, heap_used_mb()
+			self.open_stages.pop()
+			self.stages.append(OrderedDict([("Image", self.image_name), ("Stage", name), ("Parent", parent), \
+			("Wall_s", round(wall, 3)), ("CPU_s", round(cpu, 3)), ("Heap_Before_MB", round(heap_before, 1)), \
+			("Heap_After_MB", round(heap_after, 1)), ("Heap_Delta_MB", round(heap_after - heap_before, 1)), ("counts", counts)]))
+
+	def get_stage(self, name):
+		for stage in self.stages:
+			if stage["Stage"] == name:
+				return stage
+		return None
+
+	def count_columns(self):
+		columns = []
+		for stage in self.stages:
+			columns.extend(key for key in stage["counts"] if key not in columns)
+		return columns
+
+	def save(self, json_path, csv_path=None):
+		"""
+		Writes the stages as JSON, and as a CSV with one row per stage and one column per count.
+		"""
+		profile = OrderedDict([("image", self.image_name), ("started", self.started.isoformat()), \
+		("total_seconds", round(time.time() - self.start_time, 3)), ("stages", self.stages)])
+		with open(json_path, "w") as json_file:
+			json.dump(profile, json_file, indent=2)
+		if csv_path is not None:
+			count_columns = self.count_columns()
+			with open(csv_path, "w") as csv_file:
+				csv_file.write(",".join(STAGE_COLUMNS + count_columns) + "\n")
+				for stage in self.stages:
+					values = [stage[column] for column in STAGE_COLUMNS] + [stage["counts"].get(column, "") for column in count_columns]
+					csv_file.write(",".join('"{}"'.format(value) if column == "Image" else str(value) \
+					for column, value in zip(STAGE_COLUMNS + count_columns, values)) + "\n")
+		IJ.log("Stage timings saved to {}".format(json_path))
+		return json_path
+
+	def log_summary(self):
+		for stage in self.stages:
+			IJ.log("- {}{}: {:.2f} s wall, {:.2f} s CPU, heap {:+.0f} MB".format("  " if stage["Parent"] else "", stage["Stage"], stage["Wall_s"], stage["CPU_s"], stage["Heap_Delta_MB"]))
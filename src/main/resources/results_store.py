@@ -0,0 +1,108 @@
+from ij import IJ
+from ij.measure import ResultsTable
+from java.awt import GraphicsEnvironment
+from array import array
+from jarray import array as java_array
+from collections import OrderedDict
+import csv, math
+
+# Columns of a FiberSight analysis, in the order they're written
+RESULT_COLUMNS = ["Label", "Area", "MinFeret", "Central Nuclei", "Peripheral Nuclei", "Total Nuclei", \
+"Type I_%-Area", "Type IIa_%-Area", "Type IIx_%-Area", "Type IIb_%-Area", "Fiber_Type"]
+ANALYSIS_COLUMNS = {
+	"Morph": ["Area", "MinFeret"],
+	"CN": ["Central Nuclei", "Peripheral Nuclei", "Total Nuclei"],
+	"FT": ["Type I_%-Area", "Type IIa_%-Area", "Type IIx_%-Area", "Type IIb_%-Area", "Fiber_Type"]
+}
+
+def has_gui():
+	return not GraphicsEnvironment.isHeadless() and IJ.getInstance() is not None
+
+def format_value(value):
+	"""Formats a value for a results CSV, with floats to 3 decimals as ImageJ saves them"""
+	if isinstance(value, float):
+		if math.isnan(value):
+			return "NaN"
+		return "{:.3f}".format(value)
+	return str(value)
+
+class ResultsStore:
+	"""
+	Per-fiber results held as typed columns, independent of ImageJ's shared "Results" table.
+
+	Integer columns are stored in int arrays, other numbers in double arrays, and anything else (labels, fiber types)
+	as lists. The store is saved as a CSV in ImageJ's layout (with a row-number column) in one buffered write, and
+	only copied into a ResultsTable to be shown, so concurrent analyses never share a table.
+	"""
+
+	def __init__(self):
+		self.columns = OrderedDict()
+
+	@classmethod
+	def from_results_dict(cls, results_dict, Morph=False, CN=False, FT=False):
+		"""
+		Collects the columns of the enabled analyses from a results dict, in the order of RESULT_COLUMNS.
+		Values can be sequences, or dicts keyed by row.
+		"""
+		store = cls()
+		enabled = [column for analysis, flag in [("Morph", Morph), ("CN", CN), ("FT", FT)] if flag for column in ANALYSIS_COLUMNS[analysis]]
+		for column in RESULT_COLUMNS:
+			if results_dict.get(column) is not None and (column == "Label" or column in enabled):
+				values = results_dict[column]
+				store.set_column(column, [values[i] for i in range(len(values))] if isinstance(values, dict) else values)
+		return store
+
+	def __len__(self):
+		return len(self.columns.values()[0]) if self.columns else 0
+
+	def set_column(self, name, values):
+		values = list(values)
+		if self.columns and len(values) != len(self):
+			raise ValueError("Column {} has {} values, but there are {} rows".format(name, len(values), len(self)))
+		if all(isinstance(value, (int, long)) and not isinstance(value, bool) for value in values):
+			self.columns[name] = array('i', values)
+		elif all(isinstance(value, (int, long, float)) and not isinstance(value, bool) for value in values):
+			self.columns[name] = array('d', values)
+		else:
+			self.columns[name] = [value if isinstance(value, basestring) else str(value) for value in values]
+		return self.columns[name]
+
+	def get_column(self, name):
+		return self.columns[name]
+
+	def rows(self):
+		columns = self.columns.values()
+		for row in range(len(self)):
+			yield [str(row+1)] + [format_value(column[row]) for column in columns]
+
+	def save(self, csv_path):
+		with open(csv_path, "wb", 1 << 20) as results_file:
+			writer = csv.writer(results_file)
+			writer.writerow([" "] + self.columns.keys())
+			writer.writerows(self.rows())
+		IJ.log("Results saved to {}".format(csv_path))
+		return csv_path
+
+	def to_results_table(self, rt=None):
+		"""
+		Copies the columns into a ResultsTable (a new one unless given, which is cleared first), setting numeric columns whole.
+		"""
+		rt = ResultsTable() if rt is None else rt
+		rt.reset()
+		for _ in range(len(self)):
+			rt.incrementCounter()
+		for name, values in self.columns.items():
+			if isinstance(values, array):
+				rt.setValues(name, java_array(values, 'd'))
+			else:
+				for row, value in enumerate(values):
+					rt.setValue(name, row, value)
+		return rt
+
+	def show(self, title="Results"):
+		"""Shows the results in a ResultsTable window, unless there is no GUI. Returns the table, or None."""
+		if not has_gui():
+			return None
+		rt = self.to_results_table()
+		rt.show(title)
+		return rt
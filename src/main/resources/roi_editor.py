@@ -15,6 +15,9 @@ class ManualRoiEditor:
 		self.imp = read_image(image_path)
 		self.rm = RoiManager().getRoiManager()
 		self.original_roi_path = self.namer.get_path(analysis_type) if not roi_path else roi_path
+		self.source_roi_path = self.original_roi_path
+		if analysis_type == "manual_rois" and not os.path.exists(self.original_roi_path) and os.path.exists(self.namer.fiber_roi_path):
+			self.source_roi_path = self.namer.fiber_roi_path # The first edit starts from the Cellpose fibers, keeping their fiber IDs
 
 		self.imp.show()
 		
@@ -39,9 +42,9 @@ class ManualRoiEditor:
 		Args:
 		    new_save_location: False to save in place, or string path for new save location
 		"""
-		if self.original_roi_path and os.path.exists(self.original_roi_path):
-			IJ.log("Loading existing ROIs from {}".format(self.original_roi_path))
-			self.rm.open(self.original_roi_path)
+		if self.source_roi_path and os.path.exists(self.source_roi_path):
+			IJ.log("Loading existing ROIs from {}".format(self.source_roi_path))
+			self.rm.open(self.source_roi_path)
 			self.rm.runCommand("Show All with Labels")
 			self.rm.select(0)
 			roiWait = WaitForUserDialog("Edit ROIs", "Edit ROIs as needed, then hit OK")
@@ -5,12 +5,15 @@
 #@ File(label='local roipath') rp
 
 from ij import IJ, ImagePlus
-from ij.io import Opener, RoiDecoder
+from ij.io import Opener, RoiDecoder, RoiEncoder
 from ij.plugin.frame import RoiManager
-from java.util.zip import ZipInputStream
-from java.io import FileInputStream, ByteArrayOutputStream, IOException
+from ij.gui import Roi
+from ij.process import ShortProcessor, FloatProcessor
+from java.util.zip import ZipFile, ZipOutputStream, ZipEntry
+from java.io import DataInputStream, FileOutputStream, BufferedOutputStream, ByteArrayOutputStream, IOException
 from java.lang import Byte
-import sys
+from java.util import Arrays
+import sys, math
 from jarray import zeros
 from jy_tools import attrs
 
@@ -23,55 +26,185 @@ def create_roi_manager_from_ROIs(roiArray, imp=None):
 		rm.add(imp, roi, enum)
 	return rm
 
-def read_rois(roi_path):
+def iter_rois(roi_path, roi_filter=None):
 	"""
-	Reads ROIs from .zip and .roi files, and returns a list of ROIs.
+	Yields the ROIs of a .zip or .roi file one at a time, without building a list or a ROI manager.
 	
+	Zip entries are read with random access, each into a single buffer sized from the entry, then decoded.
+	If given, roi_filter(roi) decides which ROIs are yielded.
 	Heavily inspired from here:
 	https://github.com/imagej/ImageJ/blob/63544dae5bdb3f1d073d2ac2cf9bd3296e0dbe78/ij/plugin/frame/RoiManager.java#L845
 	"""
 	if roi_path.endswith(".roi"):
-		return [Opener().openRoi(roi_path)]
-	rois = []
-	z=None
+		roi = Opener().openRoi(roi_path)
+		if roi is not None and (roi_filter is None or roi_filter(roi)):
+			yield roi
+		return
 	try:
-		z = ZipInputStream(FileInputStream(roi_path))
-		buf = zeros(1024, "b") # I believe this is the right way to create a java byte array
-		entry = z.getNextEntry()
-		while entry is not None:
-			name = entry.getName()
-			if name.endswith(".roi"):
-				out = ByteArrayOutputStream()
-				bytes_read = z.read(buf)
-				while (bytes_read > 0):
-					out.write(buf, 0, bytes_read)
-					bytes_read = z.read(buf)
-				bytes_data = out.toByteArray()
-				roi = RoiDecoder(bytes_data, name).getRoi()
-				if roi is not None:
-					rois.append(roi)				
-				out.close()
-			entry = z.getNextEntry()
-		return(rois)
+		z = ZipFile(roi_path)
 	except IOException as e:
 		raise IOException("Could not read ROIs from {}: {}".format(roi_path, e))
+	try:
+		entries = z.entries()
+		while entries.hasMoreElements():
+			entry = entries.nextElement()
+			name = entry.getName()
+			if not name.endswith(".roi"):
+				continue
+			stream = z.getInputStream(entry)
+			try:
+				if entry.getSize() >= 0:
+					bytes_data = zeros(entry.getSize(), "b")
+					DataInputStream(stream).readFully(bytes_data)
+				else: # Size isn't recorded in the zip, so read in large chunks
+					out = ByteArrayOutputStream()
+					buf = zeros(1 << 16, "b")
+					bytes_read = stream.read(buf)
+					while bytes_read > 0:
+						out.write(buf, 0, bytes_read)
+						bytes_read = stream.read(buf)
+					bytes_data = out.toByteArray()
+			finally:
+				stream.close()
+			roi = RoiDecoder(bytes_data, name).getRoi()
+			if roi is not None and (roi_filter is None or roi_filter(roi)):
+				yield roi
+	finally:
+		z.close()
+
+def read_rois(roi_path, roi_filter=None):
+	"""
+	Reads ROIs from .zip and .roi files, and returns a list of ROIs.
+	"""
+	return list(iter_rois(roi_path, roi_filter))
+
+def open_rois(roi_path, rm=None, roi_filter=None):
+	"""
+	Streams the ROIs of a file into a ROI manager (the shared one unless given), and returns the ROI manager.
+	"""
+	rm = RoiManager().getRoiManager() if rm is None else rm
+	for enum, roi in enumerate(iter_rois(roi_path, roi_filter)):
+		rm.add(None, roi, enum)
+	return rm
+
+def write_rois(rois, roi_path):
+	"""
+	Writes ROIs to a .zip file in the same format as the ROI manager, without needing one.
+	"""
+	z = ZipOutputStream(BufferedOutputStream(FileOutputStream(roi_path)))
+	try:
+		for enum, roi in enumerate(rois):
+			z.putNextEntry(ZipEntry("{:05d}.roi".format(enum+1)))
+			z.write(RoiEncoder.saveAsByteArray(roi))
+			z.closeEntry()
 	finally:
-		if z is not None:
-			z.close()
+		z.close()
+	return roi_path
+
+POLYGON_TYPES = (Roi.POLYGON, Roi.FREEROI, Roi.TRACED_ROI)
+
+def is_polygonal(roi):
+	"""Checks if an ROI's area is exactly its polygon, so it can be scan-converted"""
+	return roi.getType() in POLYGON_TYPES or (roi.getType() == Roi.RECTANGLE and roi.getCornerDiameter() == 0)
 
-def R2L(image, rois=None):
+def build_edge_table(rois, height):
 	"""
-	Converts ROIs to labels without interfacing with the ROImanager. Code modified from:
+	Buckets the edges of every polygonal ROI by the first scanline they cross, for `rasterize_rois`.
+	
+	Scanlines are sampled at pixel centres (y+0.5), and each edge is stored as (last scanline + 1, x at its first scanline, dx per scanline, label).
+	Any other ROI (ovals, composites...) is converted to spans from its mask: (label, start, end) per scanline.
+	"""
+	edge_table = [[] for _ in range(height)]
+	mask_spans = {}
+	for enum, roi in enumerate(rois):
+		label = enum+1
+		if not is_polygonal(roi):
+			mask = roi.getMask()
+			bounds = roi.getBounds()
+			for row in range(max(0, -bounds.y), min(bounds.height, height - bounds.y)):
+				inside = False
+				for col in range(bounds.width + 1):
+					filled = col < bounds.width and (mask is None or mask.get(col, row) != 0)
+					if filled and not inside:
+						start, inside = col, True
+					elif inside and not filled:
+						mask_spans.setdefault(bounds.y + row, []).append((label, bounds.x + start, bounds.x + col))
+						inside = False
+			continue
+		polygon = roi.getFloatPolygon()
+		xs, ys, n_points = polygon.xpoints, polygon.ypoints, polygon.npoints
+		for i in range(n_points):
+			x0, y0, x1, y1 = xs[i], ys[i], xs[(i+1) % n_points], ys[(i+1) % n_points]
+			if y0 == y1:
+				continue # Horizontal edges never cross a scanline
+			if y0 > y1:
+				x0, y0, x1, y1 = x1, y1, x0, y0
+			first = max(0, int(math.ceil(y0 - 0.5)))
+			end = min(height, int(math.ceil(y1 - 0.5)))
+			if first >= end:
+				continue
+			dxdy = (x1 - x0) / (y1 - y0)
+			edge_table[first].append((end, x0 + (first + 0.5 - y0)*dxdy, dxdy, label))
+	return edge_table, mask_spans
+
+def rasterize_rois(rois, width, height, bit_depth=None, label_ip=None):
+	"""
+	Scan-converts ROIs into a label ImageProcessor in a single pass over the scanlines, without an ImagePlus or ROI masks.
+	
+	ROI i is labelled i+1, and later ROIs overwrite earlier ones where they overlap, as with `ImageProcessor.fill(roi)`.
+	A pixel belongs to a polygon if its centre is inside it (even-odd rule).
+	Labels are 16-bit unless there are more ROIs than a 16-bit image can label, or a 32-bit image is requested.
+	An existing label processor can be given as `label_ip` to be cleared and reused, e.g. for successive erosions of the same fibers.
+	"""
+	rois = list(rois)
+	if label_ip is not None:
+		bit_depth = label_ip.getBitDepth()
+		Arrays.fill(label_ip.getPixels(), 0 if bit_depth == 16 else 0.0)
+	else:
+		if bit_depth is None:
+			bit_depth = 16 if len(rois) <= 65535 else 32
+		label_ip = ShortProcessor(width, height) if bit_depth == 16 else FloatProcessor(width, height)
+	pixels = label_ip.getPixels()
+	if bit_depth == 16:
+		fill_value = lambda label: label if label < 32768 else label - 65536 # Stored as signed shorts
+	else:
+		fill_value = float
+	edge_table, mask_spans = build_edge_table(rois, height)
+	active = []
+	for y in range(height):
+		active = [edge for edge in active if edge[0] > y] + edge_table[y]
+		crossings = []
+		for index, (end, x, dxdy, label) in enumerate(active):
+			crossings.append((label, x))
+			active[index] = (end, x + dxdy, dxdy, label)
+		crossings.sort()
+		spans = [(crossings[i][0], int(math.ceil(crossings[i][1] - 0.5)), int(math.ceil(crossings[i+1][1] - 0.5))) \
+		for i in range(0, len(crossings) - 1, 2)]
+		if y in mask_spans:
+			spans = sorted(spans + mask_spans[y], key=lambda span: span[0]) # Keeps each ROI's drawing order
+		row = y*width
+		for label, start, end in spans:
+			start, end = max(0, start), min(width, end)
+			if start < end:
+				Arrays.fill(pixels, row + start, row + end, fill_value(label))
+	label_ip.resetMinAndMax()
+	return label_ip
+
+def R2L(image, rois=None, output_bit_depth=None):
+	"""
+	Converts ROIs to labels without interfacing with the ROImanager, using `rasterize_rois`. Originally modified from:
 	https://github.com/BIOP/ijp-LaRoMe/blob/master/src/main/java/ch/epfl/biop/ij2command/Rois2Labels.java
+	
+	Labels are 16-bit unless there are more ROIs than a 16-bit image can label, in which case a 32-bit image is made.
 	"""
 	width = image.getWidth()
 	height = image.getHeight()
 	depth = image.getNSlices()
-	output_bit_depth = 16
-	label_imp = IJ.createImage("Label Image", width, height, depth, output_bit_depth)
-	for enum, roi in enumerate(rois):
-		label_imp.getProcessor().setValue(enum+1)
-		label_imp.getProcessor().fill(rois[enum])
+	label_ip = rasterize_rois(rois, width, height, output_bit_depth)
+	if depth == 1:
+		return ImagePlus("Label Image", label_ip)
+	label_imp = IJ.createImage("Label Image", width, height, depth, label_ip.getBitDepth())
+	label_imp.getStack().setProcessor(label_ip, 1)
 	return label_imp
 
 if __name__ == "__main__":
@@ -10,7 +10,7 @@
 ''' Cellpose Autoprocessor. 
 1) Loads in a directory
 2) Creates a directory for ROIs if one doesn't exist
-3) Processes all images using sensible defaults for cellpose
+3) Processes all images using sensible defaults for cellpose, with one Cellpose process that keeps the model loaded
 '''
 
 import os
@@ -33,14 +33,17 @@ def main():
 								do_recursive
 								)
 	
-	for image_path in image_paths:
-		namer = FileNamer(image_path)
-		save_rois = "True" # Required for boolean parameter passing "True", rather than as python's True as "1".
-		runner = CellposeRunner(model_name=model, segmentation_channel=seg_chan, diameter=cellpose_diam)
-		runner.set_image(image_path)
-		runner.run_cellpose()
-		runner.save_rois(namer.fiber_roi_path)
-		runner.clean_up()
+	worker = CellposeRunner(model_name=model).create_worker()
+	try:
+		for image_path in image_paths:
+			namer = FileNamer(image_path)
+			runner = CellposeRunner(model_name=model, segmentation_channel=seg_chan, diameter=cellpose_diam, worker=worker)
+			runner.set_image(image_path)
+			runner.run_cellpose()
+			runner.save_rois(namer.fiber_roi_path)
+			runner.clean_up()
+	finally:
+		worker.close()
 		
 	IJ.log("Done!")
 
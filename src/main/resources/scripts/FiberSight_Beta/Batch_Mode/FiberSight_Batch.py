@@ -0,0 +1,47 @@
+#@ String (value="Select an experiment directory containing a 'raw' folder of images", visibility=MESSAGE, required=false) doc
+#@ File (label="Experiment directory", style="directory") experiment_dir
+#@ String (label = "Channel 1", choices={"Fiber Border", "Type I", "Type IIa", "Type IIx", "Type IIb", "DAPI", "None"}, style="dropdown", value="None") c1
+#@ String (label = "Channel 2", choices={"Fiber Border", "Type I", "Type IIa", "Type IIx", "Type IIb", "DAPI", "None"}, style="dropdown", value="None") c2
+#@ String (label = "Channel 3", choices={"Fiber Border", "Type I", "Type IIa", "Type IIx", "Type IIb", "DAPI", "None"}, style="dropdown", value="None") c3
+#@ String (label = "Channel 4", choices={"Fiber Border", "Type I", "Type IIa", "Type IIx", "Type IIb", "DAPI", "None"}, style="dropdown", value="None") c4
+#@ String (label="Cellpose Model", choices={"cyto3", "WGA_21", "PSR_9", "HE_30"}, style="radioButtonHorizontal", value="cyto3") cellpose_model
+#@ Integer (label="Cellpose Diameter", min=0, max=200, value=0) cellpose_diam
+#@ String (label = "Threshold Method", choices={"Mean", "Otsu", "Huang"}, style="radioButtonHorizontal", value="Mean") threshold_method
+#@ Boolean (label="Pseudo flat-field correction?", value=False) flat_field
+#@ Boolean (label="Assess hybrid fibers?", value=True) assess_hybrid
+#@ Boolean (label="Remove small fibers?", value=True) remove_small
+#@ Boolean (label="Overwrite existing fiber ROIs?", value=False) overwrite_rois
+#@ Boolean (label="Skip images with existing results?", value=False) skip_existing
+#@ Integer (label="Parallel workers", description="<html>Number of Fiji processes analyzing images at once. 1 runs every image in this session</html>", min=1, max=64, value=1) n_workers
+#@ String (label="Memory per worker", description="<html>Maximum memory of each parallel worker, e.g. 8g. Leave empty for the Fiji default</html>", value="") worker_memory
+
+'''
+Headless FiberSight batch processor. Runs segmentation, border exclusion, morphology, central nucleation
+and fiber-typing on every image in an experiment's 'raw' folder, e.g.
+
+fiji --headless --run FiberSight_Batch.py "experiment_dir='/data/exp1',c1='Fiber Border',c2='Type I',c3='Type IIa',c4='DAPI'"
+
+Unset parameters take the defaults above. With n_workers > 1, each worker is a separate headless Fiji process,
+and the per-image results are combined into a single results file at the end.
+'''
+
+from ij import IJ
+from batch_runner import run_experiment
+from parallel_batch import run_parallel_experiment
+
+if __name__ in ['__builtin__','__main__']:
+	options = {
+		"cellpose_model": cellpose_model,
+		"cellpose_diam": cellpose_diam,
+		"threshold_method": threshold_method,
+		"image_correction": "pseudo_flat_field" if flat_field else False,
+		"assess_hybrid": bool(assess_hybrid),
+		"remove_small_fibers": bool(remove_small),
+		"overwrite_rois": bool(overwrite_rois)
+	}
+	if n_workers > 1:
+		run_parallel_experiment(experiment_dir.getPath(), [c1, c2, c3, c4], options=options, n_workers=n_workers, \
+		memory_per_worker=worker_memory or None, skip_existing=bool(skip_existing))
+	else:
+		run_experiment(experiment_dir.getPath(), [c1, c2, c3, c4], options=options, skip_existing=bool(skip_existing))
+	IJ.log("Done!")
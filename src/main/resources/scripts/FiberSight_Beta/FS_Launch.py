@@ -4,6 +4,7 @@ from ij.measure import ResultsTable
 from ij.plugin.frame import RoiManager
 from FiberSight import FiberSight
 from jy_tools import attrs, reload_modules, closeAll
+from roi_utils import open_rois
 from image_tools import read_image, detectMultiChannel, getMyosightParameters, runMyosightSegment, loadMicroscopeImage
 import os, sys
 import java.lang.System
@@ -75,7 +76,7 @@ if __name__ in ['__builtin__','__main__']:
 	if roi_path == '':		
 		rm_fiber.show()
 	else:
-		rm_fiber.open(roi_path)
+		open_rois(roi_path, rm_fiber)
 		SEGMENT_FIBERS = False
 		
 	IJ.run("Set Measurements...", "area feret's display add redirect=None decimal=3");
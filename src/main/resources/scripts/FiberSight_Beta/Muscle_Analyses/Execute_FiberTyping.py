@@ -13,6 +13,7 @@ from ij.measure import ResultsTable
 from datetime import datetime
 from jy_tools import closeAll, saveFigure, list_files, match_files, make_directories
 from image_tools import renameChannels, generate_ft_results
+from roi_utils import open_rois
 
 IJ.log("\n### Starting Muscle Fiber Typing Analysis ###")
 
@@ -65,8 +66,7 @@ for enum, (raw, roi) in enumerate(matched_files):
 	figure_path = os.path.join(figure_dir, sample_name)
 	mask_path = os.path.join(mask_dir, sample_name)
 	
-	rm_fiber = RoiManager()
-	rm_fiber.open(roi_path)
+	rm_fiber = open_rois(roi_path, RoiManager())
 	print("\n### Running Sample: {} ###".format(sample_name))
 
 	biostring = "open=" + raw_path +  " autoscale color_mode=Default rois_import=[ROI manager] view=Hyperstack split_channels stack_order=XYCZT"
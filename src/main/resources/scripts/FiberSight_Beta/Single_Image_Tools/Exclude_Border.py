@@ -8,7 +8,7 @@ from ij import IJ
 import os
 from jy_tools import attrs, closeAll
 from remove_edge_labels import ROI_border_exclusion, open_exclusion_files
-from image_tools import convertLabelsToROIs
+from ij.plugin.frame import RoiManager
 
 def main():
 	IJ.log("\n### Processing Image: {} ###".format(raw_image_path.getName()))
@@ -17,10 +17,13 @@ def main():
 	print(raw_image_path.getPath())
 	
 	imp_base, border_roi, rm_fibers = open_exclusion_files(raw_image_path.getPath(), border_roi_path.getPath(), fiber_roi_path.getPath())
-	edgeless, base_image = ROI_border_exclusion(imp_base, border_roi, rm_fibers, separate_rois=separate_rois, GPU=gpu)
-	rm = convertLabelsToROIs(edgeless)
-	rm_fibers.show()
-	IJ.log("Number of ROIs After Edge Removal: {}".format(rm.getCount()))
+	edgeless, overlay_image, surviving_rois = ROI_border_exclusion(imp_base, border_roi, rm_fibers, separate_rois=separate_rois, GPU=gpu)
+	edgeless.show()
+	overlay_image.show()
+	rm = RoiManager().getRoiManager()
+	rm.reset()
+	for roi in surviving_rois:
+		rm.addRoi(roi)
 
 if __name__ == "__main__":
 	main()
\ No newline at end of file
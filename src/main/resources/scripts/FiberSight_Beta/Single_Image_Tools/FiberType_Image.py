@@ -27,6 +27,7 @@ from image_tools import renameChannels, generate_ft_results, detectMultiChannel,
 remove_small_rois, pickImage, calculateDist, findNdistances, findInNearestFibers, watershedParticles, \
 drawCatch, mergeChannels,getCentroidPositions, make_results
 from utilities import generate_required_directories, get_drawn_border_roi
+from roi_utils import open_rois
 from ij.plugin import HyperStackConverter
 
 ## Integrity checks ### 
@@ -56,8 +57,7 @@ ft_figure_path = os.path.join(ft_figure_dir, sample_name + "_FiberType")
 cn_figure_path = os.path.join(cn_figure_dir, sample_name + "_CentralNuc")
 ft_mask_path = os.path.join(ft_mask_dir, sample_name)
 
-rm_fiber = RoiManager()
-rm_fiber.open(fiber_rois.getAbsolutePath())
+rm_fiber = open_rois(fiber_rois.getAbsolutePath(), RoiManager())
 
 IJ.log("\n### Running Sample: {} ###".format(sample_name))
 
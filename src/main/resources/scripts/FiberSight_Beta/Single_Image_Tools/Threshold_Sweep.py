@@ -0,0 +1,43 @@
+#@ String (value="Compare the fiber types given by every threshold method, blur radius and proportion threshold", visibility=MESSAGE, required=false) doc
+#@ File (label="Select a segmented image in an experiment's 'raw' folder", style="file") my_image
+#@ String (label = "Channel 1", choices={"Fiber Border", "Type I", "Type IIa", "Type IIx", "Type IIb", "DAPI", "None"}, style="dropdown", value="None") c1
+#@ String (label = "Channel 2", choices={"Fiber Border", "Type I", "Type IIa", "Type IIx", "Type IIb", "DAPI", "None"}, style="dropdown", value="None") c2
+#@ String (label = "Channel 3", choices={"Fiber Border", "Type I", "Type IIa", "Type IIx", "Type IIb", "DAPI", "None"}, style="dropdown", value="None") c3
+#@ String (label = "Channel 4", choices={"Fiber Border", "Type I", "Type IIa", "Type IIx", "Type IIb", "DAPI", "None"}, style="dropdown", value="None") c4
+#@ String (label="Blur radii", description="Comma-separated Gaussian blur sigmas", value="2, 4") blur_radii
+#@ String (label="Proportion thresholds", description="Comma-separated %-Area cut-offs for a channel to mark a fiber", value="30, 40, 50, 60, 70") prop_thresholds
+#@ Boolean (label="Pseudo flat-field correction?", value=False) flat_field
+#@ Boolean (label="Assess hybrid fibers?", value=True) assess_hybrid
+#@ Boolean (label="Remove small fibers?", value=True) remove_small
+
+'''
+Writes a table of the fiber-type distribution given by every auto-threshold method, blur radius and proportion threshold
+to the image's results folder, from one histogram of each fiber per channel and blur radius (see threshold_sweep.py).
+The fibers are the manually edited ROIs if they exist, otherwise the Cellpose ROIs.
+'''
+
+import os
+from ij import IJ
+from analysis_setup import AnalysisSetup
+from file_naming import FileNamer
+from main import default_config, make_stage_graph, filter_fibers
+from threshold_sweep import run_threshold_sweep
+
+def parse_numbers(text):
+	return [float(value) if "." in value else int(value) for value in text.replace(" ", "").split(",") if value]
+
+if __name__ in ['__builtin__','__main__']:
+	image_path = my_image.getPath()
+	namer = FileNamer(image_path)
+	fiber_roi_path = namer.manual_rois_path if os.path.exists(namer.manual_rois_path) else None # Prefer manually edited fibers
+	analysis = AnalysisSetup(image_path, [c1, c2, c3, c4], fiber_roi_path=fiber_roi_path)
+	if analysis.rm_fiber is None:
+		IJ.error("No fiber ROIs found for {}, segment the image first".format(namer.image_name))
+	elif not analysis.FT:
+		IJ.error("At least one fiber-type channel is needed")
+	else:
+		config = default_config(analysis, image_correction="pseudo_flat_field" if flat_field else False, \
+		assess_hybrid=bool(assess_hybrid), remove_small_fibers=bool(remove_small))
+		filter_fibers(analysis, config, make_stage_graph(analysis, config))
+		run_threshold_sweep(analysis, config, blur_radii=parse_numbers(blur_radii), prop_thresholds=parse_numbers(prop_thresholds))
+		IJ.log("Done!")
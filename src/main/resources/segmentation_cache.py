@@ -0,0 +1,137 @@
+from ij import IJ
+from java.security import MessageDigest
+from java.nio import ByteBuffer
+from java.lang import String
+from java.io import FileInputStream
+from jarray import zeros
+import os, json, uuid
+from roi_utils import read_rois, write_rois
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".fibersight", "segmentation_cache")
+_model_hashes = {} # (path, size, mtime) -> sha256, so weights are only hashed once per session
+
+def hash_file(file_path):
+	file_stat = os.stat(file_path)
+	stamp = (file_path, file_stat.st_size, file_stat.st_mtime)
+	if stamp not in _model_hashes:
+		digest = MessageDigest.getInstance("SHA-256")
+		stream = FileInputStream(file_path)
+		buffer = zeros(1 << 20, 'b')
+		try:
+			n_read = stream.read(buffer)
+			while n_read > 0:
+				digest.update(buffer, 0, n_read)
+				n_read = stream.read(buffer)
+		finally:
+			stream.close()
+		_model_hashes[stamp] = "".join("{:02x}".format(b & 0xff) for b in digest.digest())
+	return _model_hashes[stamp]
+
+def hash_pixels(digest, ip):
+	"""Adds the pixels of an ImageProcessor to a MessageDigest"""
+	pixels = ip.getPixels()
+	if ip.getBitDepth() == 8:
+		digest.update(pixels)
+		return
+	item_size = 2 if ip.getBitDepth() == 16 else 4
+	buffer = ByteBuffer.allocate(item_size * ip.getPixelCount())
+	if ip.getBitDepth() == 16:
+		buffer.asShortBuffer().put(pixels)
+	elif ip.getBitDepth() == 24:
+		buffer.asIntBuffer().put(pixels)
+	else:
+		buffer.asFloatBuffer().put(pixels)
+	digest.update(buffer.array())
+
+def image_key(imp, settings):
+	"""
+	Returns a sha256 key from the pixels that Cellpose would see (every channel of the current plane) and the segmentation settings.
+	"""
+	digest = MessageDigest.getInstance("SHA-256")
+	description = dict(settings, width=imp.getWidth(), height=imp.getHeight(), bit_depth=imp.getBitDepth(), \
+	channels=imp.getNChannels(), cache_version=CACHE_VERSION)
+	digest.update(String(json.dumps(description, sort_keys=True)).getBytes("UTF-8"))
+	stack = imp.getStack()
+	for channel in range(1, imp.getNChannels()+1):
+		hash_pixels(digest, stack.getProcessor(imp.getStackIndex(channel, imp.getZ(), imp.getT())))
+	return "".join("{:02x}".format(b & 0xff) for b in digest.digest())
+
+class SegmentationCache:
+	"""
+	Content-addressed store of Cellpose segmentations, kept as ROI set .zip files named by their key.
+
+	Keys hash the image pixels together with every setting that changes the segmentation, so any earlier
+	segmentation of the same pixels with the same settings is found again, whatever the file is called.
+	The store is bounded to `max_bytes`; the least recently used segmentations are evicted first.
+	"""
+
+	def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=1 << 30):
+		self.cache_dir = cache_dir
+		self.max_bytes = max_bytes
+		if not os.path.exists(self.cache_dir):
+			os.makedirs(self.cache_dir)
+
+	def get_path(self, key):
+		return os.path.join(self.cache_dir, key + ".zip")
+
+	def get(self, key):
+		"""
+		Returns the cached ROIs for a key, or None on a miss
+		"""
+		cache_path = self.get_path(key)
+		if not os.path.exists(cache_path):
+			return None
+		try:
+			rois = read_rois(cache_path)
+		except Exception as e:
+			IJ.log("Discarding unreadable cached segmentation {}: {}".format(cache_path, e))
+			self.remove(key)
+			return None
+		os.utime(cache_path, None) # Marks the entry as recently used
+		return rois
+
+	def put(self, key, rois):
+		"""
+		Stores a segmentation, then evicts the least recently used entries beyond the size limit.
+		"""
+		temp_path = os.path.join(self.cache_dir, "{}.{}.tmp".format(key, uuid.uuid4().hex))
+		write_rois(rois, temp_path)
+		cache_path = self.get_path(key)
+		if os.path.exists(cache_path):
+			os.remove(cache_path)
+		os.rename(temp_path, cache_path) # Readers in other processes never see a partly written file
+		self.evict()
+		return cache_path
+
+	def remove(self, key):
+		cache_path = self.get_path(key)
+		if os.path.exists(cache_path):
+			os.remove(cache_path)
+
+	def entries(self):
+		"""Returns (last use, size, path) of every cached segmentation, least recently used first"""
+		entries = []
+		for file_name in os.listdir(self.cache_dir):
+			if file_name.endswith(".zip"):
+				file_path = os.path.join(self.cache_dir, file_name)
+				file_stat = os.stat(file_path)
+				entries.append((file_stat.st_mtime, file_stat.st_size, file_path))
+		return sorted(entries)
+
+	def evict(self):
+		entries = self.entries()
+		total_bytes = sum(size for _, size, _ in entries)
+		for _, size, file_path in entries:
+			if total_bytes <= self.max_bytes:
+				break
+			try:
+				os.remove(file_path)
+				total_bytes -= size
+			except OSError:
+				pass # Already evicted by another process
+		return total_bytes
+
+	def clear(self):
+		for _, _, file_path in self.entries():
+			os.remove(file_path)
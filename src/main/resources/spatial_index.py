@@ -0,0 +1,87 @@
+from math import sqrt, ceil
+from heapq import nsmallest
+
+class CentroidGrid:
+	"""
+	Uniform-grid spatial index over a set of (x, y) centroids.
+
+	The grid is built once per image (usually over the fiber centroids), and then answers
+	k-nearest queries by searching outwards ring-by-ring from the query cell. With roughly
+	`points_per_cell` centroids per cell, each query only looks at a handful of cells, so
+	assigning N markers to M fibers costs about O(N + M) rather than O(N*M*log(M)).
+	"""
+
+	def __init__(self, x, y, points_per_cell=2):
+		if len(x) != len(y):
+			raise ValueError("Centroid lists must be the same length: {} x-values, {} y-values".format(len(x), len(y)))
+		self.x = list(x)
+		self.y = list(y)
+		self.n_points = len(self.x)
+		self.cells = {}
+		if self.n_points == 0:
+			self.x_min, self.y_min, self.cell_size = 0.0, 0.0, 1.0
+			self.n_cols, self.n_rows = 1, 1
+			return
+
+		self.x_min, self.y_min = min(self.x), min(self.y)
+		width = max(max(self.x) - self.x_min, 1.0)
+		height = max(max(self.y) - self.y_min, 1.0)
+		n_cells = max(float(self.n_points) / points_per_cell, 1.0)
+		self.cell_size = max(sqrt(width * height / n_cells), 1.0)
+		self.n_cols = int(ceil(width / self.cell_size)) + 1
+		self.n_rows = int(ceil(height / self.cell_size)) + 1
+
+		for index in range(self.n_points):
+			key = self._cell_of(self.x[index], self.y[index])
+			self.cells.setdefault(key, []).append(index)
+
+	def _cell_of(self, x, y):
+		col = int((x - self.x_min) / self.cell_size)
+		row = int((y - self.y_min) / self.cell_size)
+		return (min(max(col, 0), self.n_cols - 1), min(max(row, 0), self.n_rows - 1))
+
+	def _ring(self, col, row, radius):
+		"""Yields the indices of all points in the square ring of cells at `radius` around (col, row)"""
+		if radius == 0:
+			for index in self.cells.get((col, row), []):
+				yield index
+			return
+		for c in range(col - radius, col + radius + 1):
+			for r in (row - radius, row + radius):
+				for index in self.cells.get((c, r), []):
+					yield index
+		for r in range(row - radius + 1, row + radius):
+			for c in (col - radius, col + radius):
+				for index in self.cells.get((c, r), []):
+					yield index
+
+	def nearest(self, x, y, k):
+		"""
+		Returns the indices of the k centroids nearest to (x, y), closest first.
+
+		Ties are broken by index, matching the ordering of `image_tools.findmin`.
+		"""
+		k = min(int(k), self.n_points)
+		if k <= 0:
+			return []
+		col, row = self._cell_of(x, y)
+		max_radius = max(self.n_cols, self.n_rows)
+		candidates = []
+		radius = 0
+		while radius <= max_radius:
+			for index in self._ring(col, row, radius):
+				candidates.append(((x - self.x[index])**2 + (y - self.y[index])**2, index))
+			if len(candidates) >= k:
+				# Any point outside the searched rings is at least `radius` cells away
+				kth_distance = nsmallest(k, candidates)[-1][0]
+				if kth_distance <= (radius * self.cell_size)**2:
+					break
+			radius += 1
+		return [index for _, index in nsmallest(k, candidates)]
+
+	def nearest_many(self, xs, ys, k):
+		"""
+		Batched k-nearest query. Returns a dictionary associating each query position to the
+		indices of its k nearest centroids, in the same format as `image_tools.findNdistances`.
+		"""
+		return dict((loc, self.nearest(xs[loc], ys[loc], k)) for loc in range(len(xs)))
@@ -0,0 +1,192 @@
+from ij import IJ, ImagePlus
+from ij.gui import Roi
+from java.security import MessageDigest
+from java.lang import String
+from collections import OrderedDict, namedtuple
+import os, json, uuid, shutil
+from roi_utils import read_rois, write_rois
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".fibersight", "stage_cache")
+
+# inputs are sources (set on the graph) or other stages, params are analysis configuration keys
+Stage = namedtuple("Stage", ["inputs", "params"])
+
+STAGES = OrderedDict([
+	("border_exclusion", Stage(["image", "fibers", "border"], [])),
+	("nuclei", Stage(["image"], [])),
+	("ft_masks", Stage(["image", "border"], ["blur_radius", "threshold_method", "image_correction"])),
+	("ft_fractions", Stage(["ft_masks", "fibers"], ["ft_area_mode"])),
+])
+
+def hash_text(text):
+	digest = MessageDigest.getInstance("SHA-256")
+	digest.update(String(text).getBytes("UTF-8"))
+	return "".join("{:02x}".format(b & 0xff) for b in digest.digest())
+
+def file_key(file_path, *extra):
+	"""Keys a file by its path, size and modification time (hashing the pixels of a whole slide would cost more than most stages)"""
+	file_stat = os.stat(file_path)
+	return hash_text(json.dumps([os.path.abspath(file_path), file_stat.st_size, int(file_stat.st_mtime)] + list(extra)))
+
+def rois_key(rois):
+	"""Keys ROIs by their types and outlines, in order"""
+	outlines = []
+	for roi in rois:
+		if not roi: # No manual border
+			outlines.append(None)
+			continue
+		polygon = roi.getFloatPolygon()
+		outlines.append([roi.getType()] + ["{:.3f}".format(value) for value in list(polygon.xpoints[:polygon.npoints]) + list(polygon.ypoints[:polygon.npoints])])
+	return hash_text(json.dumps(outlines))
+
+class StageCache:
+	"""
+	Store of stage outputs, one directory per stage and key.
+
+	An output is a dict: ImagePlus values and lists of them are saved as compressed TIFFs, lists of ROIs as ROI sets,
+	and anything else as JSON. Like the segmentation cache, the store is bounded to `max_bytes`, evicting the least recently used outputs.
+	"""
+
+	def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=4 << 30):
+		self.cache_dir = cache_dir
+		self.max_bytes = max_bytes
+		if not os.path.exists(self.cache_dir):
+			os.makedirs(self.cache_dir)
+
+	def get_path(self, stage, key):
+		return os.path.join(self.cache_dir, "{}_{}".format(stage, key))
+
+	def get(self, stage, key):
+		"""
+		Returns the cached output of a stage, or None on a miss
+		"""
+		entry_dir = self.get_path(stage, key)
+		if not os.path.exists(os.path.join(entry_dir, "data.json")):
+			return None
+		try:
+			output = self.read_entry(entry_dir)
+		except Exception as e:
+			IJ.log("Discarding unreadable cached {}: {}".format(stage, e))
+			shutil.rmtree(entry_dir, True)
+			return None
+		os.utime(entry_dir, None) # Marks the entry as recently used
+		return output
+
+	def read_entry(self, entry_dir):
+		with open(os.path.join(entry_dir, "data.json")) as data_file:
+			data = json.load(data_file)
+		output = OrderedDict()
+		for name, (kind, value) in sorted(data.items()):
+			if kind == "rois":
+				output[name] = read_rois(os.path.join(entry_dir, value))
+			elif kind == "images":
+				output[name] = [self.read_image(entry_dir, file_name, title) for file_name, title in value]
+			elif kind == "image":
+				output[name] = self.read_image(entry_dir, *value)
+			else:
+				output[name] = value
+		return output
+
+	def read_image(self, entry_dir, file_name, title):
+		imp = IJ.openImage(os.path.join(entry_dir, file_name))
+		if imp is None:
+			raise IOError("Can't open {}".format(file_name))
+		imp.setTitle(title)
+		return imp
+
+	def write_image(self, entry_dir, file_name, imp):
+		IJ.saveAs(imp.duplicate(), "ZIP", os.path.join(entry_dir, file_name)) # Saving a duplicate keeps the original's title and path
+		return [file_name, imp.getTitle()]
+
+	def put(self, stage, key, output):
+		"""
+		Stores the output of a stage, then evicts the least recently used entries beyond the size limit.
+		"""
+		temp_dir = os.path.join(self.cache_dir, "{}_{}.{}.tmp".format(stage, key, uuid.uuid4().hex))
+		os.makedirs(temp_dir)
+		data = {}
+		for name, value in output.items():
+			if isinstance(value, ImagePlus):
+				data[name] = ["image", self.write_image(temp_dir, "{}.zip".format(name), value)]
+			elif isinstance(value, (list, tuple)) and value and all(isinstance(item, ImagePlus) for item in value):
+				data[name] = ["images", [self.write_image(temp_dir, "{}_{}.zip".format(name, enum), item) for enum, item in enumerate(value)]]
+			elif isinstance(value, (list, tuple)) and value and all(isinstance(item, Roi) for item in value):
+				write_rois(value, os.path.join(temp_dir, "{}_RoiSet.zip".format(name)))
+				data[name] = ["rois", "{}_RoiSet.zip".format(name)]
+			else:
+				data[name] = ["json", value]
+		with open(os.path.join(temp_dir, "data.json"), "w") as data_file:
+			json.dump(data, data_file)
+		entry_dir = self.get_path(stage, key)
+		if os.path.exists(entry_dir):
+			shutil.rmtree(entry_dir, True)
+		os.rename(temp_dir, entry_dir) # Readers in other processes never see a partly written entry
+		self.evict()
+		return entry_dir
+
+	def entries(self):
+		"""Returns (last use, size, path) of every cached output, least recently used first"""
+		entries = []
+		for entry_name in os.listdir(self.cache_dir):
+			entry_dir = os.path.join(self.cache_dir, entry_name)
+			if os.path.isdir(entry_dir) and not entry_name.endswith(".tmp"):
+				size = sum(os.path.getsize(os.path.join(entry_dir, file_name)) for file_name in os.listdir(entry_dir))
+				entries.append((os.stat(entry_dir).st_mtime, size, entry_dir))
+		return sorted(entries)
+
+	def evict(self):
+		entries = self.entries()
+		total_bytes = sum(size for _, size, _ in entries)
+		for _, size, entry_dir in entries:
+			if total_bytes <= self.max_bytes:
+				break
+			shutil.rmtree(entry_dir, True)
+			total_bytes -= size
+		return total_bytes
+
+	def clear(self):
+		for _, _, entry_dir in self.entries():
+			shutil.rmtree(entry_dir, True)
+
+class StageGraph:
+	"""
+	Runs the cacheable stages of an analysis (see STAGES), reusing their outputs from earlier runs.
+
+	A stage's key hashes its name, the configuration values of its params, and the keys of its inputs, which are
+	either sources (e.g. the image or fibers, set with `set_source`) or the keys of other stages. Changing a parameter
+	therefore only invalidates the stages that depend on it: a new threshold method re-thresholds the fiber-type masks
+	and re-measures the area fractions, while a new prop_threshold re-runs none of them.
+	Without a cache every stage is simply run.
+	"""
+
+	def __init__(self, config, cache=None):
+		self.config = config
+		self.cache = cache
+		self.sources = {}
+
+	def set_source(self, name, key):
+		self.sources[name] = key
+
+	def key(self, stage):
+		if stage in self.sources:
+			return self.sources[stage]
+		spec = STAGES[stage]
+		description = OrderedDict([("stage", stage), ("version", CACHE_VERSION), \
+		("params", [[param, self.config[param]] for param in spec.params]), ("inputs", [[name, self.key(name)] for name in spec.inputs])])
+		return hash_text(json.dumps(description))
+
+	def run(self, stage, compute):
+		"""
+		Returns the output dict of a stage, from the cache if its inputs and params are unchanged, otherwise from `compute()`.
+		"""
+		if self.cache is None:
+			return compute()
+		key = self.key(stage)
+		output = self.cache.get(stage, key)
+		if output is not None:
+			IJ.log("Reusing {} from {}".format(stage, self.cache.get_path(stage, key)))
+			return output
+		output = compute()
+		self.cache.put(stage, key, output)
+		return output
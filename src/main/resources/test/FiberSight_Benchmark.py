@@ -0,0 +1,272 @@
+# Benchmarks of the FiberSight pipeline stages on synthetic muscle cross-sections.
+#
+# Run from Fiji's script editor. Each stage is timed on sections of increasing size, and the report
+# (one row per section size and stage) is written to ~/FiberSight_benchmarks. If a baseline.csv
+# (e.g. the report of the previous release) is in that folder, stages that got slower are logged.
+
+import os, tempfile, shutil, random
+from math import ceil, sqrt, exp, cos, sin, pi
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from ij import IJ, ImagePlus
+from ij.gui import PolygonRoi, OvalRoi, Roi
+from ij.plugin.frame import RoiManager
+from ij.process import ShortProcessor
+from jy_tools import reload_modules, closeAll
+from profiling import StageProfiler, STAGE_COLUMNS
+from fiber_geometry import FiberGeometry
+from fiber_table import FiberTable
+from image_tools import findNdistances, findInLabelImage
+from central_nucleation import repeated_erosion, gradient_nucleation
+from label_utils import label_area_fractions, exclude_border_labels
+from muscle_fiber_typing import fiber_type_channel
+from fiber_morphology import estimate_fiber_morphology
+from remove_edge_labels import ROI_border_exclusion
+from roi_utils import read_rois, write_rois, R2L
+
+reload_modules()
+
+SIZES = [100, 1000, 10000, 50000]
+FIBER_TYPE_CHANNELS = ["Type I", "Type IIa"]
+PERC_REDUCTIONS = [float(a)/10 for a in range(0, 10, 1)]
+
+# fiber_rois are the true fiber outlines, central_fibers the indices of fibers with a central nucleus,
+# positive_fibers the indices of the fibers positive in each fiber-type channel
+SyntheticSection = namedtuple("SyntheticSection", ["border", "dapi", "fiber_types", "fiber_rois", "xNuc", "yNuc", "central_fibers", "positive_fibers"])
+
+def poisson(rng, mean):
+	"""Draws from a Poisson distribution (Knuth's method, fine for small means)"""
+	limit, k, p = exp(-mean), 0, rng.random()
+	while p > limit:
+		k += 1
+		p *= rng.random()
+	return k
+
+def fiber_polygons(n_fibers, cell_size, margin, rng, jitter=0.3, gap=0.12):
+	"""
+	Returns the outlines of `n_fibers` fibers tiling a section, and the section's width and height.
+
+	The fibers are the cells of a grid whose corners are randomly jittered, a cheap stand-in for a Voronoi tessellation
+	that gives irregular, touching polygons. Each cell is shrunk by `gap` towards its centre, leaving the endomysium between fibers.
+	"""
+	n_cols = int(ceil(sqrt(n_fibers)))
+	n_rows = int(ceil(float(n_fibers)/n_cols))
+	corners = {}
+	for row in range(n_rows+1):
+		for col in range(n_cols+1):
+			dx, dy = rng.uniform(-jitter, jitter), rng.uniform(-jitter, jitter)
+			corners[(row, col)] = (margin + (col+dx)*cell_size, margin + (row+dy)*cell_size)
+	polygons = []
+	for fiber in range(n_fibers):
+		row, col = divmod(fiber, n_cols)
+		points = [corners[(row, col)], corners[(row, col+1)], corners[(row+1, col+1)], corners[(row+1, col)]]
+		x_centre, y_centre = sum(x for x, _ in points)/4, sum(y for _, y in points)/4
+		polygons.append([(x_centre + (x-x_centre)*(1-gap), y_centre + (y-y_centre)*(1-gap)) for x, y in points])
+	return polygons, n_cols*cell_size + 2*margin, n_rows*cell_size + 2*margin
+
+def synthetic_section(n_fibers, cell_size=32, mean_nuclei=2.0, central_fraction=0.1, positive_fraction=0.4, \
+fiber_type_channels=FIBER_TYPE_CHANNELS, seed=0):
+	"""
+	Generates a synthetic muscle cross-section with known central nucleation and fiber types.
+
+	Each fiber gets a Poisson number of nuclei (`mean_nuclei`), of which a `central_fraction` sit near its centre
+	and the rest at its periphery. Each fiber is positive in each fiber-type channel with probability `positive_fraction`.
+	The same seed always generates the same section.
+	"""
+	rng = random.Random(seed)
+	polygons, width, height = fiber_polygons(n_fibers, cell_size, 2*cell_size, rng)
+	fiber_rois = []
+	for fiber, polygon in enumerate(polygons):
+		roi = PolygonRoi([x for x, _ in polygon], [y for _, y in polygon], len(polygon), Roi.POLYGON)
+		roi.setName(str(fiber+1))
+		fiber_rois.append(roi)
+
+	border_ip = ShortProcessor(width, height)
+	border_ip.setValue(1000)
+	border_ip.fill()
+	border_ip.setValue(150)
+	for roi in fiber_rois:
+		border_ip.fill(roi)
+
+	dapi_ip = ShortProcessor(width, height)
+	dapi_ip.setValue(2000)
+	xNuc, yNuc, central_fibers = [], [], set()
+	nucleus_radius = max(2, cell_size//12)
+	for fiber, polygon in enumerate(polygons):
+		x_centre, y_centre = sum(x for x, _ in polygon)/len(polygon), sum(y for _, y in polygon)/len(polygon)
+		for nucleus in range(poisson(rng, mean_nuclei)):
+			if rng.random() < central_fraction:
+				angle, distance = rng.uniform(0, 2*pi), rng.uniform(0, 0.1*cell_size)
+				x, y = x_centre + distance*cos(angle), y_centre + distance*sin(angle)
+				central_fibers.add(fiber)
+			else: # Just inside a random point of the outline
+				(x1, y1), (x2, y2) = rng.choice(zip(polygon, polygon[1:] + polygon[:1]))
+				t = rng.random()
+				x, y = x_centre + 0.85*(x1 + t*(x2-x1) - x_centre), y_centre + 0.85*(y1 + t*(y2-y1) - y_centre)
+			xNuc.append(x)
+			yNuc.append(y)
+			dapi_ip.fill(OvalRoi(x-nucleus_radius, y-nucleus_radius, 2*nucleus_radius, 2*nucleus_radius))
+
+	fiber_types, positive_fibers = [], OrderedDict()
+	for title in fiber_type_channels:
+		ft_ip = ShortProcessor(width, height)
+		ft_ip.setValue(200)
+		ft_ip.fill()
+		ft_ip.setValue(1500)
+		positive_fibers[title] = [fiber for fiber in range(n_fibers) if rng.random() < positive_fraction]
+		for fiber in positive_fibers[title]:
+			ft_ip.fill(fiber_rois[fiber])
+		fiber_types.append(ft_ip)
+
+	channels = []
+	for title, ip in [("Fiber Border", border_ip), ("DAPI", dapi_ip)] + zip(fiber_type_channels, fiber_types):
+		ip.noise(30)
+		ip.resetMinAndMax()
+		channels.append(ImagePlus(title, ip))
+	return SyntheticSection(channels[0], channels[1], channels[2:], fiber_rois, xNuc, yNuc, central_fibers, positive_fibers)
+
+def roi_manager(rois):
+	rm = RoiManager(True)
+	for enum, roi in enumerate(rois):
+		rm.add(None, roi, enum)
+	return rm
+
+def benchmark_section(n_fibers, **options):
+	"""
+	Times each pipeline stage on a synthetic section of `n_fibers` fibers, returning a StageProfiler of the stages.
+	The counts of each stage hold what it found next to what was generated, so a speed-up that breaks a stage shows up too.
+	Both the label-image paths (the pipeline's defaults) and the nearest-fiber and ROI measuring paths are timed.
+	"""
+	IJ.log("### Benchmarking {} fibers ###".format(n_fibers))
+	profiler = StageProfiler("synthetic_{}".format(n_fibers))
+	with profiler.stage("generate") as stage:
+		section = synthetic_section(n_fibers, **options)
+		stage["fibers"], stage["nuclei"] = n_fibers, len(section.xNuc)
+	width, height = section.border.getWidth(), section.border.getHeight()
+	geometry = FiberGeometry(section.fiber_rois)
+	xFib, yFib = geometry.x, geometry.y
+	roi_dir = tempfile.mkdtemp()
+	try:
+		roi_path = os.path.join(roi_dir, "synthetic_fibers_RoiSet.zip")
+		write_rois(section.fiber_rois, roi_path)
+		with profiler.stage("read_rois") as stage:
+			stage["fibers"] = len(read_rois(roi_path))
+	finally:
+		shutil.rmtree(roi_dir)
+
+	rm_fiber = roi_manager(section.fiber_rois)
+	rm_nuclei = roi_manager([Roi(x, y, 1, 1) for x, y in zip(section.xNuc, section.yNuc)])
+	with profiler.stage("findNdistances") as stage:
+		nearestNucleiFibers = findNdistances(section.xNuc, section.yNuc, xFib, yFib, n_fibers, rm_nuclei, 8)
+		stage["nuclei"] = len(nearestNucleiFibers)
+
+	with profiler.stage("repeated_erosion") as stage:
+		num_central, all_reduced, central_fibers = repeated_erosion(PERC_REDUCTIONS, rm_fiber, nearestNucleiFibers, section.xNuc, section.yNuc, xFib, yFib)
+		stage["central_expected"], stage["central_found"] = len(section.central_fibers), len(central_fibers[0.5])
+	RoiManager().getRoiManager().reset()
+
+	with profiler.stage("R2L") as stage:
+		fiber_labels = R2L(section.dapi, section.fiber_rois)
+		stage["fibers"] = n_fibers
+	with profiler.stage("findInLabelImage") as stage:
+		count_nuclei = findInLabelImage(fiber_labels, n_fibers, section.xNuc, section.yNuc)
+		stage["nuclei"], stage["nuclei_found"] = len(section.xNuc), sum(count_nuclei.values())
+	with profiler.stage("gradient_nucleation") as stage:
+		num_central, all_reduced, central_fibers = gradient_nucleation(PERC_REDUCTIONS, fiber_labels, n_fibers, section.xNuc, section.yNuc)
+		stage["central_expected"], stage["central_found"] = len(section.central_fibers), len(central_fibers[0.5])
+
+	for channel in section.fiber_types:
+		positive_expected = len(section.positive_fibers[channel.getTitle()])
+		with profiler.stage("fiber_type_channel") as stage:
+			fiber_type_frac, channel_dup = fiber_type_channel(channel, rm_fiber, threshold_method="Mean", blur_radius=4)
+			stage["positive_expected"] = positive_expected
+			stage["positive_found"] = sum(1 for fraction in fiber_type_frac if fraction > 50)
+		with profiler.stage("label_area_fractions") as stage:
+			fiber_type_frac, = label_area_fractions(fiber_labels.getProcessor(), [channel_dup.getProcessor()], n_fibers)
+			stage["positive_expected"] = positive_expected
+			stage["positive_found"] = sum(1 for fraction in fiber_type_frac if fraction > 50)
+		channel_dup.changes = False
+		channel_dup.close()
+
+	fibers = FiberTable.from_roi_manager(rm_fiber)
+	with profiler.stage("estimate_fiber_morphology") as stage:
+		fiber_labels, areas, min_ferets = estimate_fiber_morphology(section.border, 1.0, fibers, rois=rm_fiber.getRoisAsArray())
+		stage["fibers"] = len(areas)
+
+	inset = 4*int(round(sqrt(geometry.areas[0]))) if n_fibers else 0
+	border_roi = Roi(inset, inset, width-2*inset, height-2*inset)
+	with profiler.stage("ROI_border_exclusion") as stage:
+		edgeless, overlay_image, surviving_rois = ROI_border_exclusion(section.border, border_roi, section.fiber_rois, GPU=False)
+		stage["fibers"] = len(surviving_rois)
+	with profiler.stage("exclude_border_labels") as stage:
+		edgeless_labels, kept = exclude_border_labels(fiber_labels.getProcessor(), border_roi, n_fibers)
+		stage["fibers"] = kept.count(True)
+
+	rm_fiber.close()
+	rm_nuclei.close()
+	for imp in [edgeless, overlay_image, fiber_labels, section.border, section.dapi] + section.fiber_types:
+		imp.close()
+	profiler.log_summary()
+	return profiler
+
+def write_report(profilers, report_path):
+	"""
+	Writes the stages of every benchmarked section to one CSV, sorted by section size then stage order, so reports diff cleanly.
+	"""
+	count_columns = []
+	for profiler in profilers:
+		count_columns.extend(column for column in profiler.count_columns() if column not in count_columns)
+	columns = STAGE_COLUMNS + count_columns
+	with open(report_path, "w") as report_file:
+		report_file.write(",".join(columns) + "\n")
+		for profiler in profilers:
+			for stage in profiler.stages:
+				values = [stage[column] for column in STAGE_COLUMNS] + [stage["counts"].get(column, "") for column in count_columns]
+				report_file.write(",".join(str(value) for value in values) + "\n")
+	IJ.log("Benchmark report saved to {}".format(report_path))
+	return report_path
+
+def read_report(report_path):
+	"""Returns the rows of a report, keyed by (Image, Stage); repeated stages (one per fiber-type channel) are summed"""
+	rows = OrderedDict()
+	with open(report_path) as report_file:
+		columns = report_file.readline().strip().split(",")
+		for line in report_file:
+			row = dict(zip(columns, line.strip().split(",")))
+			key = (row["Image"], row["Stage"])
+			if key in rows:
+				rows[key]["Wall_s"] += float(row["Wall_s"])
+			else:
+				rows[key] = {"Wall_s": float(row["Wall_s"])}
+	return rows
+
+def compare_reports(baseline_path, report_path, tolerance=0.25, min_seconds=0.5):
+	"""
+	Logs the stages that are more than `tolerance` slower than in a baseline report, ignoring stages under `min_seconds`.
+	Returns the list of (image, stage, baseline seconds, seconds) regressions.
+	"""
+	baseline, report = read_report(baseline_path), read_report(report_path)
+	regressions = []
+	for key, row in report.items():
+		if key in baseline and row["Wall_s"] >= min_seconds and row["Wall_s"] > baseline[key]["Wall_s"]*(1+tolerance):
+			regressions.append((key[0], key[1], baseline[key]["Wall_s"], row["Wall_s"]))
+	IJ.log("### {} regressions against {} ###".format(len(regressions), baseline_path))
+	for image, stage, before, after in regressions:
+		IJ.log("{} {}: {:.2f} s -> {:.2f} s".format(image, stage, before, after))
+	return regressions
+
+def run_benchmarks(sizes=SIZES, report_dir=None, **options):
+	report_dir = os.path.join(os.path.expanduser("~"), "FiberSight_benchmarks") if report_dir is None else report_dir
+	if not os.path.exists(report_dir):
+		os.makedirs(report_dir)
+	profilers = [benchmark_section(n_fibers, **options) for n_fibers in sizes]
+	report_path = write_report(profilers, os.path.join(report_dir, "benchmark_{}.csv".format(datetime.now().strftime("%Y%m%d-%H%M%S"))))
+	baseline_path = os.path.join(report_dir, "baseline.csv")
+	if os.path.exists(baseline_path):
+		compare_reports(baseline_path, report_path)
+	return report_path
+
+if __name__ in ['__builtin__','__main__']:
+	IJ.run("Close All")
+	closeAll()
+	run_benchmarks()
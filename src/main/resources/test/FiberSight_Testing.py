@@ -1,7 +1,7 @@
 # Auto-testing
 
 import unittest
-import sys, os
+import sys, os, tempfile, shutil, struct
 import inspect
 from ij import IJ, WindowManager as WM
 from file_naming import FileNamer
@@ -10,7 +10,32 @@ from jy_tools import reload_modules, closeAll, test_Results, match_files
 from cellpose_runner import CellposeRunner
 from utilities import download_model, get_model_path
 from main import run_FiberSight, setup_experiment
-from roi_utils import read_rois
+from batch_runner import run_experiment
+from parallel_batch import shard_images, merge_results
+from segmentation_cache import SegmentationCache, image_key
+from tiled_segmentation import tile_grid, stitch_tiles
+from image_pyramid import ImagePyramid, PyramidLevel, scale_rois
+from tiff_mmap import MappedTiff, open_mapped_tiff
+from lazy_channels import open_channel_handles
+from profiling import StageProfiler
+from incremental import diff_fibers, patch_results, tag_fiber_rois, analysis_settings
+from stage_cache import StageCache, StageGraph, rois_key
+from results_store import ResultsStore
+from threshold_sweep import fiber_histograms, auto_thresholds, area_fractions_above, classify_fibers
+from utilities import read_csv_rows
+from roi_utils import read_rois, iter_rois, write_rois, R2L, rasterize_rois
+from spatial_index import CentroidGrid
+from central_nucleation import gradient_nucleation
+from label_utils import label_area_fractions, exclude_border_labels, erode_labels
+from fiber_morphology import measure_fiber_morphology, estimate_fiber_morphology
+from fiber_geometry import FiberGeometry
+from fiber_table import FiberTable, remove_small_fibers
+from ij.gui import PolygonRoi
+from image_tools import calculateDist, findmin, findInLabelImage
+from ij.gui import Roi, OvalRoi
+from ij.process import ShortProcessor
+from ij.plugin.frame import RoiManager
+import random
 
 reload_modules()
 
@@ -54,6 +79,29 @@ class TestAnalysisSetup(unittest.TestCase):
 	def test_analysis_prerequisites(self):
 		# Test ROI existence checking
 		self.assertFalse(self.setup.get_manual_border())
+
+	def test_lazy_channels(self):
+		image_path = os.path.join(test_directory, "test_experiment_fluorescence", "raw", "skm_rat_R7x10ta.tif")
+		setup = AnalysisSetup(image_path, ["DAPI", "Type I", "Type IIa", "Fiber Border"])
+		self.assertTrue(setup.CN and setup.FT)
+		self.assertFalse(any(handle.is_loaded() for handle in setup.channels))
+		border = setup.border_channel
+		self.assertEqual(border.getTitle(), "Fiber Border")
+		self.assertEqual([handle.is_loaded() for handle in setup.channels], [False, False, False, True])
+		self.assertIsNone(setup.cn_merge_imp)
+		self.assertEqual(list(border.getProcessor().getPixels()), list(setup.imp.getStack().getProcessor(4).getPixels()))
+		self.assertAlmostEqual(setup.imp_scale, setup.imp.getCalibration().pixelWidth)
+
+	def test_release_image(self):
+		image_path = os.path.join(test_directory, "test_experiment_fluorescence", "raw", "skm_rat_R7x10ta.tif")
+		setup = AnalysisSetup(image_path, ["DAPI", "Type I", "None", "Fiber Border"])
+		dapi_pixels = list(setup.imp.getStack().getProcessor(1).getPixels())
+		setup.release_image()
+		self.assertIsNone(setup.loaded_imp)
+		self.assertEqual([handle.is_loaded() for handle in setup.channels], [True, True, False, True])
+		self.assertEqual(list(setup.dapi_channel.getProcessor().getPixels()), dapi_pixels)
+		self.assertAlmostEqual(setup.dapi_channel.getCalibration().pixelWidth, setup.imp_scale)
+		self.assertIsNone(setup.loaded_imp)
 	   
 	def tearDown(self):
 		self.setup.rm_fiber.close()
@@ -111,6 +159,24 @@ class TestCellpose(unittest.TestCase):
 		with self.assertRaises(OSError):
 			self.runner.run_cellpose()
 
+	def test_persistent_worker(self):
+		self.model_name = "cyto3"
+		worker = CellposeRunner(model_name=self.model_name).create_worker()
+		try:
+			counts = []
+			for repeat in range(2): # The second image reuses the loaded model
+				self.runner = CellposeRunner(model_name=self.model_name, diameter=self.diameter, worker=worker)
+				self.runner.set_image(self.setup.imp)
+				self.runner.run_cellpose()
+				self.assertEqual(self.runner.label_image.getWidth(), self.setup.imp.getWidth())
+				counts.append(self.runner.label_image.getProcessor().getMax())
+				self.runner.clean_up()
+			self.assertGreater(counts[0], 0, "No masks found in output")
+			self.assertEqual(counts[0], counts[1])
+		finally:
+			worker.close()
+		self.runner = None
+
 	def test_bad_model(self):
 		self.model_name = "bad_model"
 		with self.assertRaises(RuntimeError):
@@ -232,6 +298,521 @@ class TestFiberSight(unittest.TestCase):
 		IJ.run("Close All")
 		closeAll()
 
+class TestBatchRunner(unittest.TestCase):
+	def test_headless_experiment(self):
+		experiment_dir = os.path.join(test_directory, "test_experiment_psr")
+		if not os.path.exists(experiment_dir):
+			self.skipTest("Path does not exist")
+		summary = run_experiment(experiment_dir, ["Fiber Border", "None", "None", "None"])
+		self.assertEqual(len(summary), 1)
+		self.assertEqual(summary[0]["Status"], "Done")
+		self.assertGreater(summary[0]["Fibers"], 1)
+		self.assertTrue(os.path.exists(os.path.join(experiment_dir, "results", "PSR_crop_w55_results.csv")))
+
+	def test_failures_are_recorded(self):
+		experiment_dir = os.path.join(test_directory, "test_experiment_psr")
+		if not os.path.exists(experiment_dir):
+			self.skipTest("Path does not exist")
+		summary = run_experiment(experiment_dir, ["DAPI", "None", "None", "None"]) # No fiber border channel
+		self.assertEqual(summary[0]["Status"], "Failed")
+
+	def tearDown(self):
+		IJ.run("Close All")
+		closeAll()
+
+class TestParallelBatch(unittest.TestCase):
+	def test_shards_cover_images(self):
+		images = ["image_{}.tif".format(i) for i in range(10)]
+		shards = shard_images(images, 4)
+		self.assertEqual(len(shards), 4)
+		self.assertEqual(sorted(sum(shards, [])), sorted(images))
+		self.assertEqual(len(shard_images(images[:2], 4)), 2)
+
+	def test_merge_results(self):
+		experiment_dir = tempfile.mkdtemp()
+		try:
+			os.mkdir(os.path.join(experiment_dir, "raw"))
+			os.mkdir(os.path.join(experiment_dir, "results"))
+			image_paths = [os.path.join(experiment_dir, "raw", name) for name in ["a.tif", "b.tif"]]
+			with open(FileNamer(image_paths[0]).results_path, "w") as results_file:
+				results_file.write(" ,Label,Area\n1,a:1,10\n2,a:2,20\n")
+			with open(FileNamer(image_paths[1]).results_path, "w") as results_file:
+				results_file.write(" ,Label,Area,Type I_%-Area\n1,b:1,30,55\n")
+			merged_path = os.path.join(experiment_dir, "results", "combined.csv")
+			self.assertEqual(merge_results(image_paths, merged_path), 2)
+			with open(merged_path) as merged_file:
+				lines = merged_file.read().splitlines()
+			self.assertEqual(lines[0], "Image,Label,Area,Type I_%-Area")
+			self.assertEqual(lines[1], "a.tif,a:1,10,")
+			self.assertEqual(lines[3], "b.tif,b:1,30,55")
+		finally:
+			shutil.rmtree(experiment_dir)
+class TestRoiFiles(unittest.TestCase):
+	def test_streamed_rois(self):
+		roi_dir = tempfile.mkdtemp()
+		try:
+			roi_path = os.path.join(roi_dir, "rois.zip")
+			rois = [Roi(10*i, 10, 5 + i, 5) for i in range(20)]
+			for enum, roi in enumerate(rois):
+				roi.setName("fiber_{}".format(enum+1))
+			write_rois(rois, roi_path)
+			read_back = read_rois(roi_path)
+			self.assertEqual([roi.getName() for roi in read_back], [roi.getName() for roi in rois])
+			self.assertEqual(read_back[19].getBounds(), rois[19].getBounds())
+			wide = list(iter_rois(roi_path, roi_filter=lambda roi: roi.getBounds().width >= 20))
+			self.assertEqual(len(wide), 5)
+			self.assertEqual(next(iter_rois(roi_path)).getName(), "fiber_1")
+		finally:
+			shutil.rmtree(roi_dir)
+
+
+class TestImagePyramid(unittest.TestCase):
+	def test_levels(self):
+		pyramid = ImagePyramid(os.path.join(test_directory, "test_experiment_fluorescence", "raw", "skm_rat_R7x10ta.tif"))
+		self.assertEqual(len(pyramid), 1)
+		self.assertEqual(pyramid.level_for_diameter(200).index, 0)
+		pyramid.levels = [PyramidLevel(0, 0, 4000, 3000, 1.0), PyramidLevel(1, 1, 2000, 1500, 2.0), PyramidLevel(2, 2, 1000, 750, 4.0)]
+		self.assertEqual([pyramid.level_for_diameter(diameter).index for diameter in [0, 45, 90, 200]], [0, 0, 1, 2])
+
+	def test_scale_rois(self):
+		roi = Roi(10, 10, 5, 5)
+		roi.setName("fiber_1")
+		scaled, = scale_rois([roi], 2.0)
+		self.assertEqual((scaled.getBounds().x, scaled.getBounds().width), (20, 10))
+		self.assertEqual(scaled.getName(), "fiber_1")
+
+def write_plain_tiff(tiff_path, width, height, pixels_per_inch):
+	"""Writes an uncompressed 8-bit TIFF without an ImageJ description, calibrated in pixels per inch"""
+	n_entries = 11
+	rational_offset = 8 + 2 + 12*n_entries + 4
+	pixel_offset = rational_offset + 16
+	entries = [(256, 4, 1, width), (257, 4, 1, height), (258, 3, 1, 8), (259, 3, 1, 1), (262, 3, 1, 1), (273, 4, 1, pixel_offset), \
+	(277, 3, 1, 1), (278, 4, 1, height), (279, 4, 1, width*height), (282, 5, 1, rational_offset), (283, 5, 1, rational_offset + 8)]
+	data = struct.pack("<2sHI", "II", 42, 8) + struct.pack("<H", n_entries)
+	for tag, field_type, count, value in entries:
+		data += struct.pack("<HHII", tag, field_type, count, value)
+	data += struct.pack("<I", 0) + struct.pack("<IIII", pixels_per_inch, 1, pixels_per_inch, 1)
+	data += "".join(chr(i % 256) for i in range(width*height))
+	with open(tiff_path, "wb") as tiff_file:
+		tiff_file.write(data)
+
+class TestMappedTiff(unittest.TestCase):
+	def test_planes_match(self):
+		tiff_dir = tempfile.mkdtemp()
+		try:
+			imp = IJ.createImage("Mapped", "16-bit ramp", 300, 200, 3, 1, 1)
+			imp.getStack().getProcessor(2).invert()
+			imp.getCalibration().pixelWidth = imp.getCalibration().pixelHeight = 0.5
+			imp.getCalibration().setUnit("micron")
+			tiff_path = os.path.join(tiff_dir, "mapped.tif")
+			IJ.saveAsTiff(imp, tiff_path)
+			tiff = MappedTiff(tiff_path)
+			try:
+				self.assertEqual(tiff.get_size(), (300, 200, 3, 1, 1))
+				self.assertAlmostEqual(tiff.get_calibration().pixelWidth, 0.5)
+				for channel in range(3):
+					self.assertEqual(list(tiff.read_plane(channel).getPixels()), list(imp.getStack().getProcessor(channel+1).getPixels()))
+				ip = imp.getStack().getProcessor(2)
+				ip.setRoi(Roi(120, 50, 64, 100))
+				self.assertEqual(list(tiff.read_region(1, 120, 50, 64, 100).getPixels()), list(ip.crop().getPixels()))
+			finally:
+				tiff.close()
+			self.assertIsNone(open_mapped_tiff(os.path.join(tiff_dir, "mapped.png"))) # Other formats are read by Bio-Formats
+		finally:
+			shutil.rmtree(tiff_dir)
+
+	def test_other_tiffs_use_bioformats(self):
+		tiff_dir = tempfile.mkdtemp()
+		try:
+			tiff_path = os.path.join(tiff_dir, "plain.tif")
+			write_plain_tiff(tiff_path, 30, 20, 50800) # 0.5 microns per pixel
+			self.assertIsNone(open_mapped_tiff(tiff_path))
+			handles, reader = open_channel_handles(tiff_path, ["Fiber Border"])
+			try:
+				self.assertEqual(reader.__class__.__name__, "ChannelReader")
+				self.assertAlmostEqual(handles[0].load().getCalibration().pixelWidth, 0.5, places=3)
+			finally:
+				reader.close()
+		finally:
+			shutil.rmtree(tiff_dir)
+
+class TestStageProfiler(unittest.TestCase):
+	def test_nested_stages(self):
+		profile_dir = tempfile.mkdtemp()
+		try:
+			profiler = StageProfiler("image.tif")
+			with profiler.stage("analysis"):
+				with profiler.stage("count") as stage:
+					stage["fibers"] = 12
+			self.assertEqual([stage["Stage"] for stage in profiler.stages], ["count", "analysis"])
+			self.assertEqual(profiler.get_stage("count")["Parent"], "analysis")
+			self.assertTrue(profiler.get_stage("analysis")["Wall_s"] >= profiler.get_stage("count")["Wall_s"])
+			json_path, csv_path = os.path.join(profile_dir, "profile.json"), os.path.join(profile_dir, "profile.csv")
+			profiler.save(json_path, csv_path)
+			with open(csv_path) as csv_file:
+				rows = csv_file.read().splitlines()
+			self.assertEqual(len(rows), 3)
+			self.assertTrue(rows[0].endswith("fibers"))
+			self.assertTrue(rows[1].endswith(",12"))
+		finally:
+			shutil.rmtree(profile_dir)
+
+class TestSegmentationCache(unittest.TestCase):
+	def setUp(self):
+		self.cache_dir = tempfile.mkdtemp()
+		self.settings = {"model": "cyto3", "diameter": 0, "cellprob_threshold": 0.0, "flow_threshold": 0.4}
+
+	def test_keys(self):
+		imp = IJ.createImage("Pixels", "16-bit ramp", 64, 64, 1)
+		key = image_key(imp, self.settings)
+		self.assertEqual(key, image_key(imp.duplicate(), self.settings))
+		self.assertNotEqual(key, image_key(imp, dict(self.settings, diameter=30)))
+		imp.getProcessor().set(0, 0, 1000)
+		self.assertNotEqual(key, image_key(imp, self.settings))
+
+	def test_round_trip_and_eviction(self):
+		cache = SegmentationCache(self.cache_dir)
+		rois = [Roi(10, 10, 20, 10), PolygonRoi([40, 60, 60, 40], [40, 40, 60, 60], 4, Roi.POLYGON)]
+		self.assertIsNone(cache.get("a"))
+		cache.put("a", rois)
+		cached = cache.get("a")
+		self.assertEqual(len(cached), 2)
+		self.assertEqual(cached[1].getBounds(), rois[1].getBounds())
+
+		entry_size = os.path.getsize(cache.get_path("a"))
+		cache.max_bytes = 2*entry_size
+		cache.put("b", rois)
+		os.utime(cache.get_path("a"), (0, 0)) # "a" becomes the least recently used
+		cache.put("c", rois)
+		self.assertIsNone(cache.get("a"))
+		self.assertIsNotNone(cache.get("b"))
+		self.assertIsNotNone(cache.get("c"))
+
+	def tearDown(self):
+		shutil.rmtree(self.cache_dir)
+
+class TestTiledSegmentation(unittest.TestCase):
+	def test_tiles_cover_image(self):
+		tiles = tile_grid(5000, 1000, tile_size=2048, overlap=256)
+		self.assertEqual(tiles[0][0], 0)
+		self.assertEqual(tiles[-1][0] + tiles[-1][2], 5000)
+		for left, right in zip(tiles, tiles[1:]):
+			self.assertGreaterEqual(left[0] + left[2] - right[0], 256)
+
+	def test_seam_fibers_kept_once(self):
+		tiles = [(0, 0, 100, 100), (60, 0, 100, 100)] # 40 px overlap, seam region x=60..100
+		left_rois = [Roi(10, 10, 20, 20), Roi(70, 40, 20, 20), Roi(90, 70, 10, 20)] # The last one is cut by the seam
+		right_rois = [Roi(10, 40, 20, 20), Roi(20, 70, 20, 20), Roi(50, 10, 20, 20)] # In tile coordinates
+		stitched = stitch_tiles([(tiles[0], left_rois), (tiles[1], right_rois)], 160, 100)
+		bounds = sorted((roi.getBounds().x, roi.getBounds().y) for roi in stitched)
+		self.assertEqual(bounds, [(10, 10), (70, 40), (80, 70), (110, 10)])
+
+	def test_wide_fibers_merged_across_seam(self):
+		tiles = [(0, 0, 100, 100), (60, 0, 100, 100)]
+		left_rois = [Roi(30, 40, 70, 20), Roi(95, 5, 5, 5)] # A fiber wider than the overlap, and a fragment only one tile found
+		right_rois = [Roi(0, 40, 70, 20)]
+		stitched = stitch_tiles([(tiles[0], left_rois), (tiles[1], right_rois)], 160, 100)
+		self.assertEqual(len(stitched), 1)
+		bounds = stitched[0].getBounds()
+		self.assertEqual((bounds.x, bounds.y, bounds.width, bounds.height), (30, 40, 100, 20))
+
+
+class TestCentroidGrid(unittest.TestCase):
+	def setUp(self):
+		random.seed(0)
+		self.xFib = [random.uniform(0, 2000) for _ in range(500)]
+		self.yFib = [random.uniform(0, 1500) for _ in range(500)]
+		self.grid = CentroidGrid(self.xFib, self.yFib)
+
+	def test_matches_brute_force(self):
+		for _ in range(200):
+			x, y = random.uniform(-100, 2100), random.uniform(-100, 1600)
+			distances = calculateDist(x, y, self.xFib, self.yFib, len(self.xFib))
+			self.assertEqual(self.grid.nearest(x, y, 8), findmin(distances, 8))
+
+	def test_more_neighbours_than_points(self):
+		grid = CentroidGrid([1.0, 5.0], [1.0, 5.0])
+		self.assertEqual(grid.nearest(4.0, 4.0, 8), [1, 0])
+
+class TestLabelCounting(unittest.TestCase):
+	def setUp(self):
+		self.imp = IJ.createImage("Blank", "8-bit black", 100, 100, 1)
+		self.rois = [Roi(0, 0, 50, 50), Roi(50, 0, 50, 50), Roi(0, 50, 100, 50)]
+
+	def test_counts_by_label(self):
+		labels = R2L(self.imp, self.rois)
+		xNuc, yNuc = [10.5, 20.5, 75.2, 60.0, 99.9, -5.0, -0.5], [10.5, 40.0, 25.0, 80.0, 99.9, 10.0, 10.0] # The last two are left of the image
+		counts = findInLabelImage(labels, len(self.rois), xNuc, yNuc)
+		self.assertEqual([counts[i] for i in range(len(self.rois))], [2, 1, 2])
+
+	def test_wide_labels(self):
+		labels = R2L(self.imp, self.rois, output_bit_depth=32)
+		self.assertEqual(labels.getBitDepth(), 32)
+		self.assertEqual(labels.getProcessor().getf(99, 99), 3)
+
+	def test_reused_label_image(self):
+		for bit_depth in [16, 32]:
+			label_ip = rasterize_rois(self.rois, 100, 100, bit_depth=bit_depth)
+			reused = rasterize_rois([Roi(10, 10, 20, 20)], 100, 100, label_ip=label_ip)
+			self.assertIs(reused, label_ip)
+			self.assertEqual(list(reused.getPixels()), list(rasterize_rois([Roi(10, 10, 20, 20)], 100, 100, bit_depth=bit_depth).getPixels()))
+
+	def test_rasterize_matches_fill(self):
+		rois = [Roi(5, 5, 30, 20), PolygonRoi([40, 80, 80, 60, 60, 40], [10, 10, 50, 50, 30, 30], 6, Roi.POLYGON), \
+		OvalRoi(20, 50, 30, 25), Roi(30, 20, 20, 40), Roi(90, 90, 20, 20)] # Overlapping, and cut by the image edge
+		expected = ShortProcessor(100, 100)
+		for enum, roi in enumerate(rois):
+			expected.setValue(enum+1)
+			expected.fill(roi)
+		self.assertEqual(list(rasterize_rois(rois, 100, 100).getPixels()), list(expected.getPixels()))
+		self.assertEqual(rasterize_rois(rois, 100, 100, bit_depth=32).getf(40, 40), 4)
+
+	def test_area_fractions(self):
+		mask = IJ.createImage("Mask", "8-bit black", 100, 100, 1).getProcessor()
+		mask.setValue(255)
+		mask.fill(Roi(0, 0, 25, 50)) # Half of the first fiber
+		mask.fill(Roi(0, 50, 100, 50)) # All of the third fiber
+		for bit_depth in [16, 32]:
+			labels = R2L(self.imp, self.rois, output_bit_depth=bit_depth)
+			fractions, = label_area_fractions(labels.getProcessor(), [mask], len(self.rois))
+			self.assertEqual(fractions, [50.0, 0.0, 100.0])
+
+	def test_label_erosion(self):
+		labels = R2L(self.imp, [Roi(10, 10, 30, 30), Roi(25, 25, 15, 15)]).getProcessor() # The second label overlaps a corner of the first
+		for connectivity in [4, 8]:
+			eroded = erode_labels(labels, connectivity=connectivity, n_threads=1)
+			self.assertEqual(list(erode_labels(labels, connectivity=connectivity, n_threads=4).getPixels()), list(eroded.getPixels()))
+			self.assertEqual([eroded.getf(x, y) for x, y in [(10, 20), (11, 20), (24, 30), (23, 30), (26, 30)]], [0, 1, 0, 1, 2])
+			self.assertEqual(eroded.getf(24, 24), 1 if connectivity == 4 else 0) # Only touches the second label diagonally
+
+	def test_border_exclusion(self):
+		border_roi = Roi(5, 5, 90, 55)
+		rois = [Roi(10, 10, 20, 20), Roi(30, 10, 20, 20), Roi(40, 50, 20, 20), Roi(5, 40, 10, 10)] # Inside, touching the first, crossing the border, on the outline
+		for bit_depth in [16, 32]:
+			labels = R2L(self.imp, rois, output_bit_depth=bit_depth)
+			edgeless, kept = exclude_border_labels(labels.getProcessor(), border_roi, len(rois))
+			self.assertEqual(kept, [True, True, False, False])
+			self.assertEqual([edgeless.getf(x, y) for x, y in [(20, 20), (40, 20), (50, 55), (8, 45)]], [1, 2, 0, 0])
+
+class TestGradientNucleation(unittest.TestCase):
+	def test_central_and_peripheral(self):
+		imp = IJ.createImage("Blank", "8-bit black", 100, 50, 1)
+		labels = R2L(imp, [Roi(0, 0, 41, 41), Roi(50, 0, 41, 41)])
+		percReductions = [0.0, 0.2, 0.9]
+		num_central, _, central_fibers = gradient_nucleation(percReductions, labels, 2, [20.5, 51.5], [20.5, 20.5])
+		self.assertEqual(central_fibers[0.0], [0, 1])
+		self.assertEqual(central_fibers[0.2], [0])
+		self.assertEqual(num_central, [2, 1, 1])
+
+class TestFiberMorphology(unittest.TestCase):
+	def test_matches_measure(self):
+		imp = IJ.createImage("Blank", "8-bit black", 100, 100, 1)
+		rois = [Roi(10, 10, 20, 10), PolygonRoi([40, 60, 60, 50, 40], [40, 40, 60, 50, 60], 5, Roi.POLYGON)]
+		morphology = measure_fiber_morphology(rois, scale=0.5)
+		for enum, roi in enumerate(rois):
+			imp.setRoi(roi)
+			stats = imp.getStatistics()
+			self.assertAlmostEqual(morphology["Area"][enum], stats.pixelCount*0.25, delta=1.0)
+			self.assertAlmostEqual(morphology["X"][enum], stats.xCentroid, delta=0.5)
+			self.assertAlmostEqual(morphology["Y"][enum], stats.yCentroid, delta=0.5)
+			self.assertAlmostEqual(morphology["MinFeret"][enum], roi.getFeretValues()[2]*0.5)
+		self.assertAlmostEqual(morphology["Solidity"][0], 1.0)
+		self.assertLess(morphology["Solidity"][1], 1.0)
+		self.assertAlmostEqual(morphology["AR"][0], 2.0, places=3)
+
+	def test_shared_geometry(self):
+		rois = [Roi(10, 10, 20, 10), Roi(50, 50, 10, 10)]
+		geometry = FiberGeometry(rois)
+		self.assertTrue(geometry.matches(rois))
+		self.assertFalse(geometry.matches(rois[:1]))
+		self.assertEqual(geometry.get_scaled_areas(0.5), [50.0, 25.0])
+		x, y = geometry.get_centroids()
+		self.assertAlmostEqual(x[1], 55.0)
+		self.assertAlmostEqual(y[1], 55.0)
+		self.assertEqual(list(measure_fiber_morphology(rois, geometry=geometry)["Area"]), list(measure_fiber_morphology(rois)["Area"]))
+
+	def test_records_table_columns(self):
+		border = IJ.createImage("Fiber Border", "8-bit black", 100, 100, 1)
+		rois = [Roi(10, 10, 20, 10), Roi(50, 50, 10, 10)]
+		rois[0].setName("first")
+		fibers = FiberTable.from_rois(rois)
+		labels, areas, min_ferets = estimate_fiber_morphology(border, 0.5, fibers, rois=rois)
+		self.assertEqual(labels[0], "Fiber Border:first")
+		self.assertEqual(list(fibers.get_column("Area_um2")), [50.0, 25.0])
+		self.assertEqual(list(fibers.get_column("Area")), [200.0, 100.0]) # Still in pixels, for remove_small_fibers
+		self.assertEqual(list(fibers.get_column("MinFeret")), list(min_ferets))
+		self.assertEqual(rois[0].getName(), "first") # The ROIs are left to the figures to rename
+
+class TestFiberTable(unittest.TestCase):
+	def setUp(self):
+		self.rois = [Roi(10, 10, 20, 10), PolygonRoi([40, 60, 60, 40], [40, 40, 60, 60], 4, Roi.POLYGON), Roi(80, 80, 5, 5)]
+		for enum, roi in enumerate(self.rois):
+			roi.setName("fiber_{}".format(enum+1))
+		self.fibers = FiberTable.from_rois(self.rois)
+
+	def test_round_trip(self):
+		self.assertEqual(list(self.fibers.ids), [1, 2, 3])
+		self.assertEqual(list(self.fibers.get_column("Area")), [200.0, 400.0, 25.0])
+		roi = self.fibers.to_roi(1)
+		self.assertEqual(roi.getName(), "fiber_2")
+		self.assertEqual(roi.getBounds(), self.rois[1].getBounds())
+		self.assertEqual(FiberTable.from_rois(self.fibers.to_rois()).ids, self.fibers.ids)
+
+	def test_filter_keeps_ids(self):
+		self.fibers.set_column("Fiber_Type", ["I", "IIa", "IIx"])
+		large_fibers = remove_small_fibers(self.fibers, 100)
+		self.assertEqual(list(large_fibers.ids), [1, 2])
+		self.assertEqual(large_fibers.get_column("Fiber_Type"), ["I", "IIa"])
+		self.assertEqual(large_fibers.to_roi(1).getBounds(), self.rois[1].getBounds())
+		self.assertEqual(list(FiberTable.from_rois(large_fibers.to_rois()[1:]).ids), [2])
+		with self.assertRaises(ValueError):
+			large_fibers.set_column("Area", [1.0])
+
+class TestIncremental(unittest.TestCase):
+	def setUp(self):
+		rois = [Roi(10, 10, 20, 10), PolygonRoi([40, 60, 60, 40], [40, 40, 60, 60], 4, Roi.POLYGON), Roi(80, 80, 5, 5)]
+		self.previous_rois = FiberTable.from_rois(rois).to_rois()
+		unchanged = self.previous_rois[0].clone()
+		unchanged.setProperty("fiber_id", "") # Matched by its outline
+		modified = PolygonRoi([40, 65, 65, 40], [40, 40, 60, 60], 4, Roi.POLYGON)
+		modified.setProperty("fiber_id", "2")
+		self.edited = FiberTable.from_rois([unchanged, modified, Roi(100, 100, 10, 10)])
+
+	def test_diff(self):
+		diff = diff_fibers(self.previous_rois, self.edited)
+		self.assertEqual(diff.unchanged, [(0, 0)])
+		self.assertEqual(diff.modified, [(1, 1)])
+		self.assertEqual(diff.added, [2])
+		self.assertEqual(diff.removed, [2])
+		self.assertEqual(diff.ids, [1, 2, 5])
+
+	def test_patch_results(self):
+		results_dir = tempfile.mkdtemp()
+		try:
+			results_path = os.path.join(results_dir, "results.csv")
+			with open(results_path, "w") as results_file:
+				results_file.write(" ,Label,Area\n1,a,200\n2,b,400\n3,c,25\n")
+			patch_results(results_path, diff_fibers(self.previous_rois, self.edited), 3, {"Label": ["b2", "d"], "Area": [500.0, 100.0]})
+			header, rows = read_csv_rows(results_path)
+			self.assertEqual(rows, [["1", "a", "200"], ["2", "b2", "500.000"], ["3", "d", "100.000"]])
+		finally:
+			shutil.rmtree(results_dir)
+
+	def test_ids_survive_editing(self):
+		roi_dir = tempfile.mkdtemp()
+		try:
+			roi_path = os.path.join(roi_dir, "fibers_RoiSet.zip")
+			write_rois([Roi(10, 10, 20, 10), Roi(40, 40, 20, 20), Roi(80, 80, 5, 5)], roi_path) # Saved by Cellpose, without IDs
+			analysed = FiberTable.from_rois(read_rois(roi_path)).filter([True, True, False]) # The small fiber is removed
+			tag_fiber_rois(roi_path, dict(zip(analysed.ids, analysed.ids)))
+			self.assertEqual([roi.getProperty("fiber_id") for roi in read_rois(roi_path)], ["1", "2", "3"])
+
+			rm = RoiManager(True) # Opened, edited and saved as by ManualRoiEditor
+			rm.open(roi_path)
+			moved = rm.getRoi(1).clone()
+			moved.setLocation(45, 40)
+			rm.setRoi(moved, 1)
+			rm.add(None, Roi(60, 10, 10, 10), 3)
+			rm.save(roi_path)
+			rm.close()
+
+			edited = FiberTable.from_rois(read_rois(roi_path)).filter([True, True, False, True])
+			diff = diff_fibers(analysed.to_rois(), edited)
+			self.assertEqual((diff.unchanged, diff.modified, diff.added, diff.removed), ([(0, 0)], [(1, 1)], [2], []))
+			tag_fiber_rois(roi_path, dict(zip(edited.ids, diff.ids)))
+			self.assertEqual([roi.getProperty("fiber_id") for roi in read_rois(roi_path)], ["1", "2", "3", str(diff.ids[2])])
+		finally:
+			shutil.rmtree(roi_dir)
+
+	def test_border_changes_settings(self):
+		image_path = os.path.join(test_directory, "test_experiment_fluorescence", "raw", "skm_rat_R7x10ta.tif")
+		analysis = AnalysisSetup(image_path, ["DAPI", "Type I", "Type IIa", "Fiber Border"])
+		settings = analysis_settings(analysis, {"threshold_method": "Mean"})
+		analysis.drawn_border_roi = Roi(10, 10, 200, 200) # Redrawn, so every fiber-type threshold changes
+		self.assertNotEqual(analysis_settings(analysis, {"threshold_method": "Mean"}), settings)
+
+class TestStageCache(unittest.TestCase):
+	def setUp(self):
+		self.cache_dir = tempfile.mkdtemp()
+		self.config = {"blur_radius": 4, "threshold_method": "Mean", "image_correction": False, "ft_area_mode": "label", "prop_threshold": 50}
+
+	def make_graph(self, **options):
+		graph = StageGraph(dict(self.config, **options), StageCache(self.cache_dir))
+		graph.set_source("image", "image")
+		graph.set_source("border", rois_key([None]))
+		graph.set_source("fibers", rois_key([Roi(10, 10, 20, 10)]))
+		return graph
+
+	def test_dependent_keys(self):
+		graph = self.make_graph()
+		self.assertEqual(graph.key("ft_fractions"), self.make_graph(prop_threshold=80).key("ft_fractions"))
+		rethresholded = self.make_graph(threshold_method="Otsu")
+		self.assertNotEqual(graph.key("ft_masks"), rethresholded.key("ft_masks"))
+		self.assertNotEqual(graph.key("ft_fractions"), rethresholded.key("ft_fractions"))
+		self.assertEqual(graph.key("nuclei"), rethresholded.key("nuclei"))
+
+	def test_reuse(self):
+		calls = []
+		def detect():
+			calls.append(1)
+			return {"nuclei": [Roi(1, 1, 4, 4), Roi(20, 20, 4, 4)], "count": 2}
+		self.assertEqual(self.make_graph().run("nuclei", detect)["count"], 2)
+		cached = self.make_graph(prop_threshold=80).run("nuclei", detect)
+		self.assertEqual(len(calls), 1)
+		self.assertEqual([roi.getBounds() for roi in cached["nuclei"]], [Roi(1, 1, 4, 4).getBounds(), Roi(20, 20, 4, 4).getBounds()])
+
+	def tearDown(self):
+		shutil.rmtree(self.cache_dir)
+
+class TestThresholdSweep(unittest.TestCase):
+	def setUp(self):
+		self.rois = [Roi(0, 0, 50, 50), Roi(50, 0, 50, 50), Roi(0, 50, 100, 50)]
+		self.channel = IJ.createImage("Channel", "8-bit ramp", 100, 100, 1).getProcessor() # Brighter to the right
+		self.labels = R2L(IJ.createImage("Blank", "8-bit black", 100, 100, 1), self.rois).getProcessor()
+
+	def test_fractions_match_masks(self):
+		thresholds = auto_thresholds(self.channel.getHistogram(), ["Mean", "Otsu"])
+		for label_ip in [self.labels, None]:
+			histograms = fiber_histograms(self.channel, self.rois, label_ip)
+			for threshold in thresholds.values():
+				mask = self.channel.duplicate()
+				mask.threshold(threshold) # Values above the threshold become 255
+				expected, = label_area_fractions(self.labels, [mask], len(self.rois))
+				self.assertEqual(area_fractions_above(histograms, threshold), expected)
+
+	def test_classify(self):
+		fiber_types = classify_fibers(["I", "IIa"], [[80.0, 10.0, float("nan")], [60.0, 90.0, float("nan")]], True, 50)
+		self.assertEqual(fiber_types, ["I/IIa", "IIa", "UND-"])
+
+class TestResultsStore(unittest.TestCase):
+	def setUp(self):
+		results_dict = {"Label": ["a", "b"], "Area": [200.5, 400.0], "MinFeret": [10.0, 20.25], "Central Nuclei": {0: 1, 1: 0}, \
+		"Peripheral Nuclei": [2, 3], "Total Nuclei": [3, 3], "Type I_%-Area": [80.0, float("nan")], "Fiber_Type": ["I", "UND-"]}
+		self.store = ResultsStore.from_results_dict(results_dict, Morph=True, CN=True, FT=True)
+
+	def test_typed_columns(self):
+		self.assertEqual(self.store.columns.keys(), ["Label", "Area", "MinFeret", "Central Nuclei", "Peripheral Nuclei", "Total Nuclei", "Type I_%-Area", "Fiber_Type"])
+		self.assertEqual(self.store.get_column("Central Nuclei").typecode, "i")
+		self.assertEqual(self.store.get_column("Area").typecode, "d")
+		self.assertEqual(ResultsStore.from_results_dict({"Label": ["a"], "Area": [1.0]}).columns.keys(), ["Label"]) # Morphology not run
+		with self.assertRaises(ValueError):
+			self.store.set_column("Area", [1.0])
+
+	def test_save(self):
+		results_dir = tempfile.mkdtemp()
+		try:
+			results_path = self.store.save(os.path.join(results_dir, "results.csv"))
+			header, rows = read_csv_rows(results_path)
+			self.assertEqual(header[:3], [" ", "Label", "Area"])
+			self.assertEqual(rows, [["1", "a", "200.500", "10.000", "1", "2", "3", "80.000", "I"], ["2", "b", "400.000", "20.250", "0", "3", "3", "NaN", "UND-"]])
+		finally:
+			shutil.rmtree(results_dir)
+
+	def test_results_table(self):
+		rt = self.store.to_results_table()
+		self.assertEqual(rt.size(), 2)
+		self.assertEqual(rt.getValue("MinFeret", 1), 20.25)
+		self.assertEqual(rt.getStringValue("Fiber_Type", 1), "UND-")
 
 # TODO
 class TestRoiModification(unittest.TestCase):
@@ -258,6 +839,23 @@ def run_tests():
 	suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestDownloadModel))
 	suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestCellposeFluorescence))
 	suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestFiberSight))
+	suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestBatchRunner))
+	suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestParallelBatch))
+	suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestRoiFiles))
+	suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestImagePyramid))
+	suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestMappedTiff))
+	suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestStageProfiler))
+	suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestSegmentationCache))
+	suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestTiledSegmentation))
+	suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestCentroidGrid))
+	suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestLabelCounting))
+	suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestGradientNucleation))
+	suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestFiberMorphology))
+	suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestFiberTable))
+	suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestIncremental))
+	suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestStageCache))
+	suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestThresholdSweep))
+	suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestResultsStore))
 #	suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestRoiModification))
 	
 	# Run tests and print results
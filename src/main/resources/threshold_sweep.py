@@ -0,0 +1,122 @@
+"""
+Compares the fiber-type distributions given by many fiber-typing settings (blur radius, auto-threshold method and
+prop_threshold) in a single pass, instead of re-running the fiber-typing analysis for every combination.
+
+For each blur radius, every fiber-type channel is prepared once as in `binarize_fiber_type_channel`, scaled to the 256 bins
+ImageJ auto-thresholds with, and histogrammed within every fiber. Each threshold method is then applied to the channel's
+histogram, and a fiber's %-Area is the share of its histogram above the threshold, so further methods and prop_thresholds
+cost no passes over the pixels. Unlike the analysis' masks the positive pixels aren't despeckled, so the fractions can differ
+slightly at the edges of stained regions.
+"""
+
+from ij import IJ
+from ij.process import AutoThresholder, ByteProcessor
+from collections import OrderedDict, Counter
+import csv, math
+from muscle_fiber_typing import prepare_fiber_type_channel, determine_fiber_type
+from label_utils import label_histograms
+from roi_utils import R2L
+
+THRESHOLD_METHODS = list(AutoThresholder.getMethods())
+PROP_THRESHOLDS = [30, 40, 50, 60, 70]
+FIBER_TYPES = ["I", "I/IIa", "IIa", "IIa/IIx", "IIx", "IIx/IIb", "IIb", "UND-", "UND", "UND+", "Err"]
+
+def fiber_histograms(channel_ip, rois, label_ip=None):
+	"""
+	Returns the histogram of an 8-bit channel within each fiber: from a fiber label image if given (as in the "label" ft_area_mode),
+	otherwise from each ROI's mask (as in the "measure" mode, where overlapping fibers share pixels).
+	"""
+	if label_ip is not None:
+		return label_histograms(label_ip, channel_ip, len(rois))
+	histograms = []
+	for roi in rois:
+		channel_ip.setRoi(roi)
+		histograms.append(channel_ip.getHistogram())
+	channel_ip.resetRoi()
+	return histograms
+
+def auto_thresholds(histogram, threshold_methods):
+	"""Returns the bin each method thresholds a histogram at; with a dark background, the bins above it are positive"""
+	thresholder = AutoThresholder()
+	return OrderedDict((method, thresholder.getThreshold(method, histogram)) for method in threshold_methods)
+
+def area_fractions_above(histograms, threshold):
+	"""Returns the percentage of each fiber's pixels above a threshold bin, or NaN for fibers without pixels"""
+	fractions = []
+	for histogram in histograms:
+		area = sum(histogram)
+		fractions.append(100.0*sum(histogram[threshold+1:])/area if area > 0 else float("nan"))
+	return fractions
+
+def bin_intensity(channel_ip, threshold):
+	"""The lowest intensity of the prepared channel that is above a threshold bin"""
+	if isinstance(channel_ip, ByteProcessor):
+		return threshold + 1
+	return channel_ip.getMin() + (threshold + 1)*(channel_ip.getMax() - channel_ip.getMin() + 1)/256.0
+
+def classify_fibers(fiber_type_keys, area_fracs, hybrid, prop_threshold):
+	"""Returns the type of each fiber from the %-Area of each channel, as generate_ft_results does"""
+	fiber_types = []
+	for row in zip(*area_fracs):
+		if all(math.isnan(value) for value in row):
+			row = [0 for value in row]
+		fiber_types.append(determine_fiber_type(fiber_type_keys, list(row), T1_hybrid=hybrid, T2_hybrid=hybrid, T3_hybrid=hybrid, prop_threshold=prop_threshold))
+	return fiber_types
+
+def sweep_fiber_types(analysis, ANALYSIS_CONFIG, threshold_methods=THRESHOLD_METHODS, blur_radii=None, prop_thresholds=PROP_THRESHOLDS):
+	"""
+	Returns one row per combination of blur radius, threshold method and prop_threshold, with the threshold of each channel
+	and the number and percentage of the analysis' fibers of each type.
+	The remaining settings (image_correction, ft_area_mode and assess_hybrid) are taken from the configuration.
+	"""
+	rois = analysis.rm_fiber.getRoisAsArray()
+	titles = [handle.title for handle in analysis.ft_handles]
+	fiber_type_keys = [title.split(" ")[1] for title in titles]
+	label_ip = R2L(analysis.border_channel, rois).getProcessor() if ANALYSIS_CONFIG["ft_area_mode"] == "label" else None
+	rows = []
+	for blur_radius in blur_radii or [ANALYSIS_CONFIG["blur_radius"]]:
+		thresholds, area_fracs = [], []
+		for channel in analysis.ft_channels:
+			IJ.log("### Histogramming {} with a blur radius of {} ###".format(channel.title, blur_radius))
+			prepared = prepare_fiber_type_channel(channel, blur_radius, ANALYSIS_CONFIG["image_correction"], analysis.drawn_border_roi)
+			channel_ip = prepared.getProcessor().convertToByteProcessor(True) # Scaled over the display range, as "no-reset" thresholds it
+			histograms = fiber_histograms(channel_ip, rois, label_ip)
+			channel_thresholds = auto_thresholds(channel_ip.getHistogram(), threshold_methods)
+			fractions = dict((threshold, area_fractions_above(histograms, threshold)) for threshold in set(channel_thresholds.values()))
+			thresholds.append(OrderedDict((method, bin_intensity(prepared.getProcessor(), threshold)) for method, threshold in channel_thresholds.items()))
+			area_fracs.append(OrderedDict((method, fractions[threshold]) for method, threshold in channel_thresholds.items()))
+			prepared.close()
+
+		for method in threshold_methods:
+			for prop_threshold in prop_thresholds:
+				fiber_types = classify_fibers(fiber_type_keys, [fractions[method] for fractions in area_fracs], ANALYSIS_CONFIG["assess_hybrid"], prop_threshold)
+				counts = Counter(fiber_types)
+				row = OrderedDict([("Blur_Radius", blur_radius), ("Threshold_Method", method), ("Prop_Threshold", prop_threshold)])
+				for title, channel_thresholds in zip(titles, thresholds):
+					row["{}_Threshold".format(title)] = round(channel_thresholds[method], 1)
+				row["Fibers"] = len(fiber_types)
+				for fiber_type in FIBER_TYPES:
+					row[fiber_type] = counts[fiber_type]
+					row["{}_%".format(fiber_type)] = round(100.0*counts[fiber_type]/len(fiber_types), 2) if fiber_types else 0
+				rows.append(row)
+	return rows
+
+def save_sweep(rows, sweep_path):
+	with open(sweep_path, "wb") as sweep_file:
+		writer = csv.writer(sweep_file)
+		writer.writerow(rows[0].keys())
+		for row in rows:
+			writer.writerow(row.values())
+	IJ.log("Threshold sweep saved to {}".format(sweep_path))
+	return sweep_path
+
+def run_threshold_sweep(analysis, ANALYSIS_CONFIG, threshold_methods=THRESHOLD_METHODS, blur_radii=None, prop_thresholds=PROP_THRESHOLDS):
+	"""
+	Sweeps the fiber-typing settings of an analysis' fibers (see sweep_fiber_types), and saves the comparison table with its results.
+	"""
+	with analysis.profiler.stage("threshold_sweep") as stage:
+		rows = sweep_fiber_types(analysis, ANALYSIS_CONFIG, threshold_methods, blur_radii, prop_thresholds)
+		stage["fibers"] = analysis.rm_fiber.getCount()
+		stage["settings"] = len(rows)
+	analysis.namer.create_directory("results")
+	return save_sweep(rows, analysis.namer.threshold_sweep_path)
@@ -0,0 +1,236 @@
+from ij import IJ, ImagePlus
+from ij.measure import Calibration
+from ij.process import ByteProcessor, ShortProcessor, FloatProcessor
+from java.io import RandomAccessFile
+from java.nio import ByteBuffer, ByteOrder
+from java.nio.channels import FileChannel
+from jarray import zeros
+import re
+
+# TIFF tags
+IMAGE_WIDTH, IMAGE_LENGTH, BITS_PER_SAMPLE, COMPRESSION = 256, 257, 258, 259
+IMAGE_DESCRIPTION, STRIP_OFFSETS, SAMPLES_PER_PIXEL, STRIP_BYTE_COUNTS = 270, 273, 277, 279
+X_RESOLUTION, RESOLUTION_UNIT, TILE_WIDTH, SAMPLE_FORMAT = 282, 296, 322, 339
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8}
+
+class UnsupportedTiff(Exception):
+	pass
+
+class MappedTiff:
+	"""
+	Reads the planes of an uncompressed, strip-based ImageJ TIFF straight from memory-mapped strips.
+
+	Only the IFDs are parsed when the file is opened. A plane is read with one bulk copy from the mapped pages into the
+	processor's pixel array, without decoding the file or buffering it in the JVM heap, and the pages stay in the OS
+	page cache, where parallel workers reading the same file share them.
+	Other TIFFs, and compressed, tiled, RGB and BigTIFF files, raise UnsupportedTiff.
+	"""
+
+	def __init__(self, file_path):
+		self.file_path = file_path
+		self.file = RandomAccessFile(file_path, "r")
+		self.channel = self.file.getChannel()
+		try:
+			self.read_header()
+		except:
+			self.close()
+			raise
+
+	def read(self, offset, n_bytes):
+		buffer = zeros(n_bytes, 'b')
+		self.file.seek(offset)
+		self.file.readFully(buffer)
+		return ByteBuffer.wrap(buffer).order(self.byte_order)
+
+	def read_values(self, field_type, count, value_offset, entry):
+		"""Returns the values of an IFD entry, reading them from the file when they don't fit in the entry"""
+		n_bytes = TYPE_SIZES.get(field_type, 1)*count
+		data = entry if n_bytes <= 4 else self.read(value_offset, n_bytes)
+		start = data.position() if n_bytes <= 4 else 0
+		if field_type == 2:
+			return "".join(chr(data.get(start + i) & 0xff) for i in range(count)).rstrip("\0")
+		if field_type == 3:
+			return [data.getShort(start + 2*i) & 0xffff for i in range(count)]
+		if field_type == 4:
+			return [data.getInt(start + 4*i) & 0xffffffff for i in range(count)]
+		if field_type == 5:
+			return [float(data.getInt(start + 8*i) & 0xffffffff)/max(1, data.getInt(start + 8*i + 4) & 0xffffffff) for i in range(count)]
+		return [data.get(start + i) & 0xff for i in range(count)]
+
+	def read_ifd(self, offset):
+		n_entries = self.read(offset, 2).getShort(0) & 0xffff
+		entries = self.read(offset + 2, 12*n_entries + 4)
+		tags = {}
+		for i in range(n_entries):
+			tag, field_type = entries.getShort(12*i) & 0xffff, entries.getShort(12*i + 2) & 0xffff
+			count, value_offset = entries.getInt(12*i + 4) & 0xffffffff, entries.getInt(12*i + 8) & 0xffffffff
+			entries.position(12*i + 8)
+			tags[tag] = self.read_values(field_type, count, value_offset, entries)
+		return tags, entries.getInt(12*n_entries) & 0xffffffff
+
+	def read_header(self):
+		header = zeros(8, 'b')
+		self.file.readFully(header)
+		if header[0] == ord("I") and header[1] == ord("I"):
+			self.byte_order = ByteOrder.LITTLE_ENDIAN
+		elif header[0] == ord("M") and header[1] == ord("M"):
+			self.byte_order = ByteOrder.BIG_ENDIAN
+		else:
+			raise UnsupportedTiff("Not a TIFF file")
+		header = ByteBuffer.wrap(header).order(self.byte_order)
+		if header.getShort(2) != 42:
+			raise UnsupportedTiff("Only classic TIFFs are supported (not BigTIFF)")
+
+		self.planes = []
+		ifd_offset = header.getInt(4) & 0xffffffff
+		first = None
+		while ifd_offset:
+			tags, ifd_offset = self.read_ifd(ifd_offset)
+			if first is None:
+				first = tags
+				description = tags.get(IMAGE_DESCRIPTION, "")
+				if not (isinstance(description, str) and description.startswith("ImageJ=")):
+					raise UnsupportedTiff("Only ImageJ TIFFs are mapped; Bio-Formats reads the dimensions and calibration of other TIFFs")
+			if tags.get(COMPRESSION, [1])[0] != 1 or TILE_WIDTH in tags or tags.get(SAMPLES_PER_PIXEL, [1])[0] != 1:
+				raise UnsupportedTiff("Only uncompressed, single sample, strip-based TIFFs can be mapped")
+			if (tags[IMAGE_WIDTH][0], tags[IMAGE_LENGTH][0], tags[BITS_PER_SAMPLE][0]) != (first[IMAGE_WIDTH][0], first[IMAGE_LENGTH][0], first[BITS_PER_SAMPLE][0]):
+				break # e.g. a thumbnail
+			self.planes.append(zip(tags[STRIP_OFFSETS], tags[STRIP_BYTE_COUNTS]))
+
+		self.width, self.height = first[IMAGE_WIDTH][0], first[IMAGE_LENGTH][0]
+		self.bit_depth = first[BITS_PER_SAMPLE][0]
+		self.is_float = first.get(SAMPLE_FORMAT, [1])[0] == 3
+		if self.bit_depth not in (8, 16, 32) or (self.bit_depth == 32) != self.is_float or first.get(SAMPLE_FORMAT, [1])[0] == 2:
+			raise UnsupportedTiff("{}-bit {} pixels can't be mapped".format(self.bit_depth, "float" if self.is_float else "signed or integer"))
+		self.description = first[IMAGE_DESCRIPTION]
+		self.hyperstack = self.read_imagej_description()
+		n_images = self.hyperstack.get("images", len(self.planes))
+		if len(self.planes) == 1 and n_images > 1: # ImageJ only writes the first IFD of large stacks; the planes follow it
+			offset = self.planes[0][0][0]
+			plane_bytes = self.width*self.height*self.bit_depth//8
+			self.planes = [[(offset + plane_bytes*i, plane_bytes)] for i in range(n_images)]
+		self.calibration = self.read_calibration(first)
+
+	def read_imagej_description(self):
+		hyperstack = {}
+		if self.description.startswith("ImageJ="):
+			for key, value in re.findall(r"^(images|channels|slices|frames)=(\d+)$", self.description, re.M):
+				hyperstack[key] = int(value)
+		return hyperstack
+
+	def read_calibration(self, tags):
+		calibration = Calibration()
+		resolution = tags.get(X_RESOLUTION, [0])[0]
+		if resolution > 0:
+			unit = re.search(r"^unit=(.+)$", self.description, re.M)
+			if unit:
+				calibration.pixelWidth = calibration.pixelHeight = 1.0/resolution
+				calibration.setUnit(unit.group(1).replace("\\u00B5", u"\u00b5"))
+			elif tags.get(RESOLUTION_UNIT, [2])[0] == 3: # Centimetres
+				calibration.pixelWidth = calibration.pixelHeight = 10000.0/resolution
+				calibration.setUnit("micron")
+			elif tags.get(RESOLUTION_UNIT, [2])[0] == 2: # Inches, the TIFF default
+				calibration.pixelWidth = calibration.pixelHeight = 25400.0/resolution
+				calibration.setUnit("micron")
+		return calibration
+
+	def get_size(self):
+		"""Returns the (width, height, channels, slices, frames) of the image"""
+		n_slices, n_frames = self.hyperstack.get("slices", 1), self.hyperstack.get("frames", 1)
+		n_channels = self.hyperstack.get("channels", len(self.planes)//(n_slices*n_frames))
+		return self.width, self.height, n_channels, n_slices, n_frames
+
+	def is_single_plane(self):
+		_, _, _, n_slices, n_frames = self.get_size()
+		return n_slices == 1 and n_frames == 1
+
+	def get_calibration(self):
+		return self.calibration.copy()
+
+	def read_plane(self, index):
+		"""Returns a plane (0-indexed) as an ImageProcessor, copied from the mapped strips"""
+		strips = self.planes[index]
+		start = min(offset for offset, _ in strips)
+		end = max(offset + n_bytes for offset, n_bytes in strips)
+		mapped = self.channel.map(FileChannel.MapMode.READ_ONLY, start, end - start).order(self.byte_order)
+		n_pixels = self.width*self.height
+		pixels = zeros(n_pixels, 'b' if self.bit_depth == 8 else 'h' if self.bit_depth == 16 else 'f')
+		position = 0 # in pixels
+		for offset, n_bytes in strips:
+			n_strip_pixels = min(n_bytes*8//self.bit_depth, n_pixels - position)
+			mapped.position(offset - start)
+			if self.bit_depth == 8:
+				mapped.get(pixels, position, n_strip_pixels)
+			elif self.bit_depth == 16:
+				mapped.asShortBuffer().get(pixels, position, n_strip_pixels)
+			else:
+				mapped.asFloatBuffer().get(pixels, position, n_strip_pixels)
+			position += n_strip_pixels
+		if self.bit_depth == 8:
+			ip = ByteProcessor(self.width, self.height, pixels)
+		elif self.bit_depth == 16:
+			ip = ShortProcessor(self.width, self.height, pixels, None)
+		else:
+			ip = FloatProcessor(self.width, self.height, pixels)
+		ip.resetMinAndMax()
+		return ip
+
+	def open_channel(self, channel, title):
+		"""Reads the plane of a channel (0-indexed), as a calibrated ImagePlus"""
+		imp = ImagePlus(title or "C{}".format(channel+1), self.read_plane(channel))
+		imp.setCalibration(self.get_calibration())
+		return imp
+
+	def read_region(self, index, x, y, width, height):
+		"""Returns a rectangle of a plane (0-indexed) as an ImageProcessor, copying only its rows from the mapped strips"""
+		strips, strip_start = [], 0 # (first pixel, offset, pixels) of each strip
+		for offset, n_bytes in self.planes[index]:
+			strips.append((strip_start, offset, n_bytes*8//self.bit_depth))
+			strip_start += strips[-1][2]
+		start = min(offset for _, offset, _ in strips)
+		end = max(offset + n_pixels*self.bit_depth//8 for _, offset, n_pixels in strips)
+		mapped = self.channel.map(FileChannel.MapMode.READ_ONLY, start, end - start).order(self.byte_order)
+		pixels = zeros(width*height, 'b' if self.bit_depth == 8 else 'h' if self.bit_depth == 16 else 'f')
+		strip = 0
+		for row in range(height):
+			pixel = (y + row)*self.width + x
+			while strips[strip][0] + strips[strip][2] <= pixel: # Strips hold whole rows
+				strip += 1
+			first_pixel, offset, _ = strips[strip]
+			mapped.position(offset - start + (pixel - first_pixel)*self.bit_depth//8)
+			if self.bit_depth == 8:
+				mapped.get(pixels, row*width, width)
+			elif self.bit_depth == 16:
+				mapped.asShortBuffer().get(pixels, row*width, width)
+			else:
+				mapped.asFloatBuffer().get(pixels, row*width, width)
+		if self.bit_depth == 8:
+			ip = ByteProcessor(width, height, pixels)
+		elif self.bit_depth == 16:
+			ip = ShortProcessor(width, height, pixels, None)
+		else:
+			ip = FloatProcessor(width, height, pixels)
+		ip.resetMinAndMax()
+		return ip
+
+	def open_region(self, channel, title, region):
+		"""Reads an (x, y, width, height) rectangle of a channel (0-indexed), as a calibrated ImagePlus"""
+		imp = ImagePlus(title or "C{}".format(channel+1), self.read_region(channel, *region))
+		imp.setCalibration(self.get_calibration())
+		return imp
+
+	def close(self):
+		self.channel.close()
+		self.file.close()
+
+def open_mapped_tiff(file_path):
+	"""
+	Returns a MappedTiff of a file, or None if it isn't a TIFF that can be mapped.
+	"""
+	if not file_path.lower().endswith((".tif", ".tiff")):
+		return None
+	try:
+		return MappedTiff(file_path)
+	except UnsupportedTiff as e:
+		IJ.log("Reading {} through Bio-Formats: {}".format(file_path, e))
+		return None
@@ -0,0 +1,180 @@
+from ij import IJ
+from ij.gui import Roi, ShapeRoi
+from ij.plugin import Duplicator
+from spatial_index import CentroidGrid
+
+def tile_grid(width, height, tile_size=2048, overlap=256):
+	"""
+	Returns the (x, y, width, height) of overlapping tiles covering an image. Neighbouring tiles share `overlap` pixels.
+	"""
+	if overlap >= tile_size:
+		raise ValueError("Tile overlap ({}) must be smaller than the tile size ({})".format(overlap, tile_size))
+	step = tile_size - overlap
+	def starts(length):
+		if length <= tile_size:
+			return [0]
+		positions = list(range(0, length - tile_size, step))
+		return positions + [length - tile_size] # The last tile is flush with the image edge
+	return [(x, y, min(tile_size, width), min(tile_size, height)) for y in starts(height) for x in starts(width)]
+
+def crop_tile(imp, tile):
+	"""Duplicates every channel of one tile of an image"""
+	imp.setRoi(Roi(*tile))
+	tile_imp = Duplicator().run(imp)
+	imp.deleteRoi()
+	tile_imp.setTitle("{}-tile_x{}_y{}".format(imp.getTitle(), tile[0], tile[1]))
+	return tile_imp
+
+def touches_inner_edge(roi, tile, width, height):
+	"""
+	Checks if an ROI touches a tile edge that is inside the image, meaning the fiber may be cut by the seam.
+	"""
+	bounds = roi.getBounds()
+	x, y, tile_width, tile_height = tile
+	return (bounds.x <= x and x > 0) or (bounds.y <= y and y > 0) or \
+	(bounds.x + bounds.width >= x + tile_width and x + tile_width < width) or \
+	(bounds.y + bounds.height >= y + tile_height and y + tile_height < height)
+
+def roi_area(roi):
+	return roi.getStatistics().pixelCount
+
+def bounds_intersect(a, b):
+	return a.x < b.x + b.width and b.x < a.x + a.width and a.y < b.y + b.height and b.y < a.y + a.height
+
+def overlap_area(roi, other):
+	"""Returns the number of pixels two ROIs share"""
+	if not bounds_intersect(roi.getBounds(), other.getBounds()):
+		return 0
+	intersection = getattr(ShapeRoi(roi), "and")(ShapeRoi(other)) # 'and' is a python keyword
+	return roi_area(intersection) if intersection.getBounds().width > 0 else 0
+
+def is_duplicate(roi, other, roi_area_px, other_area_px, iou_threshold=0.5, containment_threshold=0.8):
+	"""
+	Checks if two ROIs from different tiles outline the same fiber: either their IoU is high,
+	or most of the smaller ROI lies within the other (a fiber split differently by each tile).
+	"""
+	intersection_area = overlap_area(roi, other)
+	if intersection_area == 0:
+		return False
+	iou = float(intersection_area) / (roi_area_px + other_area_px - intersection_area)
+	containment = float(intersection_area) / min(roi_area_px, other_area_px)
+	return iou >= iou_threshold or containment >= containment_threshold
+
+def tile_intersection(tile, other):
+	"""Returns the (x, y, width, height) shared by two tiles, or None if they don't overlap"""
+	x, y = max(tile[0], other[0]), max(tile[1], other[1])
+	right, bottom = min(tile[0] + tile[2], other[0] + other[2]), min(tile[1] + tile[3], other[1] + other[3])
+	return (x, y, right - x, bottom - y) if right > x and bottom > y else None
+
+def clip_roi(roi, rect_roi):
+	"""Returns an ROI's part within a rectangle ROI, with its area"""
+	clipped = getattr(ShapeRoi(roi), "and")(ShapeRoi(rect_roi))
+	return clipped, roi_area(clipped) if clipped.getBounds().width > 0 else 0
+
+def union_rois(rois):
+	"""Returns the union of overlapping ROIs, as a single ROI where it can be simplified to one"""
+	union = ShapeRoi(rois[0])
+	for roi in rois[1:]:
+		union = getattr(union, "or")(ShapeRoi(roi)) # 'or' is a python keyword
+	parts = union.getRois()
+	return parts[0] if len(parts) == 1 else union
+
+def merge_seam_fragments(fragments, fragment_tiles, tiles, fibers, iou_threshold=0.5, n_neighbours=8):
+	"""
+	Rebuilds fibers that no tile holds whole (those wider than the overlap) from their fragments.
+
+	Fragments (ROIs cut by a tile seam) lying mostly within one of the stitched `fibers` are the cut copies of a fiber found
+	whole in another tile, and are dropped. The others are joined with the fragments of neighbouring tiles they match within the
+	tiles' overlap, by the IoU of their parts in it, and each group is merged into one fiber.
+	Returns the merged fibers and the number of fragments left unmatched.
+	"""
+	if not fragments:
+		return [], 0
+	areas = [roi_area(roi) for roi in fragments]
+	if fibers:
+		fiber_bounds = [roi.getBounds() for roi in fibers]
+		fiber_areas = [roi_area(roi) for roi in fibers]
+		grid = CentroidGrid([b.x + b.width/2.0 for b in fiber_bounds], [b.y + b.height/2.0 for b in fiber_bounds])
+	open_fragments = []
+	for index, roi in enumerate(fragments):
+		bounds = roi.getBounds()
+		neighbours = grid.nearest(bounds.x + bounds.width/2.0, bounds.y + bounds.height/2.0, n_neighbours) if fibers else []
+		if not any(is_duplicate(roi, fibers[other], areas[index], fiber_areas[other], iou_threshold) for other in neighbours):
+			open_fragments.append(index)
+
+	groups = dict((index, index) for index in open_fragments) # Union-find of fragments outlining the same fiber
+	def find(index):
+		while groups[index] != index:
+			index = groups[index]
+		return index
+	by_tile = {}
+	for index in open_fragments:
+		by_tile.setdefault(fragment_tiles[index], []).append(index)
+	tile_ids = sorted(by_tile)
+	for position, tile_id in enumerate(tile_ids):
+		for other_tile in tile_ids[position+1:]:
+			shared = tile_intersection(tiles[tile_id], tiles[other_tile])
+			if shared is None:
+				continue
+			shared_roi = Roi(*shared)
+			parts = {}
+			for index in by_tile[tile_id] + by_tile[other_tile]:
+				if bounds_intersect(fragments[index].getBounds(), shared_roi.getBounds()):
+					part, part_area = clip_roi(fragments[index], shared_roi)
+					if part_area > 0:
+						parts[index] = (part, part_area)
+			for index in [i for i in by_tile[tile_id] if i in parts]:
+				for other in [i for i in by_tile[other_tile] if i in parts]:
+					(part, part_area), (other_part, other_area) = parts[index], parts[other]
+					intersection_area = overlap_area(part, other_part)
+					if intersection_area > 0 and float(intersection_area)/(part_area + other_area - intersection_area) >= iou_threshold:
+						groups[find(index)] = find(other)
+
+	members = {}
+	for index in open_fragments:
+		members.setdefault(find(index), []).append(index)
+	merged = [union_rois([fragments[index] for index in group]) for group in members.values() if len(group) > 1]
+	unmatched = sum(1 for group in members.values() if len(group) == 1)
+	return merged, unmatched
+
+def stitch_tiles(tile_results, width, height, iou_threshold=0.5, n_neighbours=8):
+	"""
+	Merges per-tile segmentations into one global ROI list.
+
+	`tile_results` is a list of (tile, rois), with ROIs in tile coordinates. ROIs cut by a tile seam are set aside, since
+	the overlap usually holds the whole fiber in the neighbouring tile; fibers found whole in more than one tile are kept once,
+	preferring the largest outline. Fibers wider than the overlap are cut in every tile, and are merged from their fragments
+	(see merge_seam_fragments).
+	"""
+	candidates, tile_ids, fragments, fragment_tiles = [], [], [], []
+	for tile_id, (tile, rois) in enumerate(tile_results):
+		for roi in rois:
+			bounds = roi.getBounds()
+			roi.setLocation(bounds.x + tile[0], bounds.y + tile[1])
+			if len(tile_results) > 1 and touches_inner_edge(roi, tile, width, height):
+				fragments.append(roi)
+				fragment_tiles.append(tile_id)
+				continue
+			candidates.append(roi)
+			tile_ids.append(tile_id)
+	if len(tile_results) == 1:
+		return candidates
+
+	areas = [roi_area(roi) for roi in candidates]
+	centers = [roi.getBounds() for roi in candidates]
+	grid = CentroidGrid([b.x + b.width/2.0 for b in centers], [b.y + b.height/2.0 for b in centers])
+	kept = [False]*len(candidates)
+	for index in sorted(range(len(candidates)), key=lambda i: -areas[i]):
+		roi = candidates[index]
+		neighbours = grid.nearest(centers[index].x + centers[index].width/2.0, centers[index].y + centers[index].height/2.0, n_neighbours+1)
+		duplicate = any(kept[other] and tile_ids[other] != tile_ids[index] and \
+		is_duplicate(roi, candidates[other], areas[index], areas[other], iou_threshold) for other in neighbours if other != index)
+		kept[index] = not duplicate
+	stitched = [roi for index, roi in enumerate(candidates) if kept[index]]
+	IJ.log("Stitched {} tiles: {} fibers kept, {} seam duplicates removed".format(len(tile_results), len(stitched), len(candidates)-len(stitched)))
+	merged, unmatched = merge_seam_fragments(fragments, fragment_tiles, [tile for tile, _ in tile_results], stitched, iou_threshold, n_neighbours)
+	if merged:
+		IJ.log("{} fibers wider than the tile overlap merged from their seam fragments".format(len(merged)))
+	if unmatched:
+		IJ.log("WARNING: {} seam fragments matched no fiber of a neighbouring tile and were dropped; a larger tile_overlap may keep them".format(unmatched))
+	return stitched + merged
@@ -1,6 +1,6 @@
 from ij import IJ
 from ij.io import Opener
-import os, sys
+import os, sys, csv
 import urllib2
 
 HOMEDIR = os.path.expanduser("~")
@@ -32,6 +32,12 @@ def make_directories(main_path, folder_names):
 		sys.exit(e)
 	return(folder_paths)
 
+def read_csv_rows(csv_path):
+	with open(csv_path) as csv_file:
+		reader = csv.reader(csv_file)
+		header = next(reader, [])
+		return header, [row for row in reader]
+
 def is_experiment_dir(main_dir, raw_image_dir):
 	if not os.path.isDir(raw_image_dir):
 		return(False)